@@ -0,0 +1,34 @@
+# coding=utf-8
+"""
+Load an agent script as a module, to call its functions directly from tests and micro-benchmarks.
+The agents declare their constants and shared state under `if __name__ == "__main__"`, so that part
+is run too, up to where the agent reads its config. Callers then set the config globals
+(cli_config_vars, if_config_vars, agent_config_vars) they need.
+"""
+import imp
+import logging
+import os
+import sys
+import textwrap
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+# after the installed packages, so a real kafka-python is used if there is one
+sys.path.append(os.path.join(BENCHMARK_DIR, 'standin'))
+MAIN_GUARD = 'if __name__ == "__main__":\n'
+CONFIG_MARKER = '    # get config\n'
+
+
+def load_agent(script, name=None):
+    """ load an agent script, relative to the repo, with its constants and shared state declared """
+    path = os.path.join(REPO_DIR, script)
+    with open(path) as script_file:
+        source = script_file.read()
+    (definitions, _, main) = source.partition(MAIN_GUARD)
+    declarations = main.partition(CONFIG_MARKER)[0]
+    module = imp.new_module(name or os.path.splitext(os.path.basename(script))[0].replace('-', '_'))
+    module.__file__ = path
+    exec(compile(definitions, path, 'exec'), module.__dict__)
+    exec(compile(textwrap.dedent(declarations), path, 'exec'), module.__dict__)
+    module.logger = logging.getLogger(module.__name__)
+    return module
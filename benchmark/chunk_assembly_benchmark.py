@@ -0,0 +1,90 @@
+# coding=utf-8
+"""
+Time how long each agent takes to assemble one chunk of log entries through send_log, for chunk sizes up
+to 2 MB. Chunk assembly that re-serializes the pending chunk for every entry grows with the square of the
+chunk size, so the larger sizes show it up.
+"""
+import random
+import time
+from optparse import OptionParser
+
+from agent_module import load_agent
+
+AGENT_SCRIPTS = {
+    'template': 'template/insightagent-boilerplate.py',
+    'file_replay': 'file_replay/getmessages_file_replay.py',
+    'kafka2': 'kafka2/getmessages_kafka2.py'
+}
+CHUNK_SIZES_KB = (256, 512, 1024, 2048)
+WORDS = ('connection', 'request', 'timeout', 'user', 'session', 'cache', 'disk', 'queue', 'retry', 'worker',
+         'started', 'finished', 'failed', 'slow', 'GET', 'POST', '/api/v1/items', 'ms')
+
+
+class ChunkSent(Exception):
+    pass
+
+
+def make_messages(count):
+    """ reproducible log messages of about 100 bytes """
+    rand = random.Random(0)
+    return [' '.join(rand.choice(WORDS) for _ in range(12)) for _ in range(count)]
+
+
+def time_chunk_assembly(agent, chunk_size_kb, messages, timeout):
+    """ seconds to fill one chunk, and the entries in it, or None if it took longer than timeout """
+    agent.if_config_vars = {'chunk_size': chunk_size_kb * 1024, 'sampling_interval': timeout,
+                            'run_interval': timeout, 'project_type': 'LOG'}
+    agent.reset_track()
+    agent.track.update({'chunk_count': 0, 'entry_count': 0})
+
+    def send_data_wrapper():
+        raise ChunkSent()
+
+    agent.send_data_wrapper = send_data_wrapper
+    start = time.time()
+    try:
+        for i, message in enumerate(messages):
+            agent.send_log(1600000000000 + i, message, 'host-{}'.format(i % 20))
+    except ChunkSent:
+        elapsed = time.time() - start
+        return (elapsed, len(agent.track['current_row'])) if elapsed < timeout else None
+    raise ValueError('{} messages do not fill a {} KB chunk'.format(len(messages), chunk_size_kb))
+
+
+def get_cli_options():
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--agent', action='append', dest='agents',
+                      help='Agent to time: {}. Can be repeated. Defaults to all of them'.format(
+                          ', '.join(sorted(AGENT_SCRIPTS))))
+    parser.add_option('--timeout', default=60, type='int',
+                      help='Seconds after which a chunk is given up on, as sampling_interval would close it. '
+                           'Defaults to 60')
+    (options, args) = parser.parse_args()
+    for agent in options.agents or []:
+        if agent not in AGENT_SCRIPTS:
+            parser.error('unknown agent {}'.format(agent))
+    return options
+
+
+def main():
+    options = get_cli_options()
+    # enough ~100 byte messages for the largest chunk
+    messages = make_messages(max(CHUNK_SIZES_KB) * 1024 // 100 + 1000)
+    rows = [('agent', 'chunk', 'entries', 'seconds', 'entries/sec')]
+    for name in options.agents or sorted(AGENT_SCRIPTS):
+        agent = load_agent(AGENT_SCRIPTS[name])
+        for chunk_size_kb in CHUNK_SIZES_KB:
+            result = time_chunk_assembly(agent, chunk_size_kb, messages, options.timeout)
+            if result is None:
+                rows.append((name, '{} KB'.format(chunk_size_kb), '-', '>{}'.format(options.timeout), '-'))
+                continue
+            (elapsed, entries) = result
+            rows.append((name, '{} KB'.format(chunk_size_kb), str(entries), '{:.2f}'.format(elapsed),
+                         str(int(entries / max(elapsed, 1e-6)))))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join([row[0].ljust(widths[0])] + [value.rjust(width) for value, width in zip(row[1:], widths[1:])]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# coding=utf-8
+"""
+Time an agent's compiled data_fields expression evaluator against filling in the fields and calling
+eval(), as the agents did before, reporting evaluations/sec for each expression.
+"""
+import random
+import sys
+import time
+from optparse import OptionParser
+
+from agent_module import load_agent
+
+AGENT_SCRIPTS = {
+    'template': 'template/insightagent-boilerplate.py',
+    'file_replay': 'file_replay/getmessages_file_replay.py',
+    'kafka2': 'kafka2/getmessages_kafka2.py'
+}
+EXPRESSIONS = [
+    '{used}/{total}',
+    '({end}-{start})*1000',
+    '{used}*100/{total}-{free}/2',
+    'max({used},{free})+round({end}-{start}, 2)'
+]
+
+
+def make_messages(count):
+    """ reproducible messages with the fields the expressions use """
+    rand = random.Random(0)
+    return [{
+        'used': rand.randint(0, 10 ** 6),
+        'free': str(rand.randint(0, 10 ** 6)),
+        'total': rand.randint(10 ** 6, 2 * 10 ** 6),
+        'start': round(rand.uniform(0, 1000), 3),
+        'end': str(round(rand.uniform(1000, 2000), 3))
+    } for _ in range(count)]
+
+
+def evaluate_with_eval(agent, message, expr):
+    """ as the agents evaluated expressions before: fill in the fields, then eval the string """
+    return eval(agent.parse_formatted(message, expr, default=expr))
+
+
+def time_evaluations(evaluate, messages, repeat):
+    """ the best of repeat runs' evaluations/sec """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for message in messages:
+            evaluate(message)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(messages) / best
+
+
+def get_cli_options():
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--agent', default='template',
+                      help='Agent whose evaluator to time: {}. Defaults to template'.format(
+                          ', '.join(sorted(AGENT_SCRIPTS))))
+    parser.add_option('--messages', default=20000, type='int', help='Messages to evaluate. Defaults to 20000')
+    parser.add_option('--repeat', default=3, type='int', help='Runs to take the best of. Defaults to 3')
+    (options, args) = parser.parse_args()
+    if options.agent not in AGENT_SCRIPTS:
+        parser.error('unknown agent {}'.format(options.agent))
+    return options
+
+
+def main():
+    options = get_cli_options()
+    agent = load_agent(AGENT_SCRIPTS[options.agent])
+    messages = make_messages(options.messages)
+    rows = [('expression', 'eval/sec', 'compiled/sec', 'speedup')]
+    for expr in EXPRESSIONS:
+        for message in messages[:100]:
+            if agent.evaluate_math_expr(message, expr) != evaluate_with_eval(agent, message, expr):
+                print('{} evaluates differently for {}'.format(expr, message))
+                sys.exit(1)
+        eval_rate = time_evaluations(lambda message: evaluate_with_eval(agent, message, expr),
+                                     messages, options.repeat)
+        compiled_rate = time_evaluations(lambda message: agent.evaluate_math_expr(message, expr),
+                                         messages, options.repeat)
+        rows.append((expr, str(int(eval_rate)), str(int(compiled_rate)),
+                     '{:.1f}x'.format(compiled_rate / eval_rate)))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join([row[0].ljust(widths[0])] + [value.rjust(width) for value, width in zip(row[1:], widths[1:])]))
+
+
+if __name__ == '__main__':
+    main()
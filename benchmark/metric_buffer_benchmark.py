@@ -0,0 +1,215 @@
+# coding=utf-8
+"""
+Time the template's metric buffer against the one it replaced, which scanned a list of keys for each value,
+re-sorted a list of timestamps for each new instance x timestamp key, and kept each value as a string in a
+dict per key. Values are buffered through send_metric with no buffer limit, then the buffer is flushed
+oldest first into chunks. Each buffer runs in its own process, so the memory it grew by can be compared.
+"""
+import multiprocessing
+import resource
+import sys
+import time
+from optparse import OptionParser
+
+from agent_module import load_agent
+
+TEMPLATE = 'template/insightagent-boilerplate.py'
+CHUNK_SIZE = 2 * 1024 * 1024
+# enough that nothing is flushed while buffering
+METRIC_BUFFER_SIZE = 2 ** 40
+
+
+class GaveUp(Exception):
+    pass
+
+
+class MetricBufferAsBefore(object):
+    """
+    the template's metric buffer before hashed timestamp buckets and column tables: keys in a list, flushed from
+    a sorted list, with a dict of {'metric[instance]': 'value'} strings per key
+    """
+    def __init__(self, agent):
+        self.agent = agent
+        self.key_list = []
+        self.ts_list = []
+        self.buffer_dict = {}
+        self.size_dict = {}
+        self.size = 0
+        self.collected_list = []
+        self.collected_dict = {}
+
+    def send_metric(self, timestamp, field_name, data, instance, device=''):
+        self.append(timestamp, field_name, float(data), instance, device)
+        self.agent.track['entry_count'] += 1
+        while self.collected_list:
+            (ts, key, index) = self.collected_list.pop()
+            del self.ts_list[index]
+            self.collected_dict.pop(key)
+            self.transpose(ts, key)
+            self.send_full_chunk()
+        while self.size >= self.agent.agent_config_vars['metric_buffer_size'] and self.ts_list:
+            (ts, key) = self.ts_list.pop()
+            self.transpose(ts, key)
+            self.send_full_chunk()
+        self.send_full_chunk()
+
+    def append(self, timestamp, field_name, data, instance, device):
+        instance_str = self.agent.make_safe_instance_string(instance, device)
+        key = '{}-{}'.format(str(timestamp), instance_str)
+        metric_str = self.agent.make_safe_metric_key(field_name)
+        metric_key = '{}[{}]'.format(metric_str, instance_str)
+        if key not in self.key_list:
+            self.key_list.append(key)
+            self.ts_list.append((timestamp, key))
+            self.ts_list.sort(key=lambda elem: elem[0], reverse=True)
+            self.buffer_dict[key] = dict()
+            self.size_dict[key] = self.agent.get_json_size_bytes(key) + 6
+            self.size += self.size_dict[key]
+            self.collected_dict[key] = []
+        value_str = str(data)
+        value_size = self.agent.get_json_size_bytes(value_str)
+        if metric_key in self.buffer_dict[key]:
+            value_size -= self.agent.get_json_size_bytes(self.buffer_dict[key][metric_key])
+        else:
+            value_size += self.agent.get_json_size_bytes(metric_key) + 4
+        self.buffer_dict[key][metric_key] = value_str
+        self.size_dict[key] += value_size
+        self.size += value_size
+        self.collected_dict[key].append(metric_str)
+        all_metrics = self.agent.agent_config_vars['all_metrics']
+        if all_metrics and set(all_metrics) <= set(self.collected_dict[key]):
+            self.collected_list.append((timestamp, key, self.ts_list.index((timestamp, key))))
+
+    def transpose(self, ts, key):
+        self.key_list.remove(key)
+        self.size -= self.size_dict.pop(key)
+        self.agent.append_to_current_row(dict({'timestamp': str(ts)}, **self.buffer_dict.pop(key)))
+
+    def send_full_chunk(self):
+        if self.agent.track['current_row_size'] >= self.agent.get_chunk_size():
+            self.agent.send_data_wrapper()
+
+    def flush(self):
+        while self.ts_list:
+            (ts, key) = self.ts_list.pop()
+            self.transpose(ts, key)
+            self.send_full_chunk()
+
+
+def flush_metric_buffer(agent):
+    """ move every buffered row into chunks, oldest first, as the eviction loop in send_metric does """
+    while agent.metric_buffer['buffer_dict']:
+        (ts, key) = agent.get_oldest_metric_buffer_key()
+        agent.transpose_metrics(ts, key)
+        if agent.track['current_row_size'] >= agent.get_chunk_size():
+            agent.send_data_wrapper()
+
+
+def make_samples(keys, timestamps, metrics):
+    """ (timestamp, field name, value, instance) samples for keys instance x timestamp keys, a timestamp at a time """
+    instances = max(keys // timestamps, 1)
+    return [(1560000000000 + ts * 60000, 'metric_{}'.format(metric), float(ts * metric + instance),
+             'host-{}'.format(instance))
+            for ts in range(timestamps) for instance in range(instances) for metric in range(metrics)]
+
+
+def load_template(chunks=None):
+    """ the template, configured to buffer metrics without limit, with the chunks it sends added to chunks """
+    agent = load_agent(TEMPLATE)
+    agent.if_config_vars = {'chunk_size': CHUNK_SIZE, 'run_interval': float('inf')}
+    agent.agent_config_vars = {'all_metrics': set(), 'metric_buffer_size': METRIC_BUFFER_SIZE}
+    agent.track.update({'chunk_count': 0, 'entry_count': 0, 'metrics_suppressed': 0})
+    agent.reset_track()
+    agent.reset_metric_buffer()
+
+    def send_data_wrapper():
+        if chunks is not None:
+            chunks.append(agent.track['current_row'])
+        agent.reset_track()
+    agent.send_data_wrapper = send_data_wrapper
+    return agent
+
+
+def get_peak_rss_mb():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / 1048576.0 if sys.platform == 'darwin' else peak_rss / 1024.0
+
+
+def run(buffer_name, samples, chunks=None, timeout=None):
+    """
+    the seconds buffering and flushing took, and how much the peak RSS grew by while buffering.
+    The chunks sent are added to chunks, if given. Raises GaveUp if buffering takes over timeout
+    """
+    agent = load_template(chunks)
+    if buffer_name == 'before':
+        before = MetricBufferAsBefore(agent)
+        (send_metric, flush) = (before.send_metric, before.flush)
+    else:
+        (send_metric, flush) = (agent.send_metric, lambda: flush_metric_buffer(agent))
+    start_rss_mb = get_peak_rss_mb()
+    start = time.time()
+    for i, sample in enumerate(samples):
+        send_metric(*sample)
+        if timeout and i % 1000 == 0 and time.time() - start > timeout:
+            raise GaveUp()
+    buffered = time.time()
+    rss_mb = get_peak_rss_mb() - start_rss_mb
+    flush()
+    agent.send_data_wrapper()
+    return buffered - start, time.time() - buffered, rss_mb
+
+
+def measure(results, buffer_name, options):
+    """ run a buffer in this process, so its memory is measured on its own, putting what run returns in results """
+    samples = make_samples(options.keys, options.timestamps, options.metrics)
+    try:
+        results.put(run(buffer_name, samples, timeout=options.timeout))
+    except GaveUp:
+        results.put(None)
+
+
+def get_cli_options():
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--keys', default=100000, type='int',
+                      help='Instance x timestamp keys to buffer. Defaults to 100000')
+    parser.add_option('--timestamps', default=5, type='int',
+                      help='Timestamps the keys are spread over. Defaults to 5')
+    parser.add_option('--metrics', default=2, type='int', help='Metrics per key. Defaults to 2')
+    parser.add_option('--timeout', default=300, type='int',
+                      help='Seconds after which buffering is given up on. Defaults to 300')
+    (options, args) = parser.parse_args()
+    return options
+
+
+def main():
+    options = get_cli_options()
+    values = str(max(options.keys // options.timestamps, 1) * options.timestamps * options.metrics)
+    rows = [('buffer', 'keys', 'values', 'buffering s', 'us/value', 'flush s', 'peak RSS +MB')]
+    for buffer_name in ('before', 'after'):
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=measure, args=(results, buffer_name, options))
+        process.start()
+        result = results.get()
+        process.join()
+        if result is None:
+            rows.append((buffer_name, str(options.keys), values, '>{}'.format(options.timeout), '-', '-', '-'))
+            continue
+        (buffering, flush, rss_mb) = result
+        rows.append((buffer_name, str(options.keys), values, '{:.2f}'.format(buffering),
+                     '{:.1f}'.format(buffering * 1000000 / int(values)), '{:.2f}'.format(flush),
+                     '{:.1f}'.format(rss_mb)))
+    # after the measured runs, which would otherwise start from this process's peak RSS
+    check_samples = make_samples(min(options.keys, 2000), options.timestamps, options.metrics)
+    (before_chunks, after_chunks) = ([], [])
+    run('before', check_samples, before_chunks)
+    run('after', check_samples, after_chunks)
+    if before_chunks != after_chunks:
+        print('The buffers flush different chunks')
+        sys.exit(1)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join([row[0].ljust(widths[0])] + [value.rjust(width) for value, width in zip(row[1:], widths[1:])]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+# coding=utf-8
+"""
+A local stand-in for the InsightFinder ingestion API, for benchmarking agents without a live backend.
+It accepts customprojectrawdata, incidentdatareceive and deploymentEventReceive posts, checks that
+each payload has the shape the agents send, and counts what it received. Latency, server errors and
+413s can be injected to see how an agent copes with a slow or struggling backend.
+"""
+import gzip
+import json
+import logging
+import random
+import threading
+import time
+import zlib
+from optparse import OptionParser
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from cStringIO import StringIO as BytesIO
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+    from io import BytesIO
+
+# api: the form field holding its data
+DATA_APIS = {
+    'customprojectrawdata': 'metricData',
+    'incidentdatareceive': 'incidentData',
+    'deploymentEventReceive': 'deploymentData'
+}
+# project management calls the agents make when a token is set
+PROJECT_APIS = {'/api/v1/getprojectstatus', '/api/v1/add-custom-project', '/api/v1/projects/update'}
+REQUIRED_FIELDS = ('userName', 'licenseKey', 'projectName')
+STAT_COUNTERS = ('requests', 'accepted', 'invalid', 'errors_injected', 'too_large', 'bytes_received',
+                 'bytes_decoded', 'events')
+
+
+class PayloadError(ValueError):
+    pass
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency=0, latency_jitter=0, error_rate=0, max_body_kb=0, too_large_rate=0):
+        HTTPServer.__init__(self, address, MockHandler)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.max_body_bytes = max_body_kb * 1024
+        self.too_large_rate = too_large_rate
+        self.lock = threading.Lock()
+        self.stats = dict()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """ start counting from zero """
+        with self.lock:
+            self.stats.clear()
+            self.stats['apis'] = dict()
+            self.stats['first_accepted'] = None
+            self.stats['last_accepted'] = None
+            for counter in STAT_COUNTERS:
+                self.stats[counter] = 0
+
+    def count(self, api, counter, value=1):
+        """ add to a counter, both overall and for the api """
+        with self.lock:
+            self.stats[counter] += value
+            api_stats = self.stats['apis'].setdefault(api, dict.fromkeys(STAT_COUNTERS, 0))
+            api_stats[counter] += value
+
+    def get_stats(self):
+        """ get a copy of the counters """
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the status line, headers and body are written separately, which Nagle holds up on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/stats':
+            self.respond(200, self.server.get_stats())
+        elif path in PROJECT_APIS:
+            # echo the project list back, so the agents see their project as existing
+            self.respond(200, {'success': True, 'data': parse_qs(urlparse(self.path).query).get('projectList', [])})
+        else:
+            self.respond(404, {'success': False, 'message': 'no such api'})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if path == '/reset':
+            self.server.reset_stats()
+            self.respond(200, {'success': True})
+            return
+        if path in PROJECT_APIS:
+            self.respond(200, {'success': True})
+            return
+        api = path.strip('/')
+        if api not in DATA_APIS:
+            self.respond(404, {'success': False, 'message': 'no such api'})
+            return
+
+        server = self.server
+        server.count(api, 'requests')
+        server.count(api, 'bytes_received', len(body))
+        delay = server.latency + random.uniform(0, server.latency_jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if (server.max_body_bytes and len(body) > server.max_body_bytes) or random.random() < server.too_large_rate:
+            server.count(api, 'too_large')
+            self.respond(413, {'success': False, 'message': 'request entity too large'})
+            return
+        if random.random() < server.error_rate:
+            server.count(api, 'errors_injected')
+            self.respond(500, {'success': False, 'message': 'injected error'})
+            return
+        try:
+            body = decode_body(body, self.headers.get('Content-Encoding'))
+            form = body if isinstance(body, str) else body.decode('utf-8')
+            events = validate_payload(api, parse_qs(form, keep_blank_values=True))
+        except (PayloadError, IOError, zlib.error, UnicodeDecodeError) as e:
+            server.count(api, 'invalid')
+            logging.warning('Invalid {} payload: {}'.format(api, e))
+            self.respond(400, {'success': False, 'message': str(e)})
+            return
+        server.count(api, 'accepted')
+        server.count(api, 'bytes_decoded', len(body))
+        server.count(api, 'events', events)
+        with server.lock:
+            now = time.time()
+            server.stats['first_accepted'] = server.stats['first_accepted'] or now
+            server.stats['last_accepted'] = now
+        self.respond(200, {'success': True})
+
+    def respond(self, status, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def decode_body(body, encoding):
+    """ undo gzip or deflate content encoding """
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=BytesIO(body)).read()
+    elif encoding == 'deflate':
+        return zlib.decompress(body)
+    elif encoding:
+        raise PayloadError('unsupported content encoding {}'.format(encoding))
+    return body
+
+
+def validate_payload(api, form):
+    """ check that a post has the fields and entry shape an agent would send, returning how many events it held """
+    for field in REQUIRED_FIELDS:
+        if not form.get(field, [''])[0]:
+            raise PayloadError('missing {}'.format(field))
+    data_field = DATA_APIS[api]
+    if data_field not in form:
+        raise PayloadError('missing {}'.format(data_field))
+    try:
+        entries = json.loads(form[data_field][0])
+    except ValueError as e:
+        raise PayloadError('{} is not json: {}'.format(data_field, e))
+    if not isinstance(entries, list):
+        raise PayloadError('{} is not a list'.format(data_field))
+    events = 0
+    for entry in entries:
+        if not isinstance(entry, dict):
+            raise PayloadError('{} entry is not an object: {}'.format(data_field, entry))
+        events += validate_entry(api, entry)
+    return events
+
+
+def validate_entry(api, entry):
+    """ check one entry, returning how many events it held: one per metric value, or one per log entry """
+    if api != 'customprojectrawdata':
+        # incidents and deployments
+        check_entry_fields(entry, ('timestamp', 'instanceName', 'data'))
+        return 1
+    if 'data' in entry:
+        # logs and alerts
+        check_entry_fields(entry, ('eventId', 'tag', 'data'))
+        return 1
+    # metrics, as {'timestamp': ms, 'metric[instance]': value, ...}
+    check_entry_fields(entry, ('timestamp',))
+    for key, value in entry.items():
+        if key == 'timestamp':
+            continue
+        if not (key.endswith(']') and '[' in key):
+            raise PayloadError('metric key {} is not metric[instance]'.format(key))
+        try:
+            float(value)
+        except (TypeError, ValueError):
+            raise PayloadError('metric {} has a non-numeric value {}'.format(key, value))
+    return len(entry) - 1
+
+
+def check_entry_fields(entry, fields):
+    for field in fields:
+        if field not in entry:
+            raise PayloadError('entry is missing {}: {}'.format(field, entry))
+
+
+def start_server(host='127.0.0.1', port=0, **options):
+    """ start a mock server on a background thread, returning it. port 0 picks a free port """
+    server = MockServer((host, port), **options)
+    thread = threading.Thread(target=server.serve_forever, name='mock-insightfinder')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def get_cli_options():
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--host', default='127.0.0.1', help='Address to listen on. Defaults to 127.0.0.1')
+    parser.add_option('--port', default=8080, type='int', help='Port to listen on. Defaults to 8080')
+    parser.add_option('--latency', default=0, type='float', help='Seconds to wait before answering each post')
+    parser.add_option('--latency-jitter', default=0, type='float',
+                      help='Up to this many more seconds to wait, chosen at random per post')
+    parser.add_option('--error-rate', default=0, type='float', help='Fraction of posts to answer with a 500')
+    parser.add_option('--max-body-kb', default=0, type='int', help='Answer posts larger than this with a 413')
+    parser.add_option('--too-large-rate', default=0, type='float',
+                      help='Fraction of posts to answer with a 413 regardless of size')
+    parser.add_option('-v', '--verbose', action='store_true', default=False, help='Log every request')
+    (options, args) = parser.parse_args()
+    return options
+
+
+if __name__ == '__main__':
+    cli_options = get_cli_options()
+    logging.basicConfig(level=logging.DEBUG if cli_options.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)-8s %(message)s')
+    mock_server = MockServer((cli_options.host, cli_options.port),
+                             latency=cli_options.latency,
+                             latency_jitter=cli_options.latency_jitter,
+                             error_rate=cli_options.error_rate,
+                             max_body_kb=cli_options.max_body_kb,
+                             too_large_rate=cli_options.too_large_rate)
+    logging.info('Listening on http://{}:{}/, GET /stats for counters, POST /reset to clear them'.format(
+        *mock_server.server_address))
+    try:
+        mock_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    logging.info(json.dumps(mock_server.get_stats(), sort_keys=True))
@@ -0,0 +1,324 @@
+# coding=utf-8
+"""
+Drive agents end to end against the mock InsightFinder API over fixture data, reporting events/sec,
+bytes/sec and peak memory for each agent and data type. Results can be saved and compared against an
+earlier run to catch throughput regressions.
+"""
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+from optparse import OptionParser
+
+try:
+    from ConfigParser import RawConfigParser
+except ImportError:
+    from configparser import RawConfigParser
+
+import mock_insightfinder
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+# agent: its script, config template, the config section for its data settings, and project types per data type
+AGENTS = {
+    'template': {
+        'script': 'template/insightagent-boilerplate.py',
+        'config': 'template/config.ini.template',
+        'section': 'agent',
+        # the fixtures are historical, which only replay projects accept
+        'project_types': {'log': 'logreplay', 'metric': 'metricreplay'}
+    },
+    'file_replay': {
+        'script': 'file_replay/getmessages_file_replay.py',
+        'config': 'file_replay/config.ini.template',
+        'section': 'agent',
+        'project_types': {'log': 'logreplay', 'metric': 'metricreplay'}
+    },
+    'kafka2': {
+        'script': 'kafka2/getmessages_kafka2.py',
+        'config': 'kafka2/config.ini.template',
+        'section': 'kafka',
+        'project_types': {'log': 'log', 'metric': 'metric'}
+    }
+}
+DATA_TYPES = ('log', 'metric')
+METRIC_FIELDS = ('cpu', 'mem', 'disk', 'net')
+FIXTURE_HOSTS = 20
+FIXTURE_START_MS = 1600000000000
+FIXTURE_WORDS = ('connection', 'request', 'timeout', 'user', 'session', 'cache', 'disk', 'queue', 'retry',
+                 'worker', 'started', 'finished', 'failed', 'slow', 'GET', 'POST', '/api/v1/items', 'ms')
+# the template's start_data_processing is a placeholder, so swap in one that reads the fixture
+TEMPLATE_DRIVER = '''def start_data_processing(thread_number):
+    """ benchmark driver: parse this worker's share of the json lines in BENCHMARK_FIXTURE """
+    with open(os.environ['BENCHMARK_FIXTURE']) as fixture:
+        for line_number, line in enumerate(fixture):
+            if is_in_worker_partition(line_number, thread_number):
+                parse_json_message(json.loads(line))
+
+
+def template_start_data_processing(thread_number):
+'''
+# run a command, then write its run time and the peak RSS of the largest process it started
+MEASURE_COMMAND = '''import resource, subprocess, sys, time
+start = time.time()
+code = subprocess.call(sys.argv[2:])
+elapsed = time.time() - start
+peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+with open(sys.argv[1], 'w') as measure_file:
+    measure_file.write('{} {}'.format(elapsed, peak_rss / 1048576.0 if sys.platform == 'darwin' else peak_rss / 1024.0))
+sys.exit(code)
+'''
+
+
+def write_fixtures(fixtures_dir, events):
+    """ write reproducible log and metric fixtures of the given number of lines """
+    rand = random.Random(0)
+    if not os.path.exists(fixtures_dir):
+        os.makedirs(fixtures_dir)
+    with open(os.path.join(fixtures_dir, 'log.json'), 'w') as log_file:
+        for i in range(events):
+            log_file.write(json.dumps({
+                'timestamp': FIXTURE_START_MS + i * 10,
+                'host': 'host-{}'.format(i % FIXTURE_HOSTS),
+                'level': rand.choice(('INFO', 'INFO', 'INFO', 'WARN', 'ERROR')),
+                'message': ' '.join(rand.choice(FIXTURE_WORDS) for _ in range(rand.randint(8, 24)))
+            }) + '\n')
+    with open(os.path.join(fixtures_dir, 'metric.json'), 'w') as metric_file:
+        for i in range(events):
+            metric = {
+                'timestamp': FIXTURE_START_MS + (i // FIXTURE_HOSTS) * 60000,
+                'host': 'host-{}'.format(i % FIXTURE_HOSTS)
+            }
+            for field in METRIC_FIELDS:
+                metric[field] = round(rand.uniform(0, 100), 2)
+            metric_file.write(json.dumps(metric) + '\n')
+
+
+def split_fixture(fixture, split_dir, files):
+    """ split a fixture into consecutive runs of lines across several files, as a directory of daily logs would be """
+    os.makedirs(split_dir)
+    with open(fixture) as fixture_file:
+        lines = fixture_file.readlines()
+    per_file = -(-len(lines) // files)
+    for i in range(files):
+        with open(os.path.join(split_dir, '{}.{}'.format(os.path.basename(fixture), i)), 'w') as split_file:
+            split_file.writelines(lines[i * per_file:(i + 1) * per_file])
+
+
+def count_fixture_events(fixture, data_type):
+    """ how many events the mock should receive for a fixture: one per log line, or one per metric value """
+    with open(fixture) as fixture_file:
+        lines = sum(1 for line in fixture_file if line.strip())
+    return lines * len(METRIC_FIELDS) if data_type == 'metric' else lines
+
+
+def prepare_agent(agent, data_type, run_dir, fixture, if_url, options):
+    """ copy an agent into its own directory with a config pointed at the fixture and the mock """
+    settings = AGENTS[agent]
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    os.makedirs(run_dir)
+    script = os.path.join(run_dir, os.path.basename(settings['script']))
+    with open(os.path.join(REPO_DIR, settings['script'])) as source_file:
+        source = source_file.read()
+    if agent == 'template':
+        source = source.replace('def start_data_processing(thread_number):\n', TEMPLATE_DRIVER, 1)
+    with open(script, 'w') as script_file:
+        script_file.write(source)
+
+    config = RawConfigParser()
+    config.read(os.path.join(REPO_DIR, settings['config']))
+    insightfinder_settings = {
+        'user_name': 'benchmark',
+        'license_key': 'benchmark',
+        'token': '',
+        'project_name': 'benchmark-{}-{}'.format(agent, data_type),
+        'project_type': settings['project_types'][data_type],
+        'sampling_interval': '1',
+        'run_interval': '10',
+        'chunk_size_kb': str(options.chunk_size_kb),
+        'if_url': if_url,
+        'if_http_proxy': '',
+        'if_https_proxy': ''
+    }
+    agent_settings = {
+        'filters_include': '',
+        'filters_exclude': '',
+        'data_format': 'json',
+        'json_top_level': '',
+        'timestamp_format': 'epoch',
+        'timezone': '',
+        'timestamp_field': 'timestamp',
+        'instance_field': 'host',
+        'device_field': '',
+        'data_fields': ','.join(METRIC_FIELDS) if data_type == 'metric' else ''
+    }
+    if agent == 'file_replay':
+        agent_settings['data_format'] = 'jsontail' if options.tail else 'json'
+        agent_settings['replay_order'] = options.replay_order
+        agent_settings['split_file_mb'] = str(options.split_file_mb or '')
+        agent_settings['file_path'] = os.path.dirname(fixture)
+        agent_settings['file_name_regex'] = '^{}$'.format(os.path.basename(fixture).replace('.', r'\.'))
+        if options.files > 1:
+            agent_settings['file_path'] = os.path.join(run_dir, 'fixture')
+            agent_settings['file_name_regex'] = r'^{}\.\d+$'.format(os.path.basename(fixture).replace('.', r'\.'))
+            split_fixture(fixture, agent_settings['file_path'], options.files)
+    elif agent == 'kafka2':
+        agent_settings['topics'] = 'benchmark'
+    for section, section_settings in (('insightfinder', insightfinder_settings),
+                                      (settings['section'], agent_settings)):
+        for option, value in section_settings.items():
+            config.set(section, option, value)
+    # optional settings newer agents have; don't leave chunks behind between runs
+    for option in ('spool_dir', 'telemetry_dir', 'telemetry_project'):
+        if config.has_option('insightfinder', option):
+            config.set('insightfinder', option, '')
+    if config.has_option('insightfinder', 'max_in_flight_chunks'):
+        config.set('insightfinder', 'max_in_flight_chunks', str(options.in_flight or ''))
+    if config.has_option('insightfinder', 'max_chunk_size_kb'):
+        config.set('insightfinder', 'min_chunk_size_kb', str(options.min_chunk_size_kb or ''))
+        config.set('insightfinder', 'max_chunk_size_kb', str(options.max_chunk_size_kb or ''))
+    with open(os.path.join(run_dir, 'config.ini'), 'w') as config_file:
+        config.write(config_file)
+    return script
+
+
+def run_scenario(agent, data_type, fixtures_dir, work_dir, server, options):
+    """ run one agent over one fixture, returning its measurements """
+    fixture = os.path.join(fixtures_dir, '{}.json'.format(data_type))
+    run_dir = os.path.join(work_dir, '{}-{}'.format(agent, data_type))
+    if_url = 'http://{}:{}'.format(*server.server_address)
+    script = prepare_agent(agent, data_type, run_dir, fixture, if_url, options)
+
+    env = dict(os.environ, BENCHMARK_FIXTURE=fixture)
+    if agent == 'kafka2':
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.join(BENCHMARK_DIR, 'standin')] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    measure_path = os.path.join(run_dir, 'measure')
+    command = [options.python, '-c', MEASURE_COMMAND, measure_path,
+               options.python, script, '-q', '--threads', str(options.threads)]
+    server.reset_stats()
+    with open(os.path.join(run_dir, 'agent.log'), 'w') as log_file:
+        exit_code = subprocess.call(command, cwd=run_dir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    with open(measure_path) as measure_file:
+        elapsed, peak_rss_mb = [float(value) for value in measure_file.read().split()]
+    stats = server.get_stats()
+    return {
+        'agent': agent,
+        'data_type': data_type,
+        'exit_code': exit_code,
+        'seconds': round(elapsed, 3),
+        'expected_events': count_fixture_events(fixture, data_type),
+        'events': stats['events'],
+        'posts': stats['requests'],
+        'rejected_posts': stats['requests'] - stats['accepted'],
+        'invalid_posts': stats['invalid'],
+        'bytes': stats['bytes_decoded'],
+        'events_per_second': round(stats['events'] / elapsed, 1),
+        'bytes_per_second': round(stats['bytes_decoded'] / elapsed, 1),
+        'peak_rss_mb': round(peak_rss_mb, 1)
+    }
+
+
+def compare_to_baseline(results, baseline, max_regression):
+    """ list the scenarios whose throughput dropped more than max_regression percent from the baseline """
+    baseline_rates = {(result['agent'], result['data_type']): result['events_per_second'] for result in baseline}
+    regressions = []
+    for result in results:
+        baseline_rate = baseline_rates.get((result['agent'], result['data_type']))
+        if not baseline_rate:
+            continue
+        change = 100.0 * (result['events_per_second'] - baseline_rate) / baseline_rate
+        result['change_percent'] = round(change, 1)
+        if change < -max_regression:
+            regressions.append(result)
+    return regressions
+
+
+def print_results(results):
+    columns = ('agent', 'data_type', 'seconds', 'events', 'expected_events', 'posts', 'rejected_posts',
+               'events_per_second', 'bytes_per_second', 'peak_rss_mb', 'change_percent')
+    rows = [columns] + [tuple(str(result.get(column, '')) for column in columns) for result in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+def get_cli_options():
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--agents', default=','.join(sorted(AGENTS)),
+                      help='Comma-separated agents to run. Defaults to {}'.format(','.join(sorted(AGENTS))))
+    parser.add_option('--data-types', default=','.join(DATA_TYPES),
+                      help='Comma-separated data types to run. Defaults to {}'.format(','.join(DATA_TYPES)))
+    parser.add_option('--events', default=100000, type='int',
+                      help='Lines per generated fixture. Defaults to 100000')
+    parser.add_option('--fixtures-dir',
+                      help='Directory of recorded log.json and metric.json fixtures to use instead of generated ones')
+    parser.add_option('--work-dir', help='Directory to run the agents in. Defaults to a temporary directory')
+    parser.add_option('--python', default=sys.executable,
+                      help='Python interpreter to run the agents with. Defaults to this one')
+    parser.add_option('--threads', default=1, type='int', help='Worker processes per agent. Defaults to 1')
+    parser.add_option('--chunk-size-kb', default=2048, type='int', help='chunk_size_kb for the agents')
+    parser.add_option('--in-flight', default=0, type='int', help='max_in_flight_chunks for agents that support it')
+    parser.add_option('--min-chunk-size-kb', default=0, type='int',
+                      help='min_chunk_size_kb for agents that support it')
+    parser.add_option('--max-chunk-size-kb', default=0, type='int',
+                      help='max_chunk_size_kb for agents that support it, to adapt their chunk size')
+    parser.add_option('--tail', action='store_true', default=False,
+                      help='Have file_replay read the fixtures as JSONTAIL, checkpointing its place in each file')
+    parser.add_option('--files', default=1, type='int',
+                      help='Split each fixture into this many files for file_replay. Defaults to 1')
+    parser.add_option('--replay-order', default='', help='replay_order for file_replay: file or timestamp')
+    parser.add_option('--split-file-mb', default=0, type='float',
+                      help='split_file_mb for file_replay, to split fixtures at least this big between --threads')
+    parser.add_option('--latency', default=0, type='float', help='Seconds the mock waits before answering a post')
+    parser.add_option('--error-rate', default=0, type='float', help='Fraction of posts the mock answers with a 500')
+    parser.add_option('--max-body-kb', default=0, type='int', help='Posts larger than this get a 413 from the mock')
+    parser.add_option('--output', help='Write the results as json to this file')
+    parser.add_option('--baseline', help='Compare throughput to results saved by an earlier --output')
+    parser.add_option('--max-regression', default=10, type='float',
+                      help='Exit with an error if events/sec dropped more than this percent from --baseline.' +
+                           ' Defaults to 10')
+    (options, args) = parser.parse_args()
+    return options
+
+
+def main():
+    options = get_cli_options()
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix='insightagent-benchmark-')
+    fixtures_dir = options.fixtures_dir or os.path.join(work_dir, 'fixtures')
+    if not options.fixtures_dir:
+        write_fixtures(fixtures_dir, options.events)
+
+    server = mock_insightfinder.start_server(latency=options.latency, error_rate=options.error_rate,
+                                             max_body_kb=options.max_body_kb)
+    results = []
+    for agent in options.agents.split(','):
+        for data_type in options.data_types.split(','):
+            result = run_scenario(agent, data_type, fixtures_dir, work_dir, server, options)
+            if result['exit_code'] != 0:
+                print('{} {} exited with {}, see {}'.format(agent, data_type, result['exit_code'], os.path.join(
+                    work_dir, '{}-{}'.format(agent, data_type), 'agent.log')))
+            results.append(result)
+    server.shutdown()
+
+    regressions = []
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            regressions = compare_to_baseline(results, json.load(baseline_file), options.max_regression)
+    print_results(results)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    for result in regressions:
+        print('Regression: {} {} events/sec changed {}% from the baseline'.format(
+            result['agent'], result['data_type'], result['change_percent']))
+    if regressions or any(result['exit_code'] != 0 for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
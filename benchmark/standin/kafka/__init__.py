@@ -0,0 +1,40 @@
+# coding=utf-8
+"""
+A stand-in for the parts of kafka-python the kafka2 agent uses, for benchmarking it without a broker.
+Each topic has a single partition holding the lines of the file named by BENCHMARK_FIXTURE; a consumer
+yields them once and then stops, as a real consumer would after consumer_timeout_ms with no new messages.
+"""
+import os
+from collections import namedtuple
+
+TopicPartition = namedtuple('TopicPartition', ['topic', 'partition'])
+ConsumerRecord = namedtuple('ConsumerRecord', ['topic', 'partition', 'offset', 'value'])
+
+
+class KafkaConsumer(object):
+    def __init__(self, *topics, **configs):
+        self.configs = configs
+        self.topics = list(topics)
+        self.partitions = []
+
+    def subscribe(self, topics):
+        self.topics = list(topics)
+        self.partitions = [TopicPartition(topic, 0) for topic in self.topics]
+
+    def partitions_for_topic(self, topic):
+        return {0}
+
+    def assign(self, partitions):
+        self.partitions = list(partitions)
+
+    def assignment(self):
+        return set(self.partitions)
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        for topic, partition in self.partitions:
+            with open(os.environ['BENCHMARK_FIXTURE']) as fixture:
+                for offset, line in enumerate(fixture):
+                    yield ConsumerRecord(topic, partition, offset, line.rstrip('\n'))
@@ -0,0 +1,149 @@
+# coding=utf-8
+"""
+Time an agent's compiled timestamp parsers against trying every format through arrow (the template) or
+strptime and pytz localize() (file_replay), as the agents did before, over a mix of epoch ms, ISO-8601
+timestamps with a fraction and offset, and local wall times.
+"""
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+import arrow
+import pytz
+
+from agent_module import load_agent
+
+AGENT_SCRIPTS = {
+    'template': 'template/insightagent-boilerplate.py',
+    'file_replay': 'file_replay/getmessages_file_replay.py'
+}
+# the template's formats are arrow's; file_replay uses its default ISO-8601 strptime formats
+TEMPLATE_FORMATS = ['YYYY-MM-DD HH:mm:ss', 'YYYY-MM-DDTHH:mm:ss.SZZ', 'epoch']
+# local wall times as each agent's formats take them
+WALL_TIME_FORMATS = {'template': '%Y-%m-%d %H:%M:%S', 'file_replay': '%Y-%m-%dT%H:%M:%S'}
+MIX = (('epoch ms', 0.4), ('ISO-8601', 0.3), ('wall time', 0.3))
+
+
+def make_timestamps(count, wall_time_format):
+    """ reproducible timestamps over a year, mixed as in MIX """
+    rand = random.Random(0)
+    start = datetime(2019, 1, 1)
+    timestamps = []
+    for _ in range(count):
+        moment = start + timedelta(seconds=rand.randint(0, 365 * 24 * 3600), microseconds=rand.randint(0, 999999))
+        kind = rand.random()
+        if kind < MIX[0][1]:
+            timestamps.append(str((moment - datetime(1970, 1, 1)).days * 86400000 + rand.randint(0, 86399999)))
+        elif kind < MIX[0][1] + MIX[1][1]:
+            timestamps.append(moment.strftime('%Y-%m-%dT%H:%M:%S.%f') + rand.choice(('Z', '+05:30', '-04:00')))
+        else:
+            timestamps.append(moment.strftime(wall_time_format))
+    return timestamps
+
+
+def template_timestamp_as_before(agent, date_string):
+    """ the template's get_timestamp_from_date_string before the compiled parsers: arrow for every format """
+    timezone = agent.agent_config_vars['timezone']
+    for timestamp_format in agent.agent_config_vars['timestamp_format']:
+        try:
+            if timestamp_format == 'epoch':
+                if 13 <= len(date_string) < 15:
+                    datetime_obj = arrow.get(time.gmtime(int(date_string) / 1000))
+                elif 9 <= len(date_string) < 13:
+                    datetime_obj = arrow.get(time.gmtime(int(date_string)))
+                else:
+                    continue
+            else:
+                datetime_obj = arrow.get(date_string, timestamp_format, tzinfo=timezone.zone)
+        except Exception as e:
+            # logged as the agent logs it, so both pay for the message
+            agent.logger.debug(e)
+            agent.logger.debug('timestamp {} does not match {}'.format(date_string, timestamp_format))
+            continue
+        return int(datetime_obj.float_timestamp * 1000)
+    return None
+
+
+def file_replay_timestamp_as_before(agent, date_string):
+    """ file_replay's get_timestamp_from_date_string before the compiled parsers: strptime, then localize """
+    date_string = date_string.partition('.')[0]
+    timestamp_datetime = date_string
+    if agent.agent_config_vars['strip_tz']:
+        date_string = ''.join(agent.agent_config_vars['strip_tz_fmt'].split(date_string))
+    for timestamp_format in agent.agent_config_vars['timestamp_format']:
+        try:
+            if timestamp_format == 'epoch':
+                timestamp_datetime = agent.get_datetime_from_unix_epoch(date_string)
+            else:
+                timestamp_datetime = datetime.strptime(date_string, timestamp_format)
+            break
+        except Exception:
+            agent.logger.info('timestamp {} does not match {}'.format(date_string, timestamp_format))
+            continue
+    timestamp_localize = agent.agent_config_vars['timezone'].localize(timestamp_datetime)
+    return long((timestamp_localize - datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds()) * 1000
+
+
+def configure(agent, name, timezone):
+    """ set the agent's formats and timezone as its config would """
+    if name == 'template':
+        agent.agent_config_vars = {'timestamp_format': list(TEMPLATE_FORMATS), 'timezone': timezone}
+    else:
+        agent.agent_config_vars = {'timestamp_format': list(agent.ISO8601), 'timezone': timezone,
+                                   'strip_tz': True, 'strip_tz_fmt': agent.PCT_z_FMT}
+
+
+def time_parsing(parse, timestamps):
+    """ microseconds per timestamp """
+    start = time.time()
+    for timestamp in timestamps:
+        parse(timestamp)
+    return (time.time() - start) * 1000000 / len(timestamps)
+
+
+def get_cli_options():
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('--agent', action='append', dest='agents',
+                      help='Agent to time: {}. Can be repeated. Defaults to both'.format(
+                          ', '.join(sorted(AGENT_SCRIPTS))))
+    parser.add_option('--timestamps', default=1000000, type='int',
+                      help='Timestamps to parse. Defaults to 1000000')
+    parser.add_option('--timezone', default='US/Eastern', help='Timezone of the wall times. Defaults to US/Eastern')
+    (options, args) = parser.parse_args()
+    for agent in options.agents or []:
+        if agent not in AGENT_SCRIPTS:
+            parser.error('unknown agent {}'.format(agent))
+    if options.timezone not in pytz.all_timezones:
+        parser.error('unknown timezone {}'.format(options.timezone))
+    return options
+
+
+def main():
+    options = get_cli_options()
+    timezone = pytz.timezone(options.timezone)
+    rows = [('agent', 'timestamps', 'before us/ts', 'after us/ts', 'speedup')]
+    for name in options.agents or sorted(AGENT_SCRIPTS):
+        agent = load_agent(AGENT_SCRIPTS[name])
+        timestamps = make_timestamps(options.timestamps, WALL_TIME_FORMATS[name])
+        parse_as_before = template_timestamp_as_before if name == 'template' else file_replay_timestamp_as_before
+        configure(agent, name, timezone)
+        for timestamp in timestamps[:1000]:
+            if agent.get_timestamp_from_date_string(timestamp) != parse_as_before(agent, timestamp):
+                print('{} parses {} differently'.format(name, timestamp))
+                sys.exit(1)
+        # each from the configured order, as the compiled parsers move the last match to the front
+        configure(agent, name, timezone)
+        before = time_parsing(lambda timestamp: parse_as_before(agent, timestamp), timestamps)
+        configure(agent, name, timezone)
+        after = time_parsing(agent.get_timestamp_from_date_string, timestamps)
+        rows.append((name, str(len(timestamps)), '{:.1f}'.format(before), '{:.1f}'.format(after),
+                     '{:.1f}x'.format(before / after)))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join([row[0].ljust(widths[0])] + [value.rjust(width) for value, width in zip(row[1:], widths[1:])]))
+
+
+if __name__ == '__main__':
+    main()
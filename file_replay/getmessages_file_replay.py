@@ -7,21 +7,31 @@ import regex
 import socket
 import sys
 import time
+import calendar
+import csv
+import itertools
+import math
+import mmap
+import zlib
+import select
+import ctypes
+import ctypes.util
+import operator
+import Queue
+import heapq
+import cPickle
+import shutil
+import tempfile
 import pytz
 from optparse import OptionParser
-from multiprocessing import Process
+from multiprocessing import Pool, Process, Queue as ProcessQueue
+from collections import OrderedDict
 from datetime import datetime
+from cStringIO import StringIO
 import dateutil
 import urlparse
-import httplib
-import requests
-import statistics
 import subprocess
 import shlex
-import xlrd
-import xml2dict
-import avro.datafile
-import avro.io
 
 
 '''
@@ -37,24 +47,12 @@ def start_data_processing(thread_number):
             agent_config_vars['file_name_regex'])
     # sort by update time, reading oldest first
     file_list.sort(key=lambda x: os.path.getmtime(x))
-    # create list of [{st_ino: filename}, {st_ino: filename}, ...]
-    file_list = [{str(os.stat(i).st_ino): i} for i in file_list]
+    # create list of [{st_ino: filename}, {st_ino: filename}, ...], keeping only this worker's files
+    file_list = [{str(os.stat(i).st_ino): i} for i in file_list if is_worker_file(i, thread_number)]
     # track st_ino of filenames
-    completed_files_st_ino = agent_config_vars['state']['completed_files_st_ino']
-    # start with current file or first in queue
-    current_file = agent_config_vars['state']['current_file']
-    if current_file:
-        _file = json.loads(current_file)
-        _file_st_ino, _file_name = _file.items()[0]
-        if str(os.stat(_file_name).st_ino) != _file_st_ino:
-            # between the last read and now, this file has rotated
-            update_state('current_file', '')
-            update_state('current_file_offset', 0)
-            _file = file_list.pop(0)
-        else:
-            file_list.pop(file_list.index(_file))
-    else:
-        _file = file_list.pop(0)
+    completed_files_st_ino = get_checkpoint_completed_files()
+    # TAIL formats pick each file up where the checkpoint left it, by st_ino, so a renamed file carries on
+    _file = file_list.pop(0) if len(file_list) != 0 else None
     # while there's a file to read
     while _file:
         logger.debug(_file)
@@ -64,29 +62,9 @@ def start_data_processing(thread_number):
             logger.debug('already streamed file {}'.format(file_name))
             _file = file_list.pop(0) if len(file_list) != 0 else None
             continue
-        # read from the file
-        message = ''
-        for line in reader(data_format, file_name, st_ino_orig):
-            if line:
-                logger.debug(line)
-                try:
-                    if 'IFEXPORT' in data_format:
-                        track['current_row'].append(line)
-                        send_metric()
-                    elif 'RAW' in data_format:
-                        message = parse_raw_line(message, line)
-                    else:  # everything else gets converted to a dict
-                        parse_json_message(line)
-                except Exception as e:
-                    logger.debug('Error when processing line {}'.format(line))
-                    logger.debug(e)
-        # get last message
-        if 'RAW' in data_format:
-            try:
-                parse_raw_message(message)
-            except Exception as e:
-                logger.debug('Error when processing line {}'.format(message))
-                logger.debug(e)
+        # read from the file, or this worker's part of it
+        part = (thread_number, cli_config_vars['threads']) if is_split_file(file_name) else None
+        replay_file(data_format, file_name, st_ino_orig, part)
         # mark as done
         completed_files_st_ino.append(st_ino_orig)
         # update file_list
@@ -94,7 +72,7 @@ def start_data_processing(thread_number):
                 agent_config_vars['file_path'],
                 agent_config_vars['file_name_regex'])
         # queue add'l files
-        new_files = [{str(os.stat(i).st_ino): i} for i in cur_files if ({str(os.stat(i).st_ino): i} not in file_list and str(os.stat(i).st_ino) not in completed_files_st_ino)]
+        new_files = [{str(os.stat(i).st_ino): i} for i in cur_files if ({str(os.stat(i).st_ino): i} not in file_list and str(os.stat(i).st_ino) not in completed_files_st_ino and is_worker_file(i, thread_number))]
         file_list += new_files
         file_list.sort(key=lambda x: os.path.getmtime(x.values()[0]))
         logger.debug(file_list)
@@ -102,9 +80,256 @@ def start_data_processing(thread_number):
         _file = file_list.pop(0) if len(file_list) != 0 else None
 
 
+def is_worker_file(file_name, thread_number):
+    """ whether a worker reads a file: its own share of the files, and its part of each file big enough to split """
+    return is_split_file(file_name) or is_in_worker_partition(os.stat(file_name).st_ino, thread_number)
+
+
+def is_split_file(file_name):
+    """ whether a file is big enough to split into a part for each worker """
+    return (agent_config_vars['split_file_bytes'] and cli_config_vars['threads'] > 1 and
+            os.path.getsize(file_name) >= agent_config_vars['split_file_bytes'])
+
+
+def replay_file(data_format, file_name, st_ino, part=None):
+    """ parse a file, or a (part, parts) of it, handing off each message in it """
+    if agent_config_vars['csv_block_rows']:
+        for lines, block in read_csv_blocks(data_format, file_name, part):
+            replay_csv_block(data_format, lines, block)
+        return
+    message = ''
+    for line in reader(data_format, file_name, st_ino, part):
+        if line:
+            logger.debug(line)
+            try:
+                if 'IFEXPORT' in data_format:
+                    export_handoff(line.get('timestamp'), line)
+                elif 'RAW' in data_format:
+                    message = parse_raw_line(message, line)
+                else:  # everything else gets converted to a dict
+                    parse_json_message(line)
+            except Exception as e:
+                logger.debug('Error when processing line {}'.format(line))
+                logger.debug(e)
+    # get last message
+    if 'RAW' in data_format:
+        try:
+            parse_raw_message(message)
+        except Exception as e:
+            logger.debug('Error when processing line {}'.format(message))
+            logger.debug(e)
+
+
+def replay_merged():
+    """ parse the files in a pool of --threads workers, then send what they hold merged into timestamp order """
+    file_list = get_all_files(
+            agent_config_vars['file_path'],
+            agent_config_vars['file_name_regex'])
+    file_list.sort(key=lambda x: os.path.getmtime(x))
+    spill_dir = tempfile.mkdtemp(prefix='file-replay-merge-')
+    try:
+        pool = Pool(cli_config_vars['threads'])
+        try:
+            # a task for each file, or for each part of one big enough to split
+            tasks = []
+            for file_name in file_list:
+                parts = cli_config_vars['threads'] if is_split_file(file_name) else 1
+                for part in range(parts):
+                    tasks.append((len(tasks), file_name, (part, parts) if parts > 1 else None, spill_dir))
+            runs = pool.map(spill_file, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        runs = sum(runs, [])
+        logger.debug('Merging {} sorted runs from {} files'.format(len(runs), len(file_list)))
+        for (_, _, _, handoff, args) in heapq.merge(*[read_merge_run(path, run_id) for run_id, path in enumerate(runs)]):
+            globals()[handoff](*args)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+def spill_file(task):
+    """ in a pool worker, parse one file or part, spilling its messages to runs sorted by timestamp. returns the runs """
+    index, file_name, part, spill_dir = task
+    merge.update({'dir': spill_dir, 'name': str(index), 'records': [], 'seq': 0,
+                  'runs': [], 'run': None, 'last': None})
+    try:
+        replay_file(agent_config_vars['data_format'], file_name, str(os.stat(file_name).st_ino), part)
+        spill_merge_records()
+        return merge['runs']
+    finally:
+        if merge['run']:
+            merge['run'].close()
+        merge.clear()
+
+
+def merge_record(handoff, *args):
+    """ keep a handoff to replay once the files are merged, keyed by its timestamp and the order it came in """
+    merge['records'].append((int(args[0]), merge['seq'], handoff, args))
+    merge['seq'] += 1
+    if len(merge['records']) >= MERGE_RUN_SIZE:
+        spill_merge_records()
+
+
+def spill_merge_records():
+    """ sort the records kept so far and write them out, carrying on the current run if they follow on from it """
+    records = merge['records']
+    if not records:
+        return
+    records.sort()
+    # a file already in timestamp order is written as a single run
+    if merge['run'] is None or records[0][0] < merge['last']:
+        if merge['run']:
+            merge['run'].close()
+        path = os.path.join(merge['dir'], '{}-{}'.format(merge['name'], len(merge['runs'])))
+        merge['run'] = open(path, 'wb')
+        merge['runs'].append(path)
+    for i in range(0, len(records), MERGE_BATCH_SIZE):
+        cPickle.dump(records[i:i + MERGE_BATCH_SIZE], merge['run'], cPickle.HIGHEST_PROTOCOL)
+    merge['last'] = records[-1][0]
+    merge['records'] = []
+
+
+def read_merge_run(path, run_id):
+    """ read a run back, with run_id breaking timestamp ties between runs in file order """
+    with open(path, 'rb') as run:
+        while True:
+            try:
+                batch = cPickle.load(run)
+            except EOFError:
+                return
+            for (timestamp, seq, handoff, args) in batch:
+                yield (timestamp, run_id, seq, handoff, args)
+
+
+def read_csv_blocks(_format, _file, part=None):
+    """ read a CSV or IFEXPORT file, or a part of it, csv_block_rows lines at a time.
+    yields each block's lines, and a pandas DataFrame of their fields as strings (None if pandas can't read them) """
+    import pandas
+    separator = agent_config_vars['csv_block_separator']
+    with open(_file) as data:
+        if 'IFEXPORT' in _format:
+            agent_config_vars['csv_field_names'] = data.readline().strip().split(',')
+        field_names = agent_config_vars['csv_field_names']
+        lines = read_file_part(data, part) if part else data
+        while True:
+            block_lines = list(itertools.islice(lines, agent_config_vars['csv_block_rows']))
+            if not block_lines:
+                return
+            text = ''.join(block_lines)
+            if agent_config_vars['csv_field_delimiter'].pattern == CSV_DELIM:
+                # the default delimiter splits on tabs too
+                text = text.replace('\t', separator)
+            try:
+                block = pandas.read_csv(StringIO(text), sep=separator, header=None, names=field_names,
+                                        usecols=range(len(field_names)), dtype=str, na_filter=False,
+                                        quoting=csv.QUOTE_NONE, skip_blank_lines=False, engine='c')
+            except ValueError as e:
+                # pandas sizes the rows by the first line, so a short one there is left to the row at a time path
+                logger.debug('Could not read a block of {} lines with pandas: {}'.format(len(block_lines), e))
+                block = None
+            yield block_lines, block
+
+
+def replay_csv_block(data_format, lines, block):
+    """ hand off a block of rows, a column at a time for metrics where the config allows it, else a row at a time """
+    if (agent_config_vars['csv_block_columns'] and get_csv_block_rows_match(lines, block) and
+            replay_metric_block(block)):
+        return
+    for row in get_csv_block_rows(lines, block):
+        try:
+            if 'IFEXPORT' in data_format:
+                export_handoff(row.get('timestamp'), row)
+            else:
+                parse_json_message(row)
+        except Exception as e:
+            logger.debug('Error when processing line {}'.format(row))
+            logger.debug(e)
+
+
+def get_csv_block_rows_match(lines, block):
+    """ whether pandas read each line as one row, as splitting the lines with csv_field_delimiter would """
+    # pandas also ends a line at a lone \r
+    return (block is not None and len(block) == len(lines) and
+            block.shape[1] == len(agent_config_vars['csv_field_names']) and
+            sum(line.count('\r') for line in lines) == sum(line.endswith('\r\n') for line in lines))
+
+
+def get_csv_block_rows(lines, block):
+    """ a block's rows as dicts of the fields in each line, as label_message would make them """
+    field_names = agent_config_vars['csv_field_names']
+    if not get_csv_block_rows_match(lines, block):
+        return [label_message(agent_config_vars['csv_field_delimiter'].split(line.strip('\r\n'))) for line in lines]
+    separators = [agent_config_vars['csv_block_separator']]
+    if agent_config_vars['csv_field_delimiter'].pattern == CSV_DELIM:
+        separators.append('\t')
+    rows = []
+    for line, values in itertools.izip(lines, block.values.tolist()):
+        # a short line only has the fields it holds
+        fields = sum(line.count(separator) for separator in separators) + 1
+        rows.append(dict(itertools.izip(field_names[:fields], values)))
+    return rows
+
+
+def replay_metric_block(block):
+    """
+    Hand off a block of metric rows a column at a time: each distinct timestamp, instance and device
+    is parsed once, and each data column is converted to numbers at once. Returns False, having handed
+    nothing off, if a column holds something only the row at a time path handles the same way.
+    """
+    columns = agent_config_vars['csv_block_columns']
+    data_columns = columns['data'] or [field for field in block.columns if field not in
+                                       (columns['timestamp'], columns['instance'], columns['device'])]
+    values = dict()
+    for field in data_columns:
+        if field in block.columns:
+            try:
+                values[field] = block[field].values.astype(float).tolist()
+            except ValueError:
+                return False
+    try:
+        timestamps = get_metric_block_column(block, columns['timestamp'], get_metric_block_timestamp)
+        instances = get_metric_block_column(block, columns['instance'], lambda x: x or HOSTNAME, HOSTNAME)
+        devices = get_metric_block_column(block, columns['device'], lambda x: x, '')
+    except (ListNotAllowedError, TypeError):
+        return False
+    fields = values.keys()
+    field_values = [values[field] for field in fields]
+    for i, timestamp in enumerate(timestamps):
+        if timestamp is not None:
+            metric_row_handoff(timestamp, dict(itertools.izip(fields, [column[i] for column in field_values])),
+                               instances[i], devices[i])
+    return True
+
+
+def get_metric_block_column(block, field, parse, default=None):
+    """ a column's values as the row at a time path reads them, parsing each distinct value once """
+    if not field:
+        return [default] * len(block)
+    parsed = dict()
+    for value in block[field].unique():
+        value_read = get_json_field({field: value}, field)
+        if not isinstance(value_read, basestring):
+            # a list, or an object, would be read differently
+            raise TypeError('{} is not a single value'.format(value))
+        parsed[value] = parse(value_read)
+    return [parsed[value] for value in block[field].values]
+
+
+def get_metric_block_timestamp(date_string):
+    """ parse a timestamp, or None if its row is to be skipped as the row at a time path would """
+    try:
+        return get_timestamp_from_date_string(date_string)
+    except Exception as e:
+        logger.debug('Error when processing timestamp {}'.format(date_string))
+        logger.debug(e)
+        return None
+
+
 def read_xls(_file):
     agent_config_vars['data_format'] = 'CSV' # treat as CSV from here out
     agent_config_vars['timestamp_format'] = ['epoch']
+    import xlrd
     # open workbook
     with xlrd.open_workbook(_file) as wb:
         # for each sheet in the workbook
@@ -131,6 +356,8 @@ def read_xls(_file):
 
 
 def reader_next_line(_format, data, line):
+    if 'TAIL' in _format:
+        advance_checkpoint(len(line))
     # preformatting on each line
     if 'RAW' not in _format:
         try:
@@ -141,14 +368,10 @@ def reader_next_line(_format, data, line):
         line = label_message(agent_config_vars['csv_field_delimiter'].split(line))
     elif 'JSON' in _format:
         line = json.loads(line)
-    if 'TAIL' in _format:
-        pos = data.tell()
-        # write to state
-        update_state('current_file_offset', pos)
     return line
 
 
-def reader(_format, _file, st_ino):
+def reader(_format, _file, st_ino, part=None):
     if _format in {'XLS', 'XLSX'}:
         for line in read_xls(_file):
             yield line
@@ -160,67 +383,322 @@ def reader(_format, _file, st_ino):
                 agent_config_vars['csv_field_names'] = data.readline().strip().split(',')
             # preformatting on all data
             if 'TAIL' in _format:
-                update_state('current_file', json.dumps({st_ino: _file}))
-                data.seek(int(agent_config_vars['state']['current_file_offset'])) # read from state
+                # resume from the checkpoint, past the header if there is one
+                offset = max(get_checkpoint_offset(st_ino, _file), data.tell())
+                data.seek(offset)
+                open_checkpoint_file(st_ino, _file, offset)
             elif _format == 'AVRO':
+                import avro.datafile
+                import avro.io
                 data = avro.datafile.DataFileReader(data, avro.io.DatumReader())
             # read data
             if _format == 'XML':
+                import xml2dict
                 data = xml2dict.parse(data)
                 yield data
+            elif part:
+                logger.debug('reading part {} of {}'.format(*part))
+                for line in read_file_part(data, part):
+                    yield reader_next_line(_format, data, line)
             else:
                 # read each line
                 logger.debug('reading each line')
+                partial = ''
                 for line in data:
+                    if 'TAILF' in _format and not line.endswith('\n'):
+                        # the last line is still being written; finish it while tailing
+                        partial = line
+                        break
                     yield reader_next_line(_format, data, line)
+                if 'TAILF' in _format:
+                    logger.debug('tailing file')
+                    # keep reading file
+                    for line2 in tail_file(_file, data, partial):
+                        yield reader_next_line(_format, data, line2)
                 if 'TAIL' in _format:
-                    if 'TAILF' in _format:
-                        logger.debug('tailing file')
-                        # keep reading file
-                        for line2 in tail_file(_file, data):
-                            yield reader_next_line(_format, data, line2)
-                        # move from current file to completed, reset position
-                        update_state('completed_files_st_ino', st_ino, append=True)
-                        update_state('current_file', '')
-                        update_state('current_file_offset', 0)
-
-
-def tail_file(_file, data):
-    # start at end of file
-    data.seek(0,2)
-    # start reading in new lines
-    while os.path.getmtime(_file) > (get_timestamp_from_datetime(datetime.now())/1000 - if_config_vars['run_interval']):
-        line = ''
-        # build the line while it doesn't end in a newline
-        while not line.endswith(('\r', '\n', '\r\n')):
+                    # tailed files are done with once they stop being written to
+                    close_checkpoint_file(completed='TAILF' in _format)
+
+
+def read_file_part(data, part):
+    """ the lines starting in one of `parts` equal byte ranges of a file, read through mmap. the first part starts
+    wherever data is, after any header; the others start at the first line, or multi-line raw message, in them """
+    index, parts = part
+    size = os.fstat(data.fileno()).st_size
+    if size == 0:
+        return
+    mm = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        start = data.tell() if index == 0 else max(get_file_part_start(mm, size * index // parts), data.tell())
+        end = get_file_part_start(mm, size * (index + 1) // parts) if index + 1 < parts else size
+        mm.seek(start)
+        while mm.tell() < end:
+            yield mm.readline()
+    finally:
+        mm.close()
+
+
+def get_file_part_start(mm, offset):
+    """ where the first line at or after offset starts, or for multi-line raw messages, the first message """
+    newline = mm.find('\n', max(offset - 1, 0))
+    start = newline + 1 if newline != -1 else mm.size()
+    if 'RAW' in agent_config_vars['data_format'] and agent_config_vars['raw_start_regex']:
+        # lines up to the next message belong to the one before the part
+        while start < mm.size():
+            newline = mm.find('\n', start)
+            line_end = newline + 1 if newline != -1 else mm.size()
+            if agent_config_vars['raw_start_regex'].match(mm[start:line_end]):
+                break
+            start = line_end
+    return start
+
+
+def tail_file(_file, data, line=''):
+    """ follow a file as it is written to, until it is rotated away or goes run_interval without a write """
+    st_ino = os.fstat(data.fileno()).st_ino
+    follower = start_file_follower(_file)
+    last_write = os.path.getmtime(_file)
+    rotated = False
+    try:
+        while True:
             tail = data.readline()
-            if not tail:
-                time.sleep(0.1)
+            if tail:
+                last_write = time.time()
+                line += tail
+                # build the line while it doesn't end in a newline
+                if line.endswith('\n'):
+                    yield line
+                    line = ''
+                continue
+            elif rotated:
+                break
+            position = data.tell()
+            if os.fstat(data.fileno()).st_size < position:
+                # copytruncate rotation: the file was copied elsewhere and emptied in place
+                logger.info('{} was truncated, reading it from the start'.format(_file))
+                data.seek(0)
+                rewind_checkpoint()
+                line = ''
                 continue
-            line += tail
+            if is_file_rotated(_file, st_ino):
+                # rename rotation: finish what was written before it, the new file is picked up as any other
+                logger.info('{} was rotated, reading the rest of it'.format(_file))
+                rotated = True
+                continue
+            idle = time.time() - last_write
+            if idle >= if_config_vars['run_interval']:
+                break
+            wait_for_file_change(follower, if_config_vars['run_interval'] - idle)
+            # clear EOF, so the next readline sees anything new
+            data.seek(position)
+    finally:
+        stop_file_follower(follower)
+    if line:
         yield line
 
 
-def update_state(setting, value, append=False):
-    # update in-mem
-    if append:
-        current = ','.join(agent_config_vars['state'][setting])
-        value = '{},{}'.format(current, value) if current else value
-        agent_config_vars['state'][setting] = value.split(',')
-    else:
-        agent_config_vars['state'][setting] = value
-    logger.debug('setting {} to {}'.format(setting, value))
-    # update config file
-    if 'TAIL' in agent_config_vars['data_format']:
-        config_ini = config_ini_path()
-        if os.path.exists(config_ini):
-            config_parser = ConfigParser.SafeConfigParser()
-            config_parser.read(config_ini)
-            config_parser.set('state', setting, str(value))
-            with open(config_ini, 'w') as config_file:
-                config_parser.write(config_file)
-    # return new value (if append)
-    return value
+def is_file_rotated(_file, st_ino):
+    """ whether the path being tailed no longer points to the file open as st_ino """
+    try:
+        return os.stat(_file).st_ino != st_ino
+    except OSError:
+        return True
+
+
+def get_inotify():
+    """ libc, where it has inotify. elsewhere tailed files are polled instead """
+    if 'libc' not in INOTIFY:
+        INOTIFY['libc'] = None
+        if sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+                INOTIFY['libc'] = libc if hasattr(libc, 'inotify_init1') else None
+            except OSError as e:
+                logger.debug('Could not load libc: {}'.format(e))
+        if not INOTIFY['libc']:
+            logger.debug('inotify is not available, polling tailed files every {}s'.format(TAIL_POLL_SECONDS))
+    return INOTIFY['libc']
+
+
+def start_file_follower(_file):
+    """ an inotify descriptor woken when the file is written to, moved or deleted, or its directory gets a new file.
+    None if inotify can't be used, in which case the file is polled """
+    libc = get_inotify()
+    if not libc:
+        return None
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        logger.debug('Could not start inotify, polling {}: {}'.format(_file, os.strerror(ctypes.get_errno())))
+        return None
+    watches = [(_file, IN_MODIFY | IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF),
+               (os.path.dirname(os.path.abspath(_file)), IN_CREATE | IN_MOVED_TO)]
+    for path, mask in watches:
+        if libc.inotify_add_watch(fd, path, mask) < 0:
+            logger.debug('Could not watch {}, polling {}: {}'.format(path, _file, os.strerror(ctypes.get_errno())))
+            os.close(fd)
+            return None
+    return fd
+
+
+def wait_for_file_change(follower, timeout):
+    """ wait up to timeout seconds for the followed file to change """
+    if follower is None:
+        time.sleep(min(TAIL_POLL_SECONDS, timeout))
+        return
+    readable, _, _ = select.select([follower], [], [], timeout)
+    if readable:
+        # the events themselves don't matter, only that something happened
+        try:
+            os.read(follower, 65536)
+        except OSError:
+            pass
+
+
+def stop_file_follower(follower):
+    if follower is not None:
+        os.close(follower)
+
+
+def start_checkpoint(thread_number):
+    """ load where each file was read up to, for TAIL formats """
+    checkpoint.clear()
+    if 'TAIL' not in agent_config_vars['data_format']:
+        return
+    prefix = '.checkpoint-{}-'.format(make_safe_string(if_config_vars['project_name']))
+    checkpoint['path'] = abs_path_from_cur(prefix + str(thread_number))
+    # <st_ino>: {'file', 'offset', 'timestamp' of the last entry sent, 'completed', 'updated'}
+    checkpoint['files'] = dict()
+    # read every worker's checkpoint, as the files may be split between the workers differently than last run
+    paths = [abs_path_from_cur(f) for f in os.listdir(abs_path_from_cur()) if f.startswith(prefix) and
+             not f.endswith('.tmp')]
+    for path in paths:
+        try:
+            with open(path) as checkpoint_file:
+                files = json.load(checkpoint_file)
+        except (IOError, OSError, ValueError) as e:
+            logger.warning('Could not read the checkpoint {}: {}'.format(path, e))
+            continue
+        for st_ino, entry in files.items():
+            if entry['updated'] >= checkpoint['files'].get(st_ino, entry)['updated']:
+                checkpoint['files'][st_ino] = entry
+    if not paths:
+        migrate_checkpoint_state()
+    # position in the file being read, and files read since the last chunk was accepted
+    checkpoint['reading'] = None
+    checkpoint['pending'] = dict()
+    checkpoint['failed'] = False
+    checkpoint['dirty'] = False
+    checkpoint['written'] = time.time()
+
+
+def migrate_checkpoint_state():
+    """ start from the [state] older versions kept in config.ini """
+    state = agent_config_vars['state']
+    if state['current_file']:
+        st_ino, file_name = json.loads(state['current_file']).items()[0]
+        checkpoint['files'][st_ino] = {'file': file_name, 'offset': state['current_file_offset'],
+                                       'timestamp': None, 'completed': False, 'updated': time.time()}
+    for st_ino in filter(lambda x: x, state['completed_files_st_ino']):
+        checkpoint['files'][st_ino] = {'file': '', 'offset': 0,
+                                       'timestamp': None, 'completed': True, 'updated': time.time()}
+
+
+def get_checkpoint_completed_files():
+    """ st_inos of TAILF files that have been fully read and sent """
+    return [st_ino for st_ino, entry in checkpoint.get('files', {}).items() if entry['completed']]
+
+
+def get_checkpoint_offset(st_ino, file_name):
+    """ where to resume reading a file: its checkpointed offset, unless it has been truncated since """
+    entry = checkpoint['files'].get(st_ino)
+    if not entry:
+        return 0
+    if entry['offset'] > os.path.getsize(file_name):
+        logger.warning('{} is smaller than when it was last read, reading it from the start'.format(file_name))
+        return 0
+    return entry['offset']
+
+
+def open_checkpoint_file(st_ino, file_name, offset):
+    checkpoint['reading'] = {'st_ino': st_ino, 'file': file_name, 'offset': offset, 'line_start': offset}
+
+
+def rewind_checkpoint():
+    """ the file being read was truncated, and is being read again from the start """
+    reading = checkpoint['reading']
+    reading['offset'] = 0
+    reading['line_start'] = 0
+
+
+def advance_checkpoint(line_size):
+    """ move past a line. until it has been handed off, the line might be only partly in the current chunk """
+    reading = checkpoint['reading']
+    reading['line_start'] = reading['offset']
+    reading['offset'] += line_size
+
+
+def close_checkpoint_file(completed=False):
+    """ the file being read has been handed off up to its end; it is saved once the chunk holding it is accepted """
+    reading = checkpoint['reading']
+    checkpoint['pending'][reading['st_ino']] = {'file': reading['file'], 'offset': reading['offset'],
+                                                'completed': completed}
+    checkpoint['reading'] = None
+
+
+def commit_checkpoint(chunk):
+    """ after IF accepts a chunk, move the checkpoint up to the lines it held, and save it every so often """
+    if not checkpoint or checkpoint['failed']:
+        return
+    last_entry = chunk[-1] if chunk else {}
+    timestamp = last_entry.get('timestamp', last_entry.get('eventId'))
+    held = get_held_offsets()
+    files = []
+    for st_ino, entry in checkpoint['pending'].items():
+        if held.get(st_ino, entry['offset']) < entry['offset']:
+            # some of its samples are still being aggregated; commit up to them now, and the rest once they are sent
+            files.append((st_ino, dict(entry, offset=held[st_ino], completed=False)))
+        else:
+            files.append((st_ino, entry))
+            del checkpoint['pending'][st_ino]
+    reading = checkpoint['reading']
+    if reading:
+        offset = min(reading['line_start'], held.get(reading['st_ino'], reading['line_start']))
+        files.append((reading['st_ino'], {'file': reading['file'], 'offset': offset, 'completed': False}))
+    for st_ino, entry in files:
+        entry['timestamp'] = timestamp or checkpoint['files'].get(st_ino, {}).get('timestamp')
+        entry['updated'] = time.time()
+        checkpoint['files'][st_ino] = entry
+    checkpoint['dirty'] = True
+    if time.time() - checkpoint['written'] >= CHECKPOINT_INTERVAL_SECONDS:
+        write_checkpoint()
+
+
+def fail_checkpoint():
+    """ stop moving the checkpoint, so that an undelivered chunk is read again on the next run """
+    if checkpoint and not checkpoint['failed']:
+        logger.warning('A chunk was not delivered; the checkpoint will stay before it so it is read again')
+        checkpoint['failed'] = True
+
+
+def write_checkpoint():
+    """ atomically rewrite this worker's checkpoint file """
+    checkpoint['written'] = time.time()
+    if not checkpoint['dirty'] or cli_config_vars['testing']:
+        return
+    try:
+        with open(checkpoint['path'] + '.tmp', 'w') as checkpoint_file:
+            json.dump(checkpoint['files'], checkpoint_file)
+        os.rename(checkpoint['path'] + '.tmp', checkpoint['path'])
+        checkpoint['dirty'] = False
+    except (IOError, OSError) as e:
+        logger.warning('Could not save the checkpoint to {}: {}'.format(checkpoint['path'], e))
+
+
+def stop_checkpoint():
+    """ everything read has been sent by now, so save the checkpoint up to it """
+    if checkpoint:
+        commit_checkpoint([])
+        write_checkpoint()
 
 
 def get_agent_config_vars():
@@ -239,6 +717,9 @@ def get_agent_config_vars():
             # files
             file_path = config_parser.get('agent', 'file_path')
             file_name_regex = config_parser.get('agent', 'file_name_regex')
+            replay_order = get_optional_config(config_parser, 'agent', 'replay_order').lower()
+            split_file_mb = get_optional_config(config_parser, 'agent', 'split_file_mb')
+            csv_block_rows = get_optional_config(config_parser, 'agent', 'csv_block_rows')
 
             # filters
             filters_include = config_parser.get('agent', 'filters_include')
@@ -259,6 +740,9 @@ def get_agent_config_vars():
             timezone = config_parser.get('agent', 'timezone') or 'UTC'
             data_fields = config_parser.get('agent', 'data_fields', raw=True)
 
+            # metric aggregation
+            metric_aggregates = get_optional_config(config_parser, 'agent', 'metric_aggregates')
+
         except ConfigParser.NoOptionError as cp_noe:
             logger.error(cp_noe)
             config_error()
@@ -266,6 +750,7 @@ def get_agent_config_vars():
         # data format
         if data_format in {'CSV',
                            'CSVTAIL',
+                           'CSVTAILF',
                            'XLS',
                            'XLSX'}:
             # field names
@@ -281,6 +766,7 @@ def get_agent_config_vars():
                 config_error('csv_field_delimiter')
         elif data_format in {'JSON',
                              'JSONTAIL',
+                             'JSONTAILF',
                              'AVRO',
                              'XML'}:
             pass
@@ -291,7 +777,8 @@ def get_agent_config_vars():
             instance_field = ''
             device_field = ''
         elif data_format in {'RAW',
-                             'RAWTAIL'}:
+                             'RAWTAIL',
+                             'RAWTAILF'}:
             try:
                 raw_regex = regex.compile(raw_regex)
             except Exception as e:
@@ -321,6 +808,14 @@ def get_agent_config_vars():
             filters_include = filters_include.split('|')
         if len(filters_exclude) != 0:
             filters_exclude = filters_exclude.split('|')
+        try:
+            FILTERS['include'] = compile_filters(filters_include)
+        except IndexError:
+            config_error('filters_include')
+        try:
+            FILTERS['exclude'] = compile_filters(filters_exclude)
+        except IndexError:
+            config_error('filters_exclude')
 
         # fields
         # project_fields = project_field.split(',')
@@ -342,6 +837,74 @@ def get_agent_config_vars():
                 if timestamp_field in data_fields:
                     data_fields.pop(data_fields.index(timestamp_field))
 
+        # compile field paths once, rather than splitting them for every message
+        compile_json_fields(instance_fields + device_fields + timestamp_fields + [json_top_level])
+        if len(data_fields) != 0:
+            compile_json_fields(data_fields)
+            try:
+                compile_math_exprs(data_fields)
+            except ValueError as e:
+                logger.error(e)
+                config_error('data_fields')
+
+        # replay order
+        if replay_order not in {'', 'file', 'timestamp'} or (replay_order == 'timestamp' and 'TAIL' in data_format):
+            config_error('replay_order')
+
+        # file splitting, for the formats read a line at a time from the start
+        try:
+            split_file_bytes = int(float(split_file_mb or '0') * 1024 * 1024)
+        except ValueError:
+            config_error('split_file_mb')
+        if split_file_bytes < 0 or (split_file_bytes and data_format not in {'CSV', 'JSON', 'RAW', 'IFEXPORT'}):
+            config_error('split_file_mb')
+
+        # metric aggregation
+        try:
+            metric_aggregates = parse_metric_aggregates(
+                filter(lambda x: x, [aggregate.strip().lower() for aggregate in metric_aggregates.split(',')]))
+        except ValueError as e:
+            logger.error(e)
+            config_error('metric_aggregates')
+        if metric_aggregates and cli_config_vars['threads'] > 1 and replay_order != 'timestamp':
+            logger.warning('With --threads, each worker sends its own aggregates of the samples it reads; '
+                           'set replay_order = timestamp to aggregate all of them in one process')
+
+        # csv blocks
+        try:
+            csv_block_rows = int(csv_block_rows or '0')
+        except ValueError:
+            config_error('csv_block_rows')
+        csv_block_separator = ''
+        csv_block_columns = None
+        if csv_block_rows:
+            if csv_block_rows < 0 or data_format not in {'CSV', 'IFEXPORT'}:
+                config_error('csv_block_rows')
+            # pandas isn't in requirements.txt, as only csv_block_rows needs it
+            try:
+                import pandas
+            except ImportError:
+                logger.error('csv_block_rows needs pandas, which is not installed')
+                config_error('csv_block_rows')
+            csv_block_separator = get_csv_block_separator(csv_field_delimiter.pattern)
+            if not csv_block_separator:
+                logger.error('csv_block_rows needs csv_field_delimiter to be a single character')
+                config_error('csv_block_rows')
+            # plain columns of metrics can be read a column at a time
+            plain_fields = timestamp_fields + instance_fields + device_fields + (data_fields or [])
+            if data_format == 'CSV' and 'METRIC' in if_config_vars['project_type'] and \
+                    not (filters_include or filters_exclude or json_top_level or metric_aggregates) and \
+                    len(timestamp_fields) == 1 and len(instance_fields) == 1 and len(device_fields) == 1 and \
+                    timestamp_fields[0] in csv_field_names and \
+                    not any(is_formatted(field) or is_named_data_field(field) or JSON_LEVEL_DELIM in field
+                            for field in plain_fields):
+                csv_block_columns = {
+                    'timestamp': timestamp_fields[0],
+                    'instance': instance_fields[0] if instance_fields[0] in csv_field_names else '',
+                    'device': device_fields[0] if device_fields[0] in csv_field_names else '',
+                    'data': list(data_fields or [])
+                }
+
         # timestamp
         timestamp_format = timestamp_format.partition('.')[0]
         if '%z' in timestamp_format or '%Z' in timestamp_format:
@@ -368,6 +931,11 @@ def get_agent_config_vars():
                 },
             'file_path': file_path,
             'file_name_regex': file_name_regex,
+            'replay_order': replay_order,
+            'split_file_bytes': split_file_bytes,
+            'csv_block_rows': csv_block_rows,
+            'csv_block_separator': csv_block_separator,
+            'csv_block_columns': csv_block_columns,
             'filters_include': filters_include,
             'filters_exclude': filters_exclude,
             'data_format': data_format,
@@ -380,6 +948,7 @@ def get_agent_config_vars():
             'instance_field': instance_fields,
             'device_field': device_fields,
             'data_fields': data_fields,
+            'metric_aggregates': metric_aggregates,
             'timestamp_field': timestamp_fields,
             'timezone': timezone,
             'timestamp_format': ts_format_info['timestamp_format'],
@@ -504,11 +1073,8 @@ def get_cli_config_vars():
     """ get CLI options. use of these options should be rare """
     usage = 'Usage: %prog [options]'
     parser = OptionParser(usage=usage)
-    """
-    ## not ready.
     parser.add_option('--threads', default=1, action='store', dest='threads',
-                      help='Number of threads to run')
-    """
+                      help='Number of worker processes to run, each handling its own share of the input')
     parser.add_option('-c', '--config', action='store', dest='config', default=abs_path_from_cur('config.ini'),
                       help='Path to the config file to use. Defaults to {}'.format(abs_path_from_cur('config.ini')))
     parser.add_option('-q', '--quiet', action='store_true', dest='quiet', default=False,
@@ -520,17 +1086,14 @@ def get_cli_config_vars():
                            ' Automatically turns on verbose logging')
     (options, args) = parser.parse_args()
 
-    """
-    # not ready
     try:
-        threads = int(options.threads)
+        threads = max(1, int(options.threads))
     except ValueError:
         threads = 1
-    """
 
     config_vars = {
         'config': options.config if os.path.isfile(options.config) else abs_path_from_cur('config.ini'),
-        'threads': 1,
+        'threads': threads,
         'testing': False,
         'log_level': logging.INFO
         }
@@ -546,6 +1109,13 @@ def get_cli_config_vars():
     return config_vars
 
 
+def get_optional_config(config_parser, section, option, raw=False):
+    """ read an option that config.ini files from older versions may not have, as blank so its default applies """
+    if config_parser.has_option(section, option):
+        return config_parser.get(section, option, raw=raw)
+    return ''
+
+
 def config_error(setting=''):
     info = ' ({})'.format(setting) if setting else ''
     logger.error('Agent not correctly configured{}. Check config file.'.format(
@@ -558,6 +1128,19 @@ def config_error_no_config():
     sys.exit(1)
 
 
+def get_csv_block_separator(pattern):
+    """ the single character a csv_field_delimiter pattern splits on, if it does. the default's tabs are read as commas """
+    if pattern == CSV_DELIM:
+        return ','
+    elif pattern == r'\t':
+        return '\t'
+    elif len(pattern) == 1 and pattern not in '.^$*+?{}[]\\|()':
+        return pattern
+    elif len(pattern) == 2 and pattern[0] == '\\' and not pattern[1].isalnum():
+        return pattern[1]
+    return ''
+
+
 def strip_tz_info(timestamp_format):
     # strptime() doesn't allow timezone info
     if '%Z' in timestamp_format:
@@ -703,6 +1286,67 @@ def get_field_index(field_names, field, label, is_required=False):
             return field
 
 
+def compile_filters(filters):
+    """ compile field:value,value filters into one matcher per field, in the order fields first appear """
+    matchers = OrderedDict()
+    for _filter in filters:
+        filter_field = _filter.split(':')[0]
+        filter_vals = _filter.split(':')[1].split(',')
+        matcher = matchers.setdefault(filter_field, {'field': filter_field, 'values': []})
+        for filter_val in filter_vals:
+            if filter_val.upper() not in matcher['values']:
+                matcher['values'].append(filter_val.upper())
+    for matcher in matchers.values():
+        # values are matched as case-insensitive substrings; an exact match is just the cheapest case
+        matcher['exact'] = set(matcher['values'])
+        matcher['any'] = regex.compile(r'\L<values>', values=matcher['values'])
+    return matchers.values()
+
+
+def get_filter_hit(matcher, filter_check):
+    """ a matcher's value that is in filter_check, or None """
+    filter_check = filter_check.upper()
+    if filter_check in matcher['exact']:
+        return filter_check
+    match = matcher['any'].search(filter_check)
+    if match is None:
+        return None
+    return match.group()
+
+
+def is_filtered(get_filter_check):
+    """ whether the filters drop a message. get_filter_check gets a field """
+    if FILTERS['include']:
+        # for each provided filter field, check if there are any allowed values
+        is_valid = False
+        filter_check = None
+        for matcher in FILTERS['include']:
+            filter_check = get_filter_check(matcher['field'])
+            # check if a valid value
+            if get_filter_hit(matcher, filter_check) is not None:
+                is_valid = True
+                break
+        if not is_valid:
+            logger.debug('filtered message (inclusion): {} not in {}'.format(
+                filter_check, matcher['values']))
+            return True
+        else:
+            logger.debug('passed filter (inclusion)')
+
+    if FILTERS['exclude']:
+        # for each provided filter field, check if there are any disallowed values
+        for matcher in FILTERS['exclude']:
+            filter_check = get_filter_check(matcher['field'])
+            # check if a valid value
+            filter_val = get_filter_hit(matcher, filter_check)
+            if filter_val is not None:
+                logger.debug('filtered message (exclusion): {} in {}'.format(
+                    filter_val, filter_check))
+                return True
+        logger.debug('passed filter (exclusion)')
+    return False
+
+
 def should_include_per_config(setting, value):
     """ determine if an agent config filter setting would exclude a given value """
     return len(agent_config_vars[setting]) != 0 and value not in agent_config_vars[setting]
@@ -718,6 +1362,15 @@ def get_json_size_bytes(json_data):
     return len(bytearray(json.dumps(json_data)))
 
 
+def append_to_current_row(entry):
+    """ add an entry to the current chunk, keeping a running total of its serialized size """
+    if len(track['current_row']) != 0:
+        # json.dumps separates list items with ', '
+        track['current_row_size'] += 2
+    track['current_row'].append(entry)
+    track['current_row_size'] += get_json_size_bytes(entry)
+
+
 def get_all_files(files, file_regex_c):
     return [ i for j in
                 map(lambda k:
@@ -786,6 +1439,15 @@ def is_named_data_field(setting_value):
     return ':' in setting_value
 
 
+def compile_math_exprs(setting_values):
+    """ compile the evaluators for the arithmetic expressions in a list of data fields """
+    for setting_value in setting_values:
+        if is_named_data_field(setting_value):
+            value = setting_value.split(':')[1]
+            if is_math_expr(value):
+                get_math_expr_evaluator(get_math_expr(value))
+
+
 def merge_data(field, value, data={}):
     fields = field.split(JSON_LEVEL_DELIM)
     for i in range(len(fields) - 1):
@@ -837,17 +1499,13 @@ def get_data_value(message, setting_value):
         # get value
         value = setting_value[1]
         # check if math
-        evaluate = False
         if is_math_expr(value):
-            evaluate = True
-            value = get_math_expr(value)
-        if is_formatted(value):
+            value = evaluate_math_expr(message, get_math_expr(value))
+        elif is_formatted(value):
             value = parse_formatted(message,
                                     value,
                                     default=value,
                                     allow_list=True)
-        if evaluate:
-            value = eval(value)
     else:
         name = setting_value
         value = get_json_field(message,
@@ -856,6 +1514,134 @@ def get_data_value(message, setting_value):
     return (name, value)
 
 
+def parse_math_number(value):
+    """ parse a field value or literal as an int or float; returns None if it is not a number """
+    if isinstance(value, (int, long, float)):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+
+def get_math_expr_evaluator(expr):
+    """ get the compiled evaluator for an arithmetic expression, compiling it on first use """
+    evaluate = MATH_EXPRS.get(expr)
+    if evaluate is None:
+        evaluate = compile_math_expr(expr)
+        MATH_EXPRS[expr] = evaluate
+    return evaluate
+
+
+def evaluate_math_expr(message, expr, default=''):
+    """ evaluate an arithmetic expression against a message """
+    try:
+        return get_math_expr_evaluator(expr)(message)
+    except (ValueError, ArithmeticError) as e:
+        logger.debug('cannot evaluate {}: {}'.format(expr, e))
+        return default
+
+
+def compile_math_expr(expr):
+    """
+    Compile an arithmetic expression into a function of the message.
+    Supports {field} references, numeric literals, + - * /, parentheses,
+    and the functions in MATH_EXPR_FUNCTIONS. Raises ValueError on anything else.
+    """
+    tokens = MATH_EXPR_TOKENS.findall(expr)
+    evaluate, pos = _compile_math_sum(tokens, 0, expr)
+    if pos != len(tokens):
+        raise _math_expr_error(tokens, pos, expr)
+    return evaluate
+
+
+def _get_math_token(tokens, pos):
+    return tokens[pos] if pos < len(tokens) else ('', '', '', '')
+
+
+def _math_expr_error(tokens, pos, expr):
+    token = ''.join(_get_math_token(tokens, pos)) or 'end of expression'
+    return ValueError('unexpected {} in expression {}'.format(token, expr))
+
+
+def _compile_math_sum(tokens, pos, expr):
+    left, pos = _compile_math_product(tokens, pos, expr)
+    while _get_math_token(tokens, pos)[3] in ('+', '-'):
+        right, next_pos = _compile_math_product(tokens, pos + 1, expr)
+        left = _bind_math_op(MATH_EXPR_OPS[tokens[pos][3]], left, right)
+        pos = next_pos
+    return left, pos
+
+
+def _compile_math_product(tokens, pos, expr):
+    left, pos = _compile_math_factor(tokens, pos, expr)
+    while _get_math_token(tokens, pos)[3] in ('*', '/'):
+        right, next_pos = _compile_math_factor(tokens, pos + 1, expr)
+        left = _bind_math_op(MATH_EXPR_OPS[tokens[pos][3]], left, right)
+        pos = next_pos
+    return left, pos
+
+
+def _compile_math_factor(tokens, pos, expr):
+    field, number, name, op = _get_math_token(tokens, pos)
+    if op in ('+', '-'):
+        operand, pos = _compile_math_factor(tokens, pos + 1, expr)
+        return (_bind_math_func(operator.neg, [operand]) if op == '-' else operand), pos
+    elif field:
+        return _bind_math_field(field[1:-1]), pos + 1
+    elif number:
+        value = parse_math_number(number)
+        return (lambda message: value), pos + 1
+    elif name in MATH_EXPR_FUNCTIONS:
+        func, min_args, max_args = MATH_EXPR_FUNCTIONS[name]
+        if _get_math_token(tokens, pos + 1)[3] != '(':
+            raise _math_expr_error(tokens, pos + 1, expr)
+        args = []
+        pos += 2
+        while True:
+            arg, pos = _compile_math_sum(tokens, pos, expr)
+            args.append(arg)
+            if _get_math_token(tokens, pos)[3] != ',':
+                break
+            pos += 1
+        if _get_math_token(tokens, pos)[3] != ')':
+            raise _math_expr_error(tokens, pos, expr)
+        if not min_args <= len(args) <= max_args:
+            raise ValueError('{} takes {} to {} arguments in expression {}'.format(name, min_args, max_args, expr))
+        return _bind_math_func(func, args), pos + 1
+    elif op == '(':
+        inner, pos = _compile_math_sum(tokens, pos + 1, expr)
+        if _get_math_token(tokens, pos)[3] != ')':
+            raise _math_expr_error(tokens, pos, expr)
+        return inner, pos + 1
+    raise _math_expr_error(tokens, pos, expr)
+
+
+def _bind_math_op(op, left, right):
+    return lambda message: op(left(message), right(message))
+
+
+def _bind_math_func(func, args):
+    return lambda message: func(*[arg(message) for arg in args])
+
+
+def _bind_math_field(field):
+    getter = get_json_field_getter(field)
+
+    def evaluate(message):
+        # same stringified value a format string would see; missing fields count as 0
+        value = json_format_field_value(getter(message, allow_list=False))
+        value = parse_math_number(value) if len(value) != 0 else 0
+        if value is None:
+            raise ValueError('{} is not a number'.format(field))
+        return value
+
+    return evaluate
+
+
 def get_single_value(message, config_setting, default='', allow_list=False, remove=False):
     if config_setting not in agent_config_vars or len(agent_config_vars[config_setting]) == 0:
         return default
@@ -892,63 +1678,89 @@ def get_json_field_by_pri(message, pri_list, default='', allow_list=False, remov
 
 def get_json_field(message, setting_value, default='', allow_list=False, remove=False):
     field_val = json_format_field_value(
-                    _get_json_field_helper(
-                        message,
-                        setting_value.split(JSON_LEVEL_DELIM),
-                        allow_list=allow_list,
-                        remove=remove))
+        get_json_field_getter(setting_value)(
+            message,
+            allow_list=allow_list,
+            remove=remove))
     if len(field_val) == 0:
         field_val = default
     return field_val
 
 
-class ListNotAllowedError():
+def get_json_field_getter(setting_value):
+    """ get the compiled getter for a field path, compiling it on first use """
+    getter = JSON_FIELD_GETTERS.get(setting_value)
+    if getter is None:
+        getter = compile_json_field(setting_value)
+        JSON_FIELD_GETTERS[setting_value] = getter
+    return getter
+
+
+def compile_json_fields(setting_values):
+    """ compile the getters for a list of configured field paths """
+    for setting_value in setting_values:
+        if setting_value and not (is_formatted(setting_value) or is_named_data_field(setting_value)):
+            get_json_field_getter(setting_value)
+
+
+def compile_json_field(setting_value):
+    """
+    Compile a JSON_LEVEL_DELIM-delimited field path into a reusable getter.
+    The getter walks the message in place, without copying it.
+    """
+    fields = tuple(setting_value.split(JSON_LEVEL_DELIM))
+
+    def getter(message, allow_list=False, remove=False):
+        return _get_json_field_helper(message, fields, 0, allow_list=allow_list, remove=remove)
+
+    return getter
+
+
+class ListNotAllowedError(Exception):
     pass
 
 
-def _get_json_field_helper(nested_value, next_fields, allow_list=False, remove=False):
-    # check inputs; need a dict that is a subtree, an _array_ of fields to traverse down
-    if len(next_fields) == 0:
+def _get_json_field_helper(nested_value, fields, index, allow_list=False, remove=False, in_message=True):
+    # check inputs; need a dict that is a subtree, and a tuple of fields to traverse down
+    if index == len(fields):
         # nothing to look for
         return ''
     elif isinstance(nested_value, (list, set, tuple)):
         # for each elem in the list
         # already checked in the recursive call that this is OK
-        return json_gather_list_values(nested_value, next_fields)
+        return json_gather_list_values(nested_value, fields, index)
     elif not isinstance(nested_value, dict):
         # nothing to walk down
         return ''
 
     # get the next value
-    next_field = next_fields.pop(0)
-    next_value = json.loads(json.dumps(nested_value.get(next_field)))
-    if len(next_fields) == 0 and remove:
+    next_field = fields[index]
+    index += 1
+    next_value = nested_value.get(next_field)
+
+    # only fields that hang directly off the message are removed
+    if index == len(fields) and remove and in_message:
         # last field to grab, so remove it
-        nested_value.pop(next_field)
+        nested_value.pop(next_field, None)
 
     # check the next value
-    if next_value is None:
+    if next_value is None or (isinstance(next_value, basestring) and len(next_value) == 0):
         # no next value defined
         return ''
-    elif len(bytes(next_value)) == 0:
-        # no next value set
-        return ''
 
     # sometimes payloads come in formatted
-    try:
-        next_value = json.loads(next_value)
-    except Exception as ex:
-        next_value = json.loads(json.dumps(next_value))
+    if isinstance(next_value, basestring):
+        try:
+            next_value = json.loads(next_value)
+        except ValueError:
+            pass
 
     # handle simple lists
     while isinstance(next_value, (list, set, tuple)) and len(next_value) == 1:
-        next_value = next_value.pop()
+        next_value = next(iter(next_value))
 
     # continue traversing?
-    if next_fields is None:
-        # some error, but return the value
-        return next_value
-    elif len(next_fields) == 0:
+    if index == len(fields):
         # final value in the list to walk down
         return next_value
     elif isinstance(next_value, (list, set, tuple)):
@@ -956,33 +1768,38 @@ def _get_json_field_helper(nested_value, next_fields, allow_list=False, remove=F
         if allow_list:
             return json_gather_list_values(
                 next_value,
-                next_fields,
+                fields,
+                index,
                 remove=remove)
         else:
             raise ListNotAllowedError('encountered list or set in json when not allowed')
     elif isinstance(next_value, dict):
         # there's more tree to walk down
         return _get_json_field_helper(
-                json.loads(json.dumps(next_value)),
-                next_fields,
-                allow_list=allow_list,
-                remove=remove)
+            next_value,
+            fields,
+            index,
+            allow_list=allow_list,
+            remove=remove,
+            in_message=False)
     else:
         # catch-all
         return ''
 
 
-def json_gather_list_values(l, fields, remove=False):
+def json_gather_list_values(values, fields, index, remove=False):
     sub_field_value = []
     # treat each item in the list as a potential tree to walk down
-    for sub_value in l:
-        fields_copy = list(fields[i] for i in range(len(fields)))
+    # the items are only read, as removing fields from them would change the caller's message
+    for sub_value in values:
         json_value = json_format_field_value(
-                _get_json_field_helper(
-                    sub_value,
-                    fields_copy,
-                    allow_list=True,
-                    remove=remove))
+            _get_json_field_helper(
+                sub_value,
+                fields,
+                index,
+                allow_list=True,
+                remove=remove,
+                in_message=False))
         if len(json_value) != 0:
             sub_field_value.append(json_value)
     # return the full list of field values
@@ -1008,10 +1825,9 @@ def parse_json_message(messages):
             for message in messages:
                 parse_json_message_single(message)
         else:
-            top_level = _get_json_field_helper(
-                    messages,
-                    agent_config_vars['json_top_level'].split(JSON_LEVEL_DELIM),
-                    allow_list=True)
+            top_level = get_json_field_getter(agent_config_vars['json_top_level'])(
+                messages,
+                allow_list=True)
             if isinstance(top_level, (list, set, tuple)):
                 for message in top_level:
                     parse_json_message_single(message)
@@ -1025,48 +1841,9 @@ def parse_json_message(messages):
 
 
 def parse_json_message_single(message):
-    message = json.loads(json.dumps(message))
     # filter
-    if len(agent_config_vars['filters_include']) != 0:
-        # for each provided filter
-        is_valid = False
-        for _filter in agent_config_vars['filters_include']:
-            filter_field = _filter.split(':')[0]
-            filter_vals = _filter.split(':')[1].split(',')
-            filter_check = get_json_field(
-                message,
-                filter_field,
-                allow_list=True)
-            # check if a valid value
-            for filter_val in filter_vals:
-                if filter_val.upper() in filter_check.upper():
-                    is_valid = True
-                    break
-            if is_valid:
-                break
-        if not is_valid:
-            logger.debug('filtered message (inclusion): {} not in {}'.format(
-                filter_check, filter_vals))
-            return
-        else:
-            logger.debug('passed filter (inclusion)')
-
-    if len(agent_config_vars['filters_exclude']) != 0:
-        # for each provided filter
-        for _filter in agent_config_vars['filters_exclude']:
-            filter_field = _filter.split(':')[0]
-            filter_vals = _filter.split(':')[1].split(',')
-            filter_check = get_json_field(
-                message,
-                filter_field,
-                allow_list=True)
-            # check if a valid value
-            for filter_val in filter_vals:
-                if filter_val.upper() in filter_check.upper():
-                    logger.debug('filtered message (exclusion): {} in {}'.format(
-                        filter_val, filter_check))
-                    return
-        logger.debug('passed filter (exclusion)')
+    if is_filtered(lambda field: get_json_field(message, field, allow_list=True)):
+        return
 
     # get project, instance, & device
     # check_project(get_single_value(message,
@@ -1117,7 +1894,7 @@ def parse_json_message_single(message):
 
 def label_message(message, fields=[]):
     """ turns unlabeled, split data into labeled data """
-    if agent_config_vars['data_format'] in {'CSV', 'CSVTAIL', 'IFEXPORT'}:
+    if agent_config_vars['data_format'] in {'CSV', 'CSVTAIL', 'CSVTAILF', 'IFEXPORT'}:
         fields = agent_config_vars['csv_field_names']
     json = dict()
     for i in range(minlen(fields, message)):
@@ -1131,40 +1908,8 @@ def minlen(one, two):
 
 def parse_csv_message(message):
     # filter
-    if len(agent_config_vars['filters_include']) != 0:
-        # for each provided filter, check if there are any allowed valued
-        is_valid = False
-        for _filter in agent_config_vars['filters_include']:
-            filter_field = _filter.split(':')[0]
-            filter_vals = _filter.split(':')[1].split(',')
-            filter_check = message[int(filter_field)]
-            # check if a valid value
-            for filter_val in filter_vals:
-                if filter_val.upper() in filter_check.upper():
-                    is_valid = True
-                    break
-            if is_valid:
-                break
-        if not is_valid:
-            logger.debug('filtered message (inclusion): {} not in {}'.format(
-                filter_check, filter_vals))
-            return
-        else:
-            logger.debug('passed filter (inclusion)')
-
-    if len(agent_config_vars['filters_exclude']) != 0:
-        # for each provided filter, check if there are any disallowed values
-        for _filter in agent_config_vars['filters_exclude']:
-            filter_field = _filter.split(':')[0]
-            filter_vals = _filter.split(':')[1].split(',')
-            filter_check = message[int(filter_field)]
-            # check if a valid value
-            for filter_val in filter_vals:
-                if filter_val.upper() in filter_check.upper():
-                    logger.debug('filtered message (exclusion): {} in {}'.format(
-                        filter_check, filter_val))
-                    return
-        logger.debug('passed filter (exclusion)')
+    if is_filtered(lambda field: message[int(field)]):
+        return
 
     # project
     # if isinstance(agent_config_vars['project_field'], int):
@@ -1226,19 +1971,20 @@ def get_datetime_from_date_string(date_string):
     if 'strip_tz' in agent_config_vars and agent_config_vars['strip_tz']:
         date_string = ''.join(agent_config_vars['strip_tz_fmt'].split(date_string))
     if 'timestamp_format' in agent_config_vars:
-        for timestamp_format in agent_config_vars['timestamp_format']:
+        timestamp_formats = agent_config_vars['timestamp_format']
+        for i, timestamp_format in enumerate(timestamp_formats):
             try:
-                if timestamp_format == 'epoch':
-                    timestamp_datetime = get_datetime_from_unix_epoch(date_string)
-                else:
-                    timestamp_datetime = datetime.strptime(date_string,
-                                                           timestamp_format)
-                break
+                timestamp_datetime = get_datetime_parser(timestamp_format)(date_string)
             except Exception as e:
                 logger.info('timestamp {} does not match {}'.format(
                     date_string,
                     timestamp_format))
                 continue
+            if i != 0 and timestamp_format != 'epoch':
+                # pin the matching format so it is tried first from now on.
+                # epoch is left in place, as it exits on anything that isn't a number
+                timestamp_formats.insert(0, timestamp_formats.pop(i))
+            break
     else:
         try:
             timestamp_datetime = dateutil.parse.parse(date_string)
@@ -1249,13 +1995,81 @@ def get_datetime_from_date_string(date_string):
     return timestamp_datetime
 
 
-def get_timestamp_from_datetime(timestamp_datetime):
-    timestamp_localize = agent_config_vars['timezone'].localize(timestamp_datetime)
+def get_datetime_parser(timestamp_format):
+    """ get the (memoized) parser for a strptime format """
+    parser = DATETIME_PARSERS.get(timestamp_format)
+    if parser is None:
+        parser = compile_datetime_parser(timestamp_format)
+        DATETIME_PARSERS[timestamp_format] = parser
+    return parser
+
+
+def compile_datetime_parser(timestamp_format):
+    """ returns a function that parses a date string in the given format into a datetime """
+    if timestamp_format == 'epoch':
+        return get_datetime_from_unix_epoch
+
+    # formats made only of numeric fields are matched with a regex instead of strptime.
+    # layout is the exact, fixed-width form; lenient accepts at least everything strptime would
+    layout = ''
+    lenient = ''
+    fields = []
+    for i, part in enumerate(STRPTIME_DIRECTIVES.split(timestamp_format)):
+        if i % 2 == 0:
+            layout += regex.escape(part)
+            lenient += r'\s+'.join(regex.escape(literal) for literal in SPACES.split(part))
+        elif part in STRPTIME_FIXED_WIDTHS and part not in fields:
+            layout += r'(\d{{{}}})'.format(STRPTIME_FIXED_WIDTHS[part])
+            lenient += r'\d{4}' if part == '%Y' else r'(?:\d{1,2}| \d)'
+            fields.append(part)
+        else:
+            return lambda date_string: datetime.strptime(date_string, timestamp_format)
+    layout_c = regex.compile('^' + layout + '$')
+    lenient_c = regex.compile('^' + lenient + '$', regex.IGNORECASE)
+    positions = [fields.index(field) if field in fields else None for field in ('%Y', '%m', '%d', '%H', '%M', '%S')]
+    defaults = (1900, 1, 1, 0, 0, 0)
+
+    def parse_fixed_layout(date_string):
+        match = layout_c.match(date_string)
+        if not match:
+            if not lenient_c.match(date_string):
+                raise ValueError('{} does not match {}'.format(date_string, timestamp_format))
+            # strptime is more lenient (whitespace, case, single digits)
+            return datetime.strptime(date_string, timestamp_format)
+        values = match.groups()
+        return datetime(*[default if position is None else int(values[position])
+                          for position, default in zip(positions, defaults)])
+
+    return parse_fixed_layout
 
-    epoch = long((timestamp_localize - datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds()) * 1000
+
+def get_timestamp_from_datetime(timestamp_datetime):
+    if timestamp_datetime.tzinfo is not None:
+        # as localize() would
+        raise ValueError('Not naive datetime (tzinfo is already set)')
+    seconds = calendar.timegm(timestamp_datetime.timetuple()) - get_utc_offset_seconds(timestamp_datetime)
+    if timestamp_datetime.microsecond:
+        seconds += timestamp_datetime.microsecond / 1000000.0
+    epoch = long(seconds) * 1000
     return epoch
 
 
+def get_utc_offset_seconds(timestamp_datetime):
+    """ seconds east of UTC for a local time in the configured timezone, cached per local hour """
+    key = (timestamp_datetime.year, timestamp_datetime.month, timestamp_datetime.day, timestamp_datetime.hour)
+    offset = UTC_OFFSETS.get(key)
+    if offset is None:
+        timezone = agent_config_vars['timezone']
+        hour_start = datetime(*key)
+        offset = timezone.localize(hour_start).utcoffset()
+        if offset != timezone.localize(hour_start.replace(minute=59, second=59, microsecond=999999)).utcoffset():
+            # the offset changes within this hour, so look up this exact time
+            return int(timezone.localize(timestamp_datetime).utcoffset().total_seconds())
+        offset = int(offset.total_seconds())
+        UTC_OFFSETS[key] = offset
+    return offset
+
+
 def get_datetime_from_unix_epoch(date_string):
     try:
         # strip leading whitespace and zeros
@@ -1386,21 +2200,89 @@ def print_summary_info():
     logger.debug(cli_data_block)
 
 
-def initialize_data_gathering(thread_number):
+def is_in_worker_partition(key, thread_number):
+    """ whether a stable key (file inode, pod name, database, ...) belongs to this worker """
+    return zlib.crc32(str(key)) % cli_config_vars['threads'] == thread_number
+
+
+def get_worker_partition(items, thread_number):
+    """ this worker's share of a fixed, ordered list (kafka partitions, ...) """
+    return items[thread_number::cli_config_vars['threads']]
+
+
+def get_worker_counters():
+    counters = dict()
+    for counter in WORKER_COUNTERS:
+        counters[counter] = track.get(counter, 0)
+    return counters
+
+
+def import_deferred_modules():
+    """
+    Import the deferred modules this data format will use before the workers fork,
+    so they are imported once rather than once per worker.
+    """
+    modules = list(DEFERRED_MODULES.get(agent_config_vars['data_format'], []))
+    if agent_config_vars['csv_block_rows']:
+        modules.append('pandas')
+    if 'METRIC' in if_config_vars['project_type']:
+        modules.append('statistics')
+    if not cli_config_vars['testing']:
+        modules.append('requests')
+    for module in modules:
+        __import__(module)
+
+
+def merge_worker_counters(counter_queue, process_list):
+    """ sum the counters each worker reports at exit, then wait for the workers to finish """
+    # a worker can't exit until what it put on the queue has been read, so read before joining
+    totals = dict()
+    workers = len(process_list)
+    reported = 0
+    while reported < workers:
+        # anything put by workers that have already exited is in the queue by now
+        all_exited = not any(p.is_alive() for p in process_list)
+        try:
+            counters = counter_queue.get(timeout=1)
+        except Queue.Empty:
+            if all_exited:
+                logger.warn('{} of {} workers exited without reporting their counters'.format(
+                    workers - reported, workers))
+                break
+            continue
+        reported += 1
+        for counter, value in counters.items():
+            totals[counter] = totals.get(counter, 0) + value
+    for p in process_list:
+        p.join()
+    logger.info('All {} workers: {}'.format(workers, ', '.join(
+        '{}: {}'.format(counter, value) for counter, value in sorted(totals.items()))))
+
+
+def initialize_data_gathering(thread_number, counter_queue=None):
     reset_track()
     track['chunk_count'] = 0
     track['entry_count'] = 0
+    start_aggregation()
+    start_checkpoint(thread_number)
 
-    start_data_processing(thread_number)
+    if agent_config_vars['replay_order'] == 'timestamp':
+        replay_merged()
+    else:
+        start_data_processing(thread_number)
+    flush_aggregation()
 
     # last chunk
     if len(track['current_row']) > 0 or len(track['current_dict']) > 0:
         logger.debug('Sending last chunk')
         send_data_wrapper()
+    stop_checkpoint()
 
     logger.debug('Total chunks created: ' + str(track['chunk_count']))
     logger.debug('Total {} entries: {}'.format(
         if_config_vars['project_type'].lower(), track['entry_count']))
+    if counter_queue is not None:
+        counter_queue.put(get_worker_counters())
 
 
 def reset_track():
@@ -1408,38 +2290,48 @@ def reset_track():
     track['start_time'] = time.time()
     track['line_count'] = 0
     track['current_row'] = []
+    track['current_row_size'] = get_json_size_bytes([])
     track['current_dict'] = dict()
+    track['current_dict_size'] = get_json_size_bytes({})
 
 
 #########################################
 # Functions to handle Log/Incident data #
 #########################################
 def incident_handoff(timestamp, data, instance, device=''):
+    if merge:
+        return merge_record('incident_handoff', timestamp, data, instance, device)
     send_log(timestamp, data, instance or HOSTNAME, device)
 
 
 def deployment_handoff(timestamp, data, instance, device=''):
+    if merge:
+        return merge_record('deployment_handoff', timestamp, data, instance, device)
     send_log(timestamp, data, instance or HOSTNAME, device)
 
 
 def alert_handoff(timestamp, data, instance, device=''):
+    if merge:
+        return merge_record('alert_handoff', timestamp, data, instance, device)
     send_log(timestamp, data, instance or HOSTNAME, device)
 
 
 def log_handoff(timestamp, data, instance, device=''):
+    if merge:
+        return merge_record('log_handoff', timestamp, data, instance, device)
     send_log(timestamp, data, instance or HOSTNAME, device)
 
 
 def send_log(timestamp, data, instance, device=''):
     entry = prepare_log_entry(str(int(timestamp)), data, instance, device)
-    track['current_row'].append(entry)
+    append_to_current_row(entry)
     track['line_count'] += 1
     track['entry_count'] += 1
-    if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
+    if track['current_row_size'] >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 100 == 0:
         logger.debug('Current data object size: {} bytes'.format(
-            get_json_size_bytes(track['current_row'])))
+            track['current_row_size']))
 
 
 def prepare_log_entry(timestamp, data, instance, device=''):
@@ -1459,7 +2351,12 @@ def prepare_log_entry(timestamp, data, instance, device=''):
 # Functions to handle Metric data #
 ###################################
 def metric_handoff(timestamp, field_name, data, instance, device=''):
-    add_and_send_metric(timestamp, field_name, data, instance or HOSTNAME, device)
+    if merge:
+        return merge_record('metric_handoff', timestamp, field_name, data, instance, device)
+    if aggregation:
+        aggregate_metric(timestamp, field_name, data, instance or HOSTNAME, device)
+    else:
+        add_and_send_metric(timestamp, field_name, data, instance or HOSTNAME, device)
 
 
 def add_and_send_metric(timestamp, field_name, data, instance, device=''):
@@ -1476,32 +2373,224 @@ def add_and_send_metric(timestamp, field_name, data, instance, device=''):
         send_metric()
 
 
-def send_metric():
-    track['entry_count'] += 1
-    if get_json_size_bytes(track['current_dict']) >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
+def metric_row_handoff(timestamp, data, instance, device=''):
+    """ a row of metric values, as {field_name: value}, sharing a timestamp, instance and device """
+    if merge:
+        return merge_record('metric_row_handoff', timestamp, data, instance, device)
+    if aggregation:
+        for field_name, value in data.items():
+            aggregate_metric(timestamp, field_name, value, instance or HOSTNAME, device)
+        return
+    instance = make_safe_instance_string(instance or HOSTNAME, device)
+    for field_name, value in data.items():
+        add_metric_data_to_entry(timestamp, '{}[{}]'.format(make_safe_metric_key(field_name), instance), value)
+    send_metric(len(data))
+
+
+def export_handoff(timestamp, row):
+    """ an IFEXPORT row, already in the shape IF takes """
+    if merge:
+        return merge_record('export_handoff', timestamp, row)
+    append_to_current_row(row)
+    send_metric()
+
+
+def send_metric(entries=1):
+    track['entry_count'] += entries
+    if max(track['current_dict_size'], track['current_row_size']) >= if_config_vars['chunk_size'] or (time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 500 == 0:
         logger.debug('Current data object size: {} bytes'.format(
-            get_json_size_bytes(track['current_dict'])))
+            max(track['current_dict_size'], track['current_row_size'])))
+
+
+def start_aggregation():
+    """ start pre-aggregating metric samples into sampling_interval buckets, if metric_aggregates is set """
+    aggregation.clear()
+    if not agent_config_vars['metric_aggregates'] or 'METRIC' not in if_config_vars['project_type']:
+        return
+    aggregation['interval'] = if_config_vars['sampling_interval'] * 1000
+    aggregation['quantiles'] = any(quantile is not None for (_, quantile) in agent_config_vars['metric_aggregates'])
+    # <bucket timestamp>: {(instance, device, field_name): aggregate}
+    aggregation['buckets'] = dict()
+    # <bucket timestamp>: {st_ino: offset of the first tailed line with samples in the bucket}
+    aggregation['held'] = dict()
+    aggregation['newest'] = 0
+
+
+def aggregate_metric(timestamp, field_name, data, instance, device=''):
+    """ add a sample to its sampling_interval bucket, sending the buckets it leaves behind """
+    try:
+        data = float(data)
+    except (TypeError, ValueError):
+        # pass it on to be logged
+        add_and_send_metric(timestamp, field_name, data, instance, device)
+        return
+    bucket = int(timestamp) // aggregation['interval'] * aggregation['interval']
+    samples = aggregation['buckets'].setdefault(bucket, dict())
+    hold_checkpoint(bucket)
+    key = (instance, device, field_name)
+    if key not in samples:
+        samples[key] = new_aggregate()
+    add_to_aggregate(samples[key], data)
+    if bucket > aggregation['newest']:
+        aggregation['newest'] = bucket
+        # samples can arrive up to one interval late
+        flush_aggregation(bucket - aggregation['interval'])
+
+
+def flush_aggregation(before=None):
+    """ send the aggregates of the buckets older than before, or of all of them """
+    if not aggregation:
+        return
+    aggregates = agent_config_vars['metric_aggregates']
+    for bucket in sorted(aggregation['buckets']):
+        if before is not None and bucket >= before:
+            break
+        for (instance, device, field_name), aggregate in aggregation['buckets'].pop(bucket).items():
+            for (name, quantile) in aggregates:
+                metric_name = field_name if len(aggregates) == 1 else '{}_{}'.format(field_name, name)
+                add_and_send_metric(bucket, metric_name, get_aggregate_value(aggregate, name, quantile), instance, device)
+        aggregation['held'].pop(bucket, None)
+
+
+def hold_checkpoint(bucket):
+    """ keep a tailed file's checkpoint from passing the line it is at until bucket has been sent """
+    reading = checkpoint.get('reading')
+    if reading:
+        aggregation['held'].setdefault(bucket, dict()).setdefault(reading['st_ino'], reading['line_start'])
+
+
+def get_held_offsets():
+    """ the earliest offset of each tailed file with samples still being aggregated """
+    held = dict()
+    for offsets in aggregation.get('held', {}).values():
+        for st_ino, offset in offsets.items():
+            held[st_ino] = min(offset, held.get(st_ino, offset))
+    return held
+
+
+def parse_metric_aggregates(metric_aggregates):
+    """ parse a list of aggregates into (name, quantile) pairs, with quantile set for pNN aggregates """
+    aggregates = []
+    for name in metric_aggregates:
+        if name in METRIC_AGGREGATES:
+            aggregates.append((name, None))
+        elif regex.match(r'^p\d+(\.\d+)?$', name) and float(name[1:]) <= 100:
+            aggregates.append((name, float(name[1:]) / 100))
+        else:
+            raise ValueError('Unknown aggregate {}'.format(name))
+    return aggregates
+
+
+def new_aggregate():
+    aggregate = {'count': 0, 'sum': 0.0, 'min': float('inf'), 'max': float('-inf'), 'last': None}
+    if aggregation['quantiles']:
+        aggregate['sketch'] = new_sketch()
+    return aggregate
+
+
+def add_to_aggregate(aggregate, value):
+    aggregate['count'] += 1
+    aggregate['sum'] += value
+    aggregate['min'] = min(aggregate['min'], value)
+    aggregate['max'] = max(aggregate['max'], value)
+    aggregate['last'] = value
+    if 'sketch' in aggregate:
+        add_to_sketch(aggregate['sketch'], value)
+
+
+def get_aggregate_value(aggregate, name, quantile=None):
+    if quantile is not None:
+        # the exact extremes are known, so keep the estimate within them
+        return min(max(get_sketch_quantile(aggregate['sketch'], quantile), aggregate['min']), aggregate['max'])
+    if name == 'avg':
+        return aggregate['sum'] / aggregate['count']
+    return aggregate[name]
+
+
+def new_sketch():
+    """
+    A quantile sketch in the style of DDSketch. Values are counted in logarithmically sized bins, so
+    quantiles are within SKETCH_RELATIVE_ACCURACY of the true value, and memory is bounded by SKETCH_MAX_BINS
+    however many values are added.
+    """
+    return {'positive': dict(), 'negative': dict(), 'zero': 0, 'count': 0}
+
+
+def add_to_sketch(sketch, value, count=1):
+    sketch['count'] += count
+    if value > SKETCH_MIN_VALUE:
+        bins = sketch['positive']
+    elif value < -SKETCH_MIN_VALUE:
+        bins = sketch['negative']
+        value = -value
+    else:
+        sketch['zero'] += count
+        return
+    index = int(math.ceil(math.log(value) / SKETCH_LOG_GAMMA))
+    bins[index] = bins.get(index, 0) + count
+    if len(bins) > SKETCH_MAX_BINS:
+        collapse_sketch_bins(bins)
+
+
+def collapse_sketch_bins(bins):
+    """ fold the bins of the smallest magnitudes together, so only their accuracy is lost """
+    indexes = sorted(bins)
+    excess = len(indexes) - SKETCH_MAX_BINS
+    bins[indexes[excess]] += sum(bins.pop(index) for index in indexes[:excess])
+
+
+def get_sketch_quantile(sketch, quantile):
+    """ estimate a quantile (0 to 1) of the values added """
+    rank = quantile * (sketch['count'] - 1)
+    seen = 0
+    # from the most negative value up
+    for index in sorted(sketch['negative'], reverse=True):
+        seen += sketch['negative'][index]
+        if seen > rank:
+            return -get_sketch_bin_value(index)
+    seen += sketch['zero']
+    if seen > rank or not sketch['positive']:
+        return 0.0
+    for index in sorted(sketch['positive']):
+        seen += sketch['positive'][index]
+        if seen > rank:
+            break
+    return get_sketch_bin_value(index)
+
+
+def get_sketch_bin_value(index):
+    """ the value a bin stands for, within SKETCH_RELATIVE_ACCURACY of every value counted in it """
+    return 2 * SKETCH_GAMMA ** index / (SKETCH_GAMMA + 1)
 
 
 def append_metric_data_to_entry(timestamp, field_name, data, instance, device=''):
     """ creates the metric entry """
     key = '{}[{}]'.format(make_safe_metric_key(field_name),
                           make_safe_instance_string(instance, device))
+    add_metric_data_to_entry(timestamp, key, data)
+
+
+def add_metric_data_to_entry(timestamp, key, data):
     ts_str = str(timestamp)
     if ts_str not in track['current_dict']:
         track['current_dict'][ts_str] = dict()
+        # '"ts": {}' plus the ', ' separator
+        track['current_dict_size'] += get_json_size_bytes(ts_str) + 6
     current_obj = track['current_dict'][ts_str]
 
     # use the next non-null value to overwrite the prev value
     # for the same metric in the same timestamp
-    if key in current_obj.keys():
+    # keep a running estimate of the chunk size rather than re-serializing it
+    if key in current_obj:
         if data is not None and len(str(data)) > 0:
             current_obj[key] += '|' + str(data)
+            track['current_dict_size'] += len(str(data)) + 1
     else:
         current_obj[key] = str(data)
-    track['current_dict'][ts_str] = current_obj
+        # '"key": "value"' plus the ', ' separator
+        track['current_dict_size'] += get_json_size_bytes(key) + get_json_size_bytes(current_obj[key]) + 4
 
 
 def transpose_metrics():
@@ -1512,6 +2601,7 @@ def transpose_metrics():
         new_row['timestamp'] = timestamp
         for key, value in kvs.items():
             if '|' in value:
+                import statistics
                 value = statistics.median(
                     map(lambda v: float(v), value.split('|')))
             new_row[key] = str(value)
@@ -1630,12 +2720,17 @@ def send_data_wrapper():
         transpose_metrics()
     logger.debug('--- Chunk creation time: {} seconds ---'.format(
         round(time.time() - track['start_time'], 2)))
-    send_data_to_if(track['current_row'])
+    accepted = send_data_to_if(track['current_row'])
+    if accepted:
+        commit_checkpoint(track['current_row'])
+    elif accepted is not None:
+        fail_checkpoint()
     track['chunk_count'] += 1
     reset_track()
 
 
 def send_data_to_if(chunk_metric_data):
+    """ post a chunk to IF, returning whether it was accepted, or None if only testing """
     send_data_time = time.time()
 
     # prepare data for metric streaming agent
@@ -1656,14 +2751,17 @@ def send_data_to_if(chunk_metric_data):
 
     # send the data
     post_url = urlparse.urljoin(if_config_vars['if_url'], get_api_from_project_type())
-    send_request(post_url, 'POST', 'Could not send request to IF',
-                 str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.',
-                 data=data_to_post, proxies=if_config_vars['if_proxies'])
+    response = send_request(post_url, 'POST', 'Could not send request to IF',
+                            str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.',
+                            data=data_to_post, proxies=if_config_vars['if_proxies'])
     logger.debug('--- Send data time: %s seconds ---' % round(time.time() - send_data_time, 2))
+    return response != -1
 
 
 def send_request(url, mode='GET', failure_message='Failure!', success_message='Success!', **request_passthrough):
     """ sends a request to the given url """
+    import httplib
+    import requests
     # determine if post or get (default)
     req = requests.get
     if mode.upper() == 'POST':
@@ -1794,13 +2892,49 @@ if __name__ == "__main__":
     NON_ALNUM = regex.compile(r"[^a-zA-Z0-9]")
     PCT_z_FMT = regex.compile(r"[\+\-][0-9]{2}[\:]?[0-9]{2}|\w+\s+\w+\s+\w+")
     PCT_Z_FMT = regex.compile(r"[A-Z]{3,4}")
+    STRPTIME_DIRECTIVES = regex.compile(r"(%.)")
+    STRPTIME_FIXED_WIDTHS = {'%Y': 4, '%m': 2, '%d': 2, '%H': 2, '%M': 2, '%S': 2}
     FORMAT_STR = regex.compile(r"{(.*?)}")
+    MATH_EXPR_TOKENS = regex.compile(r"\s*(?:(\{.*?\})|(\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?)|([A-Za-z_]\w*)|(\S))")
+    MATH_EXPR_OPS = {'+': operator.add, '-': operator.sub, '*': operator.mul, '/': operator.div}
+    MATH_EXPR_FUNCTIONS = {'min': (min, 2, 255), 'max': (max, 2, 255), 'abs': (abs, 1, 1), 'round': (round, 1, 2)}
     HOSTNAME = socket.gethostname().partition('.')[0]
     ISO8601 = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S', '%Y%m%dT%H%M%SZ', 'epoch']
     JSON_LEVEL_DELIM = '.'
     CSV_DELIM = r",|\t"
     ATTEMPTS = 3
+    # modules only some data formats use; see import_deferred_modules
+    DEFERRED_MODULES = {'XLS': ['xlrd'], 'XLSX': ['xlrd'], 'AVRO': ['avro.datafile', 'avro.io'], 'XML': ['xml2dict']}
+    WORKER_COUNTERS = ['chunk_count', 'entry_count']
+    CHECKPOINT_INTERVAL_SECONDS = 5
+    MERGE_RUN_SIZE = 50000
+    MERGE_BATCH_SIZE = 1000
+    TAIL_POLL_SECONDS = 0.1
+    # inotify(7) flags and events
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    METRIC_AGGREGATES = {'last', 'min', 'max', 'sum', 'avg', 'count'}
+    SKETCH_RELATIVE_ACCURACY = 0.01
+    SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+    SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA)
+    SKETCH_MIN_VALUE = 1e-9
+    SKETCH_MAX_BINS = 2048
+    JSON_FIELD_GETTERS = dict()
+    FILTERS = dict()
+    MATH_EXPRS = dict()
+    DATETIME_PARSERS = dict()
+    UTC_OFFSETS = dict()
+    INOTIFY = dict()
     track = dict()
+    aggregation = dict()
+    checkpoint = dict()
+    merge = dict()
 
     # get config
     cli_config_vars = get_cli_config_vars()
@@ -1809,9 +2943,20 @@ if __name__ == "__main__":
     if_config_vars = get_if_config_vars()
     agent_config_vars = get_agent_config_vars()
     print_summary_info()
-
-    # start data processing
-    for i in range(0, cli_config_vars['threads']):
-        Process(target=initialize_data_gathering,
-                args=(i,)
-                ).start()
+    import_deferred_modules()
+
+    # start data processing, each worker reading its own share of the files.
+    # merging them into timestamp order has a single worker send what a pool of them parsed
+    counter_queue = ProcessQueue()
+    process_list = []
+    workers = 1 if agent_config_vars['replay_order'] == 'timestamp' else cli_config_vars['threads']
+    for i in range(0, workers):
+        p = Process(target=initialize_data_gathering,
+                    args=(i, counter_queue)
+                    )
+        process_list.append(p)
+
+    for p in process_list:
+        p.start()
+
+    merge_worker_counters(counter_queue, process_list)
@@ -7,10 +7,14 @@ import regex
 import socket
 import sys
 import time
+import zlib
+import operator
+import Queue
 import pytz
 import arrow
 from optparse import OptionParser
-from multiprocessing import Process
+from multiprocessing import Process, Queue as ProcessQueue
+from collections import OrderedDict
 from datetime import datetime
 import urlparse
 import httplib
@@ -19,7 +23,7 @@ import statistics
 import subprocess
 import shlex
 
-from kafka import KafkaConsumer
+from kafka import KafkaConsumer, TopicPartition
 
 '''
 This script gathers data to send to Insightfinder
@@ -30,9 +34,17 @@ def start_data_processing(thread_number):
     # open consumer
     consumer = KafkaConsumer(**agent_config_vars['kafka_kwargs'])
     logger.info('Started consumer number ' + str(thread_number))
-    # subscribe to given topics
-    consumer.subscribe(agent_config_vars['topics'])
-    logger.info('Successfully subscribed to topics' + str(agent_config_vars['topics']))
+    if 'group_id' in agent_config_vars['kafka_kwargs']:
+        # subscribe to given topics, letting the consumer group spread partitions across workers
+        consumer.subscribe(agent_config_vars['topics'])
+        logger.info('Successfully subscribed to topics' + str(agent_config_vars['topics']))
+    else:
+        # without a group every worker would read every partition, so assign this worker's share
+        partitions = sorted((topic, partition) for topic in agent_config_vars['topics']
+                            for partition in (consumer.partitions_for_topic(topic) or []))
+        consumer.assign([TopicPartition(topic, partition)
+                         for (topic, partition) in get_worker_partition(partitions, thread_number)])
+        logger.info('Assigned partitions ' + str(consumer.assignment()))
     # start consuming messages
     parse_messages_kafka(consumer)
     consumer.close()
@@ -183,6 +195,14 @@ def get_agent_config_vars():
             filters_include = filters_include.split('|')
         if len(filters_exclude) != 0:
             filters_exclude = filters_exclude.split('|')
+        try:
+            FILTERS['include'] = compile_filters(filters_include)
+        except IndexError:
+            config_error('filters_include')
+        try:
+            FILTERS['exclude'] = compile_filters(filters_exclude)
+        except IndexError:
+            config_error('filters_exclude')
 
         # fields
         # project_field = project_field.split(',')
@@ -200,6 +220,16 @@ def get_agent_config_vars():
             if timestamp_field in data_fields:
                 data_fields.pop(data_fields.index(timestamp_field))
 
+        # compile field paths once, rather than splitting them for every message
+        compile_json_fields(instance_field + device_field + timestamp_field + [json_top_level])
+        if len(data_fields) != 0:
+            compile_json_fields(data_fields)
+            try:
+                compile_math_exprs(data_fields)
+            except ValueError as e:
+                logger.error(e)
+                config_error('data_fields')
+
         # timestamp format
         if len(timestamp_format) != 0:
             timestamp_format = filter(lambda x: x.strip(), timestamp_format.split(','))
@@ -374,11 +404,8 @@ def get_cli_config_vars():
     """ get CLI options. use of these options should be rare """
     usage = 'Usage: %prog [options]'
     parser = OptionParser(usage=usage)
-    """
-    ## not ready.
     parser.add_option('--threads', default=1, action='store', dest='threads',
-                      help='Number of threads to run')
-    """
+                      help='Number of worker processes to run, each handling its own share of the input')
     parser.add_option('-q', '--quiet', action='store_true', dest='quiet',
                       help='Only display warning and error log messages')
     parser.add_option('-v', '--verbose', action='store_true', dest='verbose',
@@ -388,16 +415,13 @@ def get_cli_config_vars():
                            ' Automatically turns on verbose logging')
     (options, args) = parser.parse_args()
 
-    """
-    # not ready
     try:
-        threads = int(options.threads)
+        threads = max(1, int(options.threads))
     except ValueError:
         threads = 1
-    """
 
     config_vars = {
-        'threads': 1,
+        'threads': threads,
         'testing': False,
         'log_level': logging.INFO
     }
@@ -566,6 +590,67 @@ def get_field_index(field_names, field, label, is_required=False):
             return field
 
 
+def compile_filters(filters):
+    """ compile field:value,value filters into one matcher per field, in the order fields first appear """
+    matchers = OrderedDict()
+    for _filter in filters:
+        filter_field = _filter.split(':')[0]
+        filter_vals = _filter.split(':')[1].split(',')
+        matcher = matchers.setdefault(filter_field, {'field': filter_field, 'values': []})
+        for filter_val in filter_vals:
+            if filter_val.upper() not in matcher['values']:
+                matcher['values'].append(filter_val.upper())
+    for matcher in matchers.values():
+        # values are matched as case-insensitive substrings; an exact match is just the cheapest case
+        matcher['exact'] = set(matcher['values'])
+        matcher['any'] = regex.compile(r'\L<values>', values=matcher['values'])
+    return matchers.values()
+
+
+def get_filter_hit(matcher, filter_check):
+    """ a matcher's value that is in filter_check, or None """
+    filter_check = filter_check.upper()
+    if filter_check in matcher['exact']:
+        return filter_check
+    match = matcher['any'].search(filter_check)
+    if match is None:
+        return None
+    return match.group()
+
+
+def is_filtered(get_filter_check):
+    """ whether the filters drop a message. get_filter_check gets a field """
+    if FILTERS['include']:
+        # for each provided filter field, check if there are any allowed values
+        is_valid = False
+        filter_check = None
+        for matcher in FILTERS['include']:
+            filter_check = get_filter_check(matcher['field'])
+            # check if a valid value
+            if get_filter_hit(matcher, filter_check) is not None:
+                is_valid = True
+                break
+        if not is_valid:
+            logger.debug('filtered message (inclusion): {} not in {}'.format(
+                filter_check, matcher['values']))
+            return True
+        else:
+            logger.debug('passed filter (inclusion)')
+
+    if FILTERS['exclude']:
+        # for each provided filter field, check if there are any disallowed values
+        for matcher in FILTERS['exclude']:
+            filter_check = get_filter_check(matcher['field'])
+            # check if a valid value
+            filter_val = get_filter_hit(matcher, filter_check)
+            if filter_val is not None:
+                logger.debug('filtered message (exclusion): {} in {}'.format(
+                    filter_val, filter_check))
+                return True
+        logger.debug('passed filter (exclusion)')
+    return False
+
+
 def should_include_per_config(setting, value):
     """ determine if an agent config filter setting would exclude a given value """
     return len(agent_config_vars[setting]) != 0 and value not in agent_config_vars[setting]
@@ -581,6 +666,15 @@ def get_json_size_bytes(json_data):
     return len(bytearray(json.dumps(json_data)))
 
 
+def append_to_current_row(entry):
+    """ add an entry to the current chunk, keeping a running total of its serialized size """
+    if len(track['current_row']) != 0:
+        # json.dumps separates list items with ', '
+        track['current_row_size'] += 2
+    track['current_row'].append(entry)
+    track['current_row_size'] += get_json_size_bytes(entry)
+
+
 def get_all_files(files, file_regex_c):
     return [i for j in
             map(lambda k:
@@ -648,6 +742,15 @@ def is_named_data_field(setting_value):
     return ':' in setting_value
 
 
+def compile_math_exprs(setting_values):
+    """ compile the evaluators for the arithmetic expressions in a list of data fields """
+    for setting_value in setting_values:
+        if is_named_data_field(setting_value):
+            value = setting_value.split(':')[1]
+            if is_math_expr(value):
+                get_math_expr_evaluator(get_math_expr(value))
+
+
 def merge_data(field, value, data={}):
     fields = field.split(JSON_LEVEL_DELIM)
     for i in range(len(fields) - 1):
@@ -699,17 +802,13 @@ def get_data_value(message, setting_value):
         # get value
         value = setting_value[1]
         # check if math
-        evaluate = False
         if is_math_expr(value):
-            evaluate = True
-            value = get_math_expr(value)
-        if is_formatted(value):
+            value = evaluate_math_expr(message, get_math_expr(value))
+        elif is_formatted(value):
             value = parse_formatted(message,
                                     value,
                                     default=value,
                                     allow_list=True)
-        if evaluate:
-            value = eval(value)
     else:
         name = setting_value
         value = get_json_field(message,
@@ -718,6 +817,134 @@ def get_data_value(message, setting_value):
     return (name, value)
 
 
+def parse_math_number(value):
+    """ parse a field value or literal as an int or float; returns None if it is not a number """
+    if isinstance(value, (int, long, float)):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+
+def get_math_expr_evaluator(expr):
+    """ get the compiled evaluator for an arithmetic expression, compiling it on first use """
+    evaluate = MATH_EXPRS.get(expr)
+    if evaluate is None:
+        evaluate = compile_math_expr(expr)
+        MATH_EXPRS[expr] = evaluate
+    return evaluate
+
+
+def evaluate_math_expr(message, expr, default=''):
+    """ evaluate an arithmetic expression against a message """
+    try:
+        return get_math_expr_evaluator(expr)(message)
+    except (ValueError, ArithmeticError) as e:
+        logger.debug('cannot evaluate {}: {}'.format(expr, e))
+        return default
+
+
+def compile_math_expr(expr):
+    """
+    Compile an arithmetic expression into a function of the message.
+    Supports {field} references, numeric literals, + - * /, parentheses,
+    and the functions in MATH_EXPR_FUNCTIONS. Raises ValueError on anything else.
+    """
+    tokens = MATH_EXPR_TOKENS.findall(expr)
+    evaluate, pos = _compile_math_sum(tokens, 0, expr)
+    if pos != len(tokens):
+        raise _math_expr_error(tokens, pos, expr)
+    return evaluate
+
+
+def _get_math_token(tokens, pos):
+    return tokens[pos] if pos < len(tokens) else ('', '', '', '')
+
+
+def _math_expr_error(tokens, pos, expr):
+    token = ''.join(_get_math_token(tokens, pos)) or 'end of expression'
+    return ValueError('unexpected {} in expression {}'.format(token, expr))
+
+
+def _compile_math_sum(tokens, pos, expr):
+    left, pos = _compile_math_product(tokens, pos, expr)
+    while _get_math_token(tokens, pos)[3] in ('+', '-'):
+        right, next_pos = _compile_math_product(tokens, pos + 1, expr)
+        left = _bind_math_op(MATH_EXPR_OPS[tokens[pos][3]], left, right)
+        pos = next_pos
+    return left, pos
+
+
+def _compile_math_product(tokens, pos, expr):
+    left, pos = _compile_math_factor(tokens, pos, expr)
+    while _get_math_token(tokens, pos)[3] in ('*', '/'):
+        right, next_pos = _compile_math_factor(tokens, pos + 1, expr)
+        left = _bind_math_op(MATH_EXPR_OPS[tokens[pos][3]], left, right)
+        pos = next_pos
+    return left, pos
+
+
+def _compile_math_factor(tokens, pos, expr):
+    field, number, name, op = _get_math_token(tokens, pos)
+    if op in ('+', '-'):
+        operand, pos = _compile_math_factor(tokens, pos + 1, expr)
+        return (_bind_math_func(operator.neg, [operand]) if op == '-' else operand), pos
+    elif field:
+        return _bind_math_field(field[1:-1]), pos + 1
+    elif number:
+        value = parse_math_number(number)
+        return (lambda message: value), pos + 1
+    elif name in MATH_EXPR_FUNCTIONS:
+        func, min_args, max_args = MATH_EXPR_FUNCTIONS[name]
+        if _get_math_token(tokens, pos + 1)[3] != '(':
+            raise _math_expr_error(tokens, pos + 1, expr)
+        args = []
+        pos += 2
+        while True:
+            arg, pos = _compile_math_sum(tokens, pos, expr)
+            args.append(arg)
+            if _get_math_token(tokens, pos)[3] != ',':
+                break
+            pos += 1
+        if _get_math_token(tokens, pos)[3] != ')':
+            raise _math_expr_error(tokens, pos, expr)
+        if not min_args <= len(args) <= max_args:
+            raise ValueError('{} takes {} to {} arguments in expression {}'.format(name, min_args, max_args, expr))
+        return _bind_math_func(func, args), pos + 1
+    elif op == '(':
+        inner, pos = _compile_math_sum(tokens, pos + 1, expr)
+        if _get_math_token(tokens, pos)[3] != ')':
+            raise _math_expr_error(tokens, pos, expr)
+        return inner, pos + 1
+    raise _math_expr_error(tokens, pos, expr)
+
+
+def _bind_math_op(op, left, right):
+    return lambda message: op(left(message), right(message))
+
+
+def _bind_math_func(func, args):
+    return lambda message: func(*[arg(message) for arg in args])
+
+
+def _bind_math_field(field):
+    getter = get_json_field_getter(field)
+
+    def evaluate(message):
+        # same stringified value a format string would see; missing fields count as 0
+        value = json_format_field_value(getter(message, allow_list=False))
+        value = parse_math_number(value) if len(value) != 0 else 0
+        if value is None:
+            raise ValueError('{} is not a number'.format(field))
+        return value
+
+    return evaluate
+
+
 def get_single_value(message, config_setting, default='', allow_list=False, remove=False):
     if config_setting not in agent_config_vars or len(agent_config_vars[config_setting]) == 0:
         return default
@@ -754,9 +981,8 @@ def get_json_field_by_pri(message, pri_list, default='', allow_list=False, remov
 
 def get_json_field(message, setting_value, default='', allow_list=False, remove=False):
     field_val = json_format_field_value(
-        _get_json_field_helper(
+        get_json_field_getter(setting_value)(
             message,
-            setting_value.split(JSON_LEVEL_DELIM),
             allow_list=allow_list,
             remove=remove))
     if len(field_val) == 0:
@@ -764,53 +990,80 @@ def get_json_field(message, setting_value, default='', allow_list=False, remove=
     return field_val
 
 
-class ListNotAllowedError():
+def get_json_field_getter(setting_value):
+    """ get the compiled getter for a field path, compiling it on first use """
+    getter = JSON_FIELD_GETTERS.get(setting_value)
+    if getter is None:
+        getter = compile_json_field(setting_value)
+        JSON_FIELD_GETTERS[setting_value] = getter
+    return getter
+
+
+def compile_json_fields(setting_values):
+    """ compile the getters for a list of configured field paths """
+    for setting_value in setting_values:
+        if setting_value and not (is_formatted(setting_value) or is_named_data_field(setting_value)):
+            get_json_field_getter(setting_value)
+
+
+def compile_json_field(setting_value):
+    """
+    Compile a JSON_LEVEL_DELIM-delimited field path into a reusable getter.
+    The getter walks the message in place, without copying it.
+    """
+    fields = tuple(setting_value.split(JSON_LEVEL_DELIM))
+
+    def getter(message, allow_list=False, remove=False):
+        return _get_json_field_helper(message, fields, 0, allow_list=allow_list, remove=remove)
+
+    return getter
+
+
+class ListNotAllowedError(Exception):
     pass
 
 
-def _get_json_field_helper(nested_value, next_fields, allow_list=False, remove=False):
-    # check inputs; need a dict that is a subtree, an _array_ of fields to traverse down
-    if len(next_fields) == 0:
+def _get_json_field_helper(nested_value, fields, index, allow_list=False, remove=False, in_message=True):
+    # check inputs; need a dict that is a subtree, and a tuple of fields to traverse down
+    if index == len(fields):
         # nothing to look for
         return ''
     elif isinstance(nested_value, (list, set, tuple)):
         # for each elem in the list
         # already checked in the recursive call that this is OK
-        return json_gather_list_values(nested_value, next_fields)
+        return json_gather_list_values(nested_value, fields, index)
     elif not isinstance(nested_value, dict):
         # nothing to walk down
         return ''
 
     # get the next value
-    next_field = next_fields.pop(0)
-    next_value = json.loads(json.dumps(nested_value.get(next_field)))
-    if len(next_fields) == 0 and remove:
+    next_field = fields[index]
+    index += 1
+    next_value = nested_value.get(next_field)
+
+    # only fields that hang directly off the message are removed
+    if index == len(fields) and remove and in_message:
         # last field to grab, so remove it
-        nested_value.pop(next_field)
+        nested_value.pop(next_field, None)
 
     # check the next value
-    if next_value is None:
+    if next_value is None or (isinstance(next_value, basestring) and len(next_value) == 0):
         # no next value defined
         return ''
-    elif len(bytes(next_value)) == 0:
-        # no next value set
-        return ''
 
     # sometimes payloads come in formatted
-    try:
-        next_value = json.loads(next_value)
-    except Exception as ex:
-        next_value = json.loads(json.dumps(next_value))
+    if isinstance(next_value, basestring):
+        try:
+            next_value = json.loads(next_value)
+        except ValueError:
+            pass
 
     # handle simple lists
     while isinstance(next_value, (list, set, tuple)) and len(next_value) == 1:
-        next_value = next_value.pop()
+        next_value = next(iter(next_value))
 
     # continue traversing?
-    if next_fields is None:
-        # some error, but return the value
-        return next_value
-    elif len(next_fields) == 0:
+    if index == len(fields):
         # final value in the list to walk down
         return next_value
     elif isinstance(next_value, (list, set, tuple)):
@@ -818,33 +1071,38 @@ def _get_json_field_helper(nested_value, next_fields, allow_list=False, remove=F
         if allow_list:
             return json_gather_list_values(
                 next_value,
-                next_fields,
+                fields,
+                index,
                 remove=remove)
         else:
             raise ListNotAllowedError('encountered list or set in json when not allowed')
     elif isinstance(next_value, dict):
         # there's more tree to walk down
         return _get_json_field_helper(
-            json.loads(json.dumps(next_value)),
-            next_fields,
+            next_value,
+            fields,
+            index,
             allow_list=allow_list,
-            remove=remove)
+            remove=remove,
+            in_message=False)
     else:
         # catch-all
         return ''
 
 
-def json_gather_list_values(l, fields, remove=False):
+def json_gather_list_values(values, fields, index, remove=False):
     sub_field_value = []
     # treat each item in the list as a potential tree to walk down
-    for sub_value in l:
-        fields_copy = list(fields[i] for i in range(len(fields)))
+    # the items are only read, as removing fields from them would change the caller's message
+    for sub_value in values:
         json_value = json_format_field_value(
             _get_json_field_helper(
                 sub_value,
-                fields_copy,
+                fields,
+                index,
                 allow_list=True,
-                remove=remove))
+                remove=remove,
+                in_message=False))
         if len(json_value) != 0:
             sub_field_value.append(json_value)
     # return the full list of field values
@@ -870,9 +1128,8 @@ def parse_json_message(messages):
             for message in messages:
                 parse_json_message_single(message)
         else:
-            top_level = _get_json_field_helper(
+            top_level = get_json_field_getter(agent_config_vars['json_top_level'])(
                 messages,
-                agent_config_vars['json_top_level'].split(JSON_LEVEL_DELIM),
                 allow_list=True)
             if isinstance(top_level, (list, set, tuple)):
                 for message in top_level:
@@ -889,46 +1146,8 @@ def parse_json_message(messages):
 def parse_json_message_single(message):
     # message = json.loads(json.dumps(message))
     # filter
-    if len(agent_config_vars['filters_include']) != 0:
-        # for each provided filter
-        is_valid = False
-        for _filter in agent_config_vars['filters_include']:
-            filter_field = _filter.split(':')[0]
-            filter_vals = _filter.split(':')[1].split(',')
-            filter_check = get_json_field(
-                message,
-                filter_field.split(JSON_LEVEL_DELIM),
-                allow_list=True)
-            # check if a valid value
-            for filter_val in filter_vals:
-                if filter_val.upper() in filter_check.upper():
-                    is_valid = True
-                    break
-            if is_valid:
-                break
-        if not is_valid:
-            logger.debug('filtered message (inclusion): {} not in {}'.format(
-                filter_check, filter_vals))
-            return
-        else:
-            logger.debug('passed filter (inclusion)')
-
-    if len(agent_config_vars['filters_exclude']) != 0:
-        # for each provided filter
-        for _filter in agent_config_vars['filters_exclude']:
-            filter_field = _filter.split(':')[0]
-            filter_vals = _filter.split(':')[1].split(',')
-            filter_check = get_json_field(
-                message,
-                filter_field.split(JSON_LEVEL_DELIM),
-                allow_list=True)
-            # check if a valid value
-            for filter_val in filter_vals:
-                if filter_val.upper() in filter_check.upper():
-                    logger.debug('filtered message (exclusion): {} in {}'.format(
-                        filter_val, filter_check))
-                    return
-        logger.debug('passed filter (exclusion)')
+    if is_filtered(lambda field: get_json_field(message, field, allow_list=True)):
+        return
 
     instance = get_single_value(message,
                                 'instance_field',
@@ -990,40 +1209,8 @@ def minlen(one, two):
 
 def parse_csv_message(message):
     # filter
-    if len(agent_config_vars['filters_include']) != 0:
-        # for each provided filter, check if there are any allowed valued
-        is_valid = False
-        for _filter in agent_config_vars['filters_include']:
-            filter_field = _filter.split(':')[0]
-            filter_vals = _filter.split(':')[1].split(',')
-            filter_check = message[int(filter_field)]
-            # check if a valid value
-            for filter_val in filter_vals:
-                if filter_val.upper() in filter_check.upper():
-                    is_valid = True
-                    break
-            if is_valid:
-                break
-        if not is_valid:
-            logger.debug('filtered message (inclusion): {} not in {}'.format(
-                filter_check, filter_vals))
-            return
-        else:
-            logger.debug('passed filter (inclusion)')
-
-    if len(agent_config_vars['filters_exclude']) != 0:
-        # for each provided filter, check if there are any disallowed values
-        for _filter in agent_config_vars['filters_exclude']:
-            filter_field = _filter.split(':')[0]
-            filter_vals = _filter.split(':')[1].split(',')
-            filter_check = message[int(filter_field)]
-            # check if a valid value
-            for filter_val in filter_vals:
-                if filter_val.upper() in filter_check.upper():
-                    logger.debug('filtered message (exclusion): {} in {}'.format(
-                        filter_check, filter_val))
-                    return
-        logger.debug('passed filter (exclusion)')
+    if is_filtered(lambda field: message[int(field)]):
+        return
 
     # project
     # if isinstance(agent_config_vars['project_field'], int):
@@ -1233,7 +1420,50 @@ def print_summary_info():
     logger.debug(cli_data_block)
 
 
-def initialize_data_gathering(thread_number):
+def is_in_worker_partition(key, thread_number):
+    """ whether a stable key (file inode, pod name, database, ...) belongs to this worker """
+    return zlib.crc32(str(key)) % cli_config_vars['threads'] == thread_number
+
+
+def get_worker_partition(items, thread_number):
+    """ this worker's share of a fixed, ordered list (kafka partitions, ...) """
+    return items[thread_number::cli_config_vars['threads']]
+
+
+def get_worker_counters():
+    counters = dict()
+    for counter in WORKER_COUNTERS:
+        counters[counter] = track.get(counter, 0)
+    return counters
+
+
+def merge_worker_counters(counter_queue, process_list):
+    """ sum the counters each worker reports at exit, then wait for the workers to finish """
+    # a worker can't exit until what it put on the queue has been read, so read before joining
+    totals = dict()
+    workers = len(process_list)
+    reported = 0
+    while reported < workers:
+        # anything put by workers that have already exited is in the queue by now
+        all_exited = not any(p.is_alive() for p in process_list)
+        try:
+            counters = counter_queue.get(timeout=1)
+        except Queue.Empty:
+            if all_exited:
+                logger.warn('{} of {} workers exited without reporting their counters'.format(
+                    workers - reported, workers))
+                break
+            continue
+        reported += 1
+        for counter, value in counters.items():
+            totals[counter] = totals.get(counter, 0) + value
+    for p in process_list:
+        p.join()
+    logger.info('All {} workers: {}'.format(workers, ', '.join(
+        '{}: {}'.format(counter, value) for counter, value in sorted(totals.items()))))
+
+
+def initialize_data_gathering(thread_number, counter_queue=None):
     reset_metric_buffer()
     reset_track()
     track['chunk_count'] = 0
@@ -1245,7 +1475,7 @@ def initialize_data_gathering(thread_number):
     while metric_buffer['buffer_ts_list']:
         (ts, key) = metric_buffer['buffer_ts_list'].pop()
         transpose_metrics(ts, key)
-        if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size']:
+        if track['current_row_size'] >= if_config_vars['chunk_size']:
             logger.debug('Sending buffer chunk')
             send_data_wrapper()
 
@@ -1257,12 +1487,16 @@ def initialize_data_gathering(thread_number):
     logger.debug('Total chunks created: ' + str(track['chunk_count']))
     logger.debug('Total {} entries: {}'.format(
         if_config_vars['project_type'].lower(), track['entry_count']))
+    if counter_queue is not None:
+        counter_queue.put(get_worker_counters())
 
 
 def reset_metric_buffer():
     metric_buffer['buffer_key_list'] = []
     metric_buffer['buffer_ts_list'] = []
     metric_buffer['buffer_dict'] = {}
+    metric_buffer['buffer_size_dict'] = {}
+    metric_buffer['buffer_size'] = 0
 
     metric_buffer['buffer_collected_list'] = []
     metric_buffer['buffer_collected_dict'] = {}
@@ -1273,6 +1507,7 @@ def reset_track():
     track['start_time'] = time.time()
     track['line_count'] = 0
     track['current_row'] = []
+    track['current_row_size'] = get_json_size_bytes([])
 
 
 #########################################
@@ -1296,15 +1531,15 @@ def log_handoff(timestamp, data, instance, device=''):
 
 def send_log(timestamp, data, instance, device=''):
     entry = prepare_log_entry(str(int(timestamp)), data, instance, device)
-    track['current_row'].append(entry)
+    append_to_current_row(entry)
     track['line_count'] += 1
     track['entry_count'] += 1
-    if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size'] or (
+    if track['current_row_size'] >= if_config_vars['chunk_size'] or (
             time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 100 == 0:
         logger.debug('Current data object size: {} bytes'.format(
-            get_json_size_bytes(track['current_row'])))
+            track['current_row_size']))
 
 
 def prepare_log_entry(timestamp, data, instance, device=''):
@@ -1346,26 +1581,26 @@ def send_metric(timestamp, field_name, data, instance, device=''):
             del metric_buffer['buffer_ts_list'][index]
             metric_buffer['buffer_collected_dict'].pop(key)
             transpose_metrics(ts, key)
-            if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size']:
+            if track['current_row_size'] >= if_config_vars['chunk_size']:
                 logger.debug('Sending buffer chunk')
                 send_data_wrapper()
 
         # send data if buffer size is bigger than threshold
-        while get_json_size_bytes(metric_buffer['buffer_dict']) >= agent_config_vars['metric_buffer_size'] and \
+        while metric_buffer['buffer_size'] >= agent_config_vars['metric_buffer_size'] and \
                 metric_buffer['buffer_ts_list']:
             (ts, key) = metric_buffer['buffer_ts_list'].pop()
             transpose_metrics(ts, key)
-            if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size']:
+            if track['current_row_size'] >= if_config_vars['chunk_size']:
                 logger.debug('Sending buffer chunk')
                 send_data_wrapper()
 
         # send data
-        if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size'] or (
+        if track['current_row_size'] >= if_config_vars['chunk_size'] or (
                 time.time() - track['start_time']) >= if_config_vars['run_interval']:
             send_data_wrapper()
         elif track['entry_count'] % 500 == 0:
             logger.debug('Buffer data object size: {} bytes'.format(
-                get_json_size_bytes(metric_buffer['buffer_dict'])))
+                metric_buffer['buffer_size']))
 
 
 def append_metric_data_to_buffer(timestamp, field_name, data, instance, device=''):
@@ -1376,14 +1611,27 @@ def append_metric_data_to_buffer(timestamp, field_name, data, instance, device='
     metric_str = make_safe_metric_key(field_name)
     metric_key = '{}[{}]'.format(metric_str, instance_str)
 
-    if key not in metric_buffer['buffer_key_list']:
+    if key not in metric_buffer['buffer_dict']:
         # add timestamp in buffer_ts_list and buffer_dict
         metric_buffer['buffer_key_list'].append(key)
         metric_buffer['buffer_ts_list'].append((timestamp, key))
         metric_buffer['buffer_ts_list'].sort(key=lambda elem: elem[0], reverse=True)
         metric_buffer['buffer_dict'][key] = dict()
+        # '"key": {}' plus the ', ' separator
+        metric_buffer['buffer_size_dict'][key] = get_json_size_bytes(key) + 6
+        metric_buffer['buffer_size'] += metric_buffer['buffer_size_dict'][key]
         metric_buffer['buffer_collected_dict'][key] = []
-    metric_buffer['buffer_dict'][key][metric_key] = str(data)
+    # keep a running estimate of the buffer size rather than re-serializing it
+    value = str(data)
+    value_size = get_json_size_bytes(value)
+    if metric_key in metric_buffer['buffer_dict'][key]:
+        value_size -= get_json_size_bytes(metric_buffer['buffer_dict'][key][metric_key])
+    else:
+        # '"key": ' plus the ', ' separator
+        value_size += get_json_size_bytes(metric_key) + 4
+    metric_buffer['buffer_dict'][key][metric_key] = value
+    metric_buffer['buffer_size_dict'][key] += value_size
+    metric_buffer['buffer_size'] += value_size
     metric_buffer['buffer_collected_dict'][key].append(metric_str)
 
     # if all metrics of ts_instance is collected, then send these data
@@ -1395,7 +1643,8 @@ def append_metric_data_to_buffer(timestamp, field_name, data, instance, device='
 
 def transpose_metrics(ts, key):
     metric_buffer['buffer_key_list'].remove(key)
-    track['current_row'].append(
+    metric_buffer['buffer_size'] -= metric_buffer['buffer_size_dict'].pop(key)
+    append_to_current_row(
         dict({'timestamp': str(ts)}, **metric_buffer['buffer_dict'].pop(key))
     )
 
@@ -1673,11 +1922,18 @@ if __name__ == "__main__":
     COMMA = regex.compile(r"\,")
     NON_ALNUM = regex.compile(r"[^a-zA-Z0-9]")
     FORMAT_STR = regex.compile(r"{(.*?)}")
+    MATH_EXPR_TOKENS = regex.compile(r"\s*(?:(\{.*?\})|(\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?)|([A-Za-z_]\w*)|(\S))")
+    MATH_EXPR_OPS = {'+': operator.add, '-': operator.sub, '*': operator.mul, '/': operator.div}
+    MATH_EXPR_FUNCTIONS = {'min': (min, 2, 255), 'max': (max, 2, 255), 'abs': (abs, 1, 1), 'round': (round, 1, 2)}
     HOSTNAME = socket.gethostname().partition('.')[0]
     ISO8601 = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S', '%Y%m%dT%H%M%SZ', 'epoch']
     JSON_LEVEL_DELIM = '.'
     CSV_DELIM = ','
     ATTEMPTS = 3
+    WORKER_COUNTERS = ['chunk_count', 'entry_count']
+    JSON_FIELD_GETTERS = dict()
+    FILTERS = dict()
+    MATH_EXPRS = dict()
     track = dict()
     metric_buffer = dict()
 
@@ -1688,16 +1944,16 @@ if __name__ == "__main__":
     agent_config_vars = get_agent_config_vars()
     print_summary_info()
 
-    # start data processing
+    # start data processing, each worker consuming its own share of the partitions
+    counter_queue = ProcessQueue()
     process_list = []
     for i in range(0, cli_config_vars['threads']):
         p = Process(target=initialize_data_gathering,
-                    args=(i,)
+                    args=(i, counter_queue)
                     )
         process_list.append(p)
 
     for p in process_list:
         p.start()
 
-    for p in process_list:
-        p.join()
+    merge_worker_counters(counter_queue, process_list)
@@ -1,4 +1,7 @@
 #!/usr/bin/env python
+import time
+# taken before the other imports so --profile-startup can report what they cost
+STARTUP_TIME = time.time()
 import ConfigParser
 import json
 import logging
@@ -6,20 +9,27 @@ import os
 import regex
 import socket
 import sys
-import time
-import pytz
-import arrow
+import calendar
+import random
+import zlib
+import gzip
+import heapq
+import math
+import bisect
+import operator
+import threading
+import Queue
 import urlparse
-import httplib
-import requests
-import statistics
 import subprocess
 import shlex
+import signal
 
-from datetime import datetime
-from decimal import Decimal
+from array import array
+from collections import OrderedDict
+from cStringIO import StringIO
+from datetime import datetime, timedelta
 from optparse import OptionParser
-from multiprocessing import Process
+from multiprocessing import Process, Queue as ProcessQueue
 
 """
 This script gathers data to send to Insightfinder
@@ -34,6 +44,8 @@ def start_data_processing(thread_number):
     0. Define the project type in config.ini
     1. Parse config options
     2. Gather data
+        Only gather this worker's share of the input, using
+        is_in_worker_partition() or get_worker_partition() with thread_number
     3. Parse each entry
     4. Call the appropriate handoff function
         metric_handoff()
@@ -62,6 +74,13 @@ def get_agent_config_vars():
             all_metrics = config_parser.get('agent', 'all_metrics')
             metric_buffer_size_mb = config_parser.get('agent', 'metric_buffer_size_mb') or '10'
 
+            # metric change suppression
+            suppression_heartbeat = get_optional_config(config_parser, 'agent', 'suppression_heartbeat') or '0'
+            suppression_tolerance = get_optional_config(config_parser, 'agent', 'suppression_tolerance') or '0'
+
+            # metric aggregation
+            metric_aggregates = get_optional_config(config_parser, 'agent', 'metric_aggregates')
+
             # filters
             filters_include = config_parser.get('agent', 'filters_include')
             filters_exclude = config_parser.get('agent', 'filters_exclude')
@@ -92,6 +111,7 @@ def get_agent_config_vars():
             config_error('timestamp_format')
 
         if timezone:
+            import pytz
             if timezone not in pytz.all_timezones:
                 config_error('timezone')
             else:
@@ -149,6 +169,14 @@ def get_agent_config_vars():
             filters_include = filters_include.split('|')
         if len(filters_exclude) != 0:
             filters_exclude = filters_exclude.split('|')
+        try:
+            FILTERS['include'] = compile_filters(filters_include)
+        except IndexError:
+            config_error('filters_include')
+        try:
+            FILTERS['exclude'] = compile_filters(filters_exclude)
+        except IndexError:
+            config_error('filters_exclude')
 
         # fields
         # project_fields = project_field.split(',')
@@ -170,15 +198,36 @@ def get_agent_config_vars():
                 if timestamp_field in data_fields:
                     data_fields.pop(data_fields.index(timestamp_field))
 
+        # compile field paths once, rather than splitting them for every message
+        compile_json_fields(instance_fields + device_fields + timestamp_fields + [json_top_level])
+        if len(data_fields) != 0:
+            compile_json_fields(data_fields)
+            try:
+                compile_math_exprs(data_fields)
+            except ValueError as e:
+                logger.error(e)
+                config_error('data_fields')
+
         # defaults
         if all_metrics:
-            all_metrics = filter(lambda x: x.strip(), all_metrics.split(','))
+            all_metrics = set(filter(lambda x: x.strip(), all_metrics.split(',')))
+
+        # metric aggregation
+        try:
+            metric_aggregates = parse_metric_aggregates(
+                filter(lambda x: x, [aggregate.strip().lower() for aggregate in metric_aggregates.split(',')]))
+        except ValueError as e:
+            logger.error(e)
+            config_error('metric_aggregates')
 
         # add parsed variables to a global
         config_vars = {
             'proxies': agent_proxies,
             'all_metrics': all_metrics,
             'metric_buffer_size': int(metric_buffer_size_mb) * 1024 * 1024,  # as bytes
+            'suppression_heartbeat': int(suppression_heartbeat),  # as sampling intervals
+            'suppression_tolerance': float(suppression_tolerance),  # as a fraction of the last value sent
+            'metric_aggregates': metric_aggregates,
             'filters_include': filters_include,
             'filters_exclude': filters_exclude,
             'data_format': data_format,
@@ -204,24 +253,40 @@ def get_agent_config_vars():
 #########################
 #   START_BOILERPLATE   #
 #########################
-def get_if_config_vars():
-    """ get config.ini vars """
+def get_if_config_vars(section='insightfinder'):
+    """ get config.ini vars, from [insightfinder] or an extra destination's section """
     config_ini = config_ini_path()
     if os.path.exists(config_ini):
         config_parser = ConfigParser.SafeConfigParser()
         config_parser.read(config_ini)
+        if section != 'insightfinder':
+            # extra destinations take the options they don't set from [insightfinder]
+            for option, value in config_parser.items('insightfinder', raw=True):
+                if not config_parser.has_option(section, option):
+                    config_parser.set(section, option, value)
         try:
-            user_name = config_parser.get('insightfinder', 'user_name')
-            license_key = config_parser.get('insightfinder', 'license_key')
-            token = config_parser.get('insightfinder', 'token')
-            project_name = config_parser.get('insightfinder', 'project_name')
-            project_type = config_parser.get('insightfinder', 'project_type').upper()
-            sampling_interval = config_parser.get('insightfinder', 'sampling_interval')
-            run_interval = config_parser.get('insightfinder', 'run_interval')
-            chunk_size_kb = config_parser.get('insightfinder', 'chunk_size_kb')
-            if_url = config_parser.get('insightfinder', 'if_url')
-            if_http_proxy = config_parser.get('insightfinder', 'if_http_proxy')
-            if_https_proxy = config_parser.get('insightfinder', 'if_https_proxy')
+            user_name = config_parser.get(section, 'user_name')
+            license_key = config_parser.get(section, 'license_key')
+            token = config_parser.get(section, 'token')
+            project_name = config_parser.get(section, 'project_name')
+            project_type = config_parser.get(section, 'project_type').upper()
+            sampling_interval = config_parser.get(section, 'sampling_interval')
+            run_interval = config_parser.get(section, 'run_interval')
+            run_jitter_seconds = get_optional_config(config_parser, section, 'run_jitter_seconds')
+            chunk_size_kb = get_optional_config(config_parser, section, 'chunk_size_kb')
+            min_chunk_size_kb = get_optional_config(config_parser, section, 'min_chunk_size_kb')
+            max_chunk_size_kb = get_optional_config(config_parser, section, 'max_chunk_size_kb')
+            max_in_flight_chunks = get_optional_config(config_parser, section, 'max_in_flight_chunks')
+            if_compression = get_optional_config(config_parser, section, 'if_compression').lower()
+            spool_dir = get_optional_config(config_parser, section, 'spool_dir')
+            spool_max_size_mb = get_optional_config(config_parser, section, 'spool_max_size_mb')
+            spool_replay_rate = get_optional_config(config_parser, section, 'spool_replay_rate')
+            telemetry_dir = get_optional_config(config_parser, section, 'telemetry_dir')
+            telemetry_interval_seconds = get_optional_config(config_parser, section, 'telemetry_interval_seconds')
+            telemetry_project = get_optional_config(config_parser, section, 'telemetry_project')
+            if_url = config_parser.get(section, 'if_url')
+            if_http_proxy = config_parser.get(section, 'if_http_proxy')
+            if_https_proxy = config_parser.get(section, 'if_https_proxy')
         except ConfigParser.NoOptionError as cp_noe:
             logger.error(cp_noe)
             config_error()
@@ -236,6 +301,9 @@ def get_if_config_vars():
         if len(project_type) == 0:
             config_error('project_type')
 
+        if if_compression not in {'', 'gzip', 'deflate'}:
+            config_error('if_compression')
+
         if project_type not in {
             'METRIC',
             'METRICREPLAY',
@@ -272,8 +340,28 @@ def get_if_config_vars():
             run_interval = int(run_interval) * 60
 
         # defaults
+        if len(run_jitter_seconds) == 0:
+            run_jitter_seconds = 0
         if len(chunk_size_kb) == 0:
             chunk_size_kb = 2048  # 2MB chunks by default
+        if len(max_chunk_size_kb) == 0:
+            max_chunk_size_kb = 0  # fixed chunk size by default
+        if len(min_chunk_size_kb) == 0:
+            min_chunk_size_kb = 64
+        if int(max_chunk_size_kb) and int(min_chunk_size_kb) > int(max_chunk_size_kb):
+            config_error('min_chunk_size_kb')
+        if len(max_in_flight_chunks) == 0:
+            max_in_flight_chunks = 0  # send inline by default
+        if len(spool_dir) != 0:
+            spool_dir = abs_path_from_cur(spool_dir)
+        if len(spool_max_size_mb) == 0:
+            spool_max_size_mb = 100
+        if len(spool_replay_rate) == 0:
+            spool_replay_rate = 1  # chunks per second
+        if len(telemetry_dir) != 0:
+            telemetry_dir = abs_path_from_cur(telemetry_dir)
+        if len(telemetry_interval_seconds) == 0:
+            telemetry_interval_seconds = 10
         if len(if_url) == 0:
             if_url = 'https://app.insightfinder.com'
 
@@ -292,10 +380,23 @@ def get_if_config_vars():
             'project_type': project_type,
             'sampling_interval': int(sampling_interval),  # as seconds
             'run_interval': int(run_interval),  # as seconds
+            'run_jitter': min(float(run_jitter_seconds), int(run_interval)),  # as seconds
             'chunk_size': int(chunk_size_kb) * 1024,  # as bytes
+            'min_chunk_size': int(min_chunk_size_kb) * 1024,  # as bytes
+            'max_chunk_size': int(max_chunk_size_kb) * 1024,  # as bytes
+            'max_in_flight_chunks': int(max_in_flight_chunks),
+            'if_compression': if_compression,
+            'spool_dir': spool_dir,
+            'spool_max_size': int(spool_max_size_mb) * 1024 * 1024,  # as bytes
+            'spool_replay_rate': float(spool_replay_rate),
+            'telemetry_dir': telemetry_dir,
+            'telemetry_interval': float(telemetry_interval_seconds),  # as seconds
+            'telemetry_project': telemetry_project,
             'if_url': if_url,
             'if_proxies': if_proxies,
-            'is_replay': is_replay
+            'is_replay': is_replay,
+            # the extra destination's name, so its state files are kept apart
+            'destination': section[len(DESTINATION_SECTION_PREFIX):] if section != 'insightfinder' else ''
         }
 
         return config_vars
@@ -337,11 +438,8 @@ def get_cli_config_vars():
     """ get CLI options. use of these options should be rare """
     usage = 'Usage: %prog [options]'
     parser = OptionParser(usage=usage)
-    """
-    ## not ready.
     parser.add_option('--threads', default=1, action='store', dest='threads',
-                      help='Number of threads to run')
-    """
+                      help='Number of worker processes to run, each handling its own share of the input')
     parser.add_option('-c', '--config', action='store', dest='config', default=abs_path_from_cur('config.ini'),
                       help='Path to the config file to use. Defaults to {}'.format(abs_path_from_cur('config.ini')))
     parser.add_option('-q', '--quiet', action='store_true', dest='quiet', default=False,
@@ -351,20 +449,31 @@ def get_cli_config_vars():
     parser.add_option('-t', '--testing', action='store_true', dest='testing', default=False,
                       help='Set to testing mode (do not send data).' +
                            ' Automatically turns on verbose logging')
+    parser.add_option('-d', '--daemon', action='store_true', dest='daemon', default=False,
+                      help='Stay resident and collect every run_interval instead of exiting after one run.' +
+                           ' Send SIGHUP to reload the config file')
+    parser.add_option('--profile-startup', action='store_true', dest='profile_startup', default=False,
+                      help='Log how long each startup stage took, and warn if startup is over budget')
+    parser.add_option('--profile', action='store_true', dest='profile', default=False,
+                      help='Profile each worker, writing a .pstats file and a memory report per worker process' +
+                           ' to --profile-dir')
+    parser.add_option('--profile-dir', action='store', dest='profile_dir', default=abs_path_from_cur('profile'),
+                      help='Directory to write --profile output to. Defaults to {}'.format(abs_path_from_cur('profile')))
     (options, args) = parser.parse_args()
 
-    """
-    # not ready
     try:
-        threads = int(options.threads)
+        threads = max(1, int(options.threads))
     except ValueError:
         threads = 1
-    """
 
     config_vars = {
         'config': options.config if os.path.isfile(options.config) else abs_path_from_cur('config.ini'),
-        'threads': 1,
+        'threads': threads,
         'testing': False,
+        'daemon': options.daemon,
+        'profile_startup': options.profile_startup,
+        'profile': options.profile,
+        'profile_dir': os.path.abspath(options.profile_dir),
         'log_level': logging.INFO
     }
 
@@ -379,6 +488,13 @@ def get_cli_config_vars():
     return config_vars
 
 
+def get_optional_config(config_parser, section, option, raw=False):
+    """ read an option that config.ini files from older versions may not have, as blank so its default applies """
+    if config_parser.has_option(section, option):
+        return config_parser.get(section, option, raw=raw)
+    return ''
+
+
 def config_error(setting=''):
     info = ' ({})'.format(setting) if setting else ''
     logger.error('Agent not correctly configured{}. Check config file.'.format(
@@ -480,6 +596,108 @@ def get_field_index(field_names, field, label, is_required=False):
             return field
 
 
+def compile_filters(filters):
+    """ compile field:value,value filters into one matcher per field, in the order fields first appear """
+    matchers = OrderedDict()
+    for _filter in filters:
+        filter_field = _filter.split(':')[0]
+        filter_vals = _filter.split(':')[1].split(',')
+        matcher = matchers.setdefault(filter_field, {'field': filter_field, 'values': []})
+        for filter_val in filter_vals:
+            if filter_val.upper() not in matcher['values']:
+                matcher['values'].append(filter_val.upper())
+    for matcher in matchers.values():
+        # values are matched as case-insensitive substrings; an exact match is just the cheapest case
+        matcher['exact'] = set(matcher['values'])
+        matcher['any'] = regex.compile(r'\L<values>', values=matcher['values'])
+        matcher['hits'] = dict.fromkeys(matcher['values'], 0)
+    return matchers.values()
+
+
+def get_filter_hit(matcher, filter_check):
+    """ a matcher's value that is in filter_check, or None """
+    filter_check = filter_check.upper()
+    if filter_check in matcher['exact']:
+        filter_val = filter_check
+    else:
+        match = matcher['any'].search(filter_check)
+        if match is None:
+            return None
+        filter_val = match.group()
+    matcher['hits'][filter_val] += 1
+    return filter_val
+
+
+def get_filter_reason(filters, get_filter_check):
+    """ 'include' or 'exclude' if a set of filters drops a message, otherwise None. get_filter_check gets a field """
+    if filters['include']:
+        # for each provided filter field, check if there are any allowed values
+        is_valid = False
+        filter_check = None
+        for matcher in filters['include']:
+            filter_check = get_filter_check(matcher['field'])
+            # check if a valid value
+            if get_filter_hit(matcher, filter_check) is not None:
+                is_valid = True
+                break
+        if not is_valid:
+            logger.debug('filtered message (inclusion): {} not in {}'.format(
+                filter_check, matcher['values']))
+            return 'include'
+        else:
+            logger.debug('passed filter (inclusion)')
+
+    if filters['exclude']:
+        # for each provided filter field, check if there are any disallowed values
+        for matcher in filters['exclude']:
+            filter_check = get_filter_check(matcher['field'])
+            # check if a valid value
+            filter_val = get_filter_hit(matcher, filter_check)
+            if filter_val is not None:
+                logger.debug('filtered message (exclusion): {} in {}'.format(
+                    filter_val, filter_check))
+                return 'exclude'
+        logger.debug('passed filter (exclusion)')
+    return None
+
+
+def route_message(get_filter_check):
+    """
+    whether any destination takes a message. with extra destinations, notes which of them do for fan_out,
+    until end_route is called after the message's handoffs
+    """
+    filter_reason = get_filter_reason(FILTERS, get_filter_check)
+    if fanout:
+        fanout['to_primary'] = filter_reason is None
+        fanout['targets'] = [destination for destination in fanout['destinations']
+                             if get_filter_reason(destination['filters'], get_filter_check) is None]
+        if fanout['targets']:
+            return True
+    if filter_reason is not None:
+        count_telemetry('messages_filtered_total', labels=(('filter', filter_reason),))
+        # nothing will be handed off
+        end_route()
+        return False
+    return True
+
+
+def end_route():
+    """ the routed message has been handed off, so later handoffs that aren't routed go to every destination """
+    if fanout:
+        fanout['targets'] = fanout['destinations']
+        fanout['to_primary'] = True
+
+
+def get_filter_hits():
+    """ hits per filter rule, as '<include|exclude> <field>:<value>' """
+    filter_hits = dict()
+    for setting in ('include', 'exclude'):
+        for matcher in FILTERS.get(setting, []):
+            for filter_val, hits in matcher['hits'].items():
+                filter_hits['{} {}:{}'.format(setting, matcher['field'], filter_val)] = hits
+    return filter_hits
+
+
 def should_include_per_config(setting, value):
     """ determine if an agent config filter setting would exclude a given value """
     return len(agent_config_vars[setting]) != 0 and value not in agent_config_vars[setting]
@@ -495,6 +713,17 @@ def get_json_size_bytes(json_data):
     return len(bytearray(json.dumps(json_data)))
 
 
+def append_to_current_row(entry):
+    """ add an entry to the current chunk, keeping a running total of its serialized size """
+    previous_stage = switch_telemetry_stage('assemble')
+    if len(track['current_row']) != 0:
+        # json.dumps separates list items with ', '
+        track['current_row_size'] += 2
+    track['current_row'].append(entry)
+    track['current_row_size'] += get_json_size_bytes(entry)
+    switch_telemetry_stage(previous_stage)
+
+
 def get_all_files(files, file_regex_c):
     return [i for j in
             map(lambda k:
@@ -519,6 +748,7 @@ def get_file_list_for_directory(root_path='/', file_name_regex_c=''):
 
 
 def parse_raw_line(message, line):
+    count_telemetry('lines_read_total')
     # if multiline
     if agent_config_vars['raw_start_regex']:
         # if new message, parse old and start new
@@ -568,6 +798,15 @@ def is_named_data_field(setting_value):
     return '::' in setting_value
 
 
+def compile_math_exprs(setting_values):
+    """ compile the evaluators for the arithmetic expressions in a list of data fields """
+    for setting_value in setting_values:
+        if is_named_data_field(setting_value):
+            value = setting_value.split('::')[1]
+            if is_math_expr(value) and is_formatted(get_math_expr(value)):
+                get_math_expr_evaluator(get_math_expr(value))
+
+
 def merge_data(field, value, data=None):
     if data is None:
         data = {}
@@ -619,17 +858,24 @@ def get_data_value(message, setting_value):
                                 allow_list=False,
                                 remove=False)
         # check if math
-        evaluate = False
-        if is_math_expr(value):
-            evaluate = True
-            value = get_math_expr(value)
-        value = get_single_value(message,
-                                 value,
-                                 default=0 if evaluate else '',
-                                 allow_list=not evaluate,
-                                 remove=False)
-        if value and evaluate:
-            value = eval(value)
+        if is_math_expr(value) and is_formatted(get_math_expr(value)):
+            value = evaluate_math_expr(message, get_math_expr(value))
+        elif is_math_expr(value):
+            # the expression is a single field (or complex value) holding a number
+            value = get_single_value(message,
+                                     get_math_expr(value),
+                                     default=0,
+                                     allow_list=False,
+                                     remove=False)
+            if value:
+                number = parse_math_number(value)
+                value = '' if number is None else number
+        else:
+            value = get_single_value(message,
+                                     value,
+                                     default='',
+                                     allow_list=True,
+                                     remove=False)
     elif is_complex(setting_value):
         this_field, metadata, that_field = setting_value.split('!!')
         name = this_field
@@ -650,6 +896,134 @@ def get_data_value(message, setting_value):
     return name, value
 
 
+def parse_math_number(value):
+    """ parse a field value or literal as an int or float; returns None if it is not a number """
+    if isinstance(value, (int, long, float)):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+
+def get_math_expr_evaluator(expr):
+    """ get the compiled evaluator for an arithmetic expression, compiling it on first use """
+    evaluate = MATH_EXPRS.get(expr)
+    if evaluate is None:
+        evaluate = compile_math_expr(expr)
+        MATH_EXPRS[expr] = evaluate
+    return evaluate
+
+
+def evaluate_math_expr(message, expr, default=''):
+    """ evaluate an arithmetic expression against a message """
+    try:
+        return get_math_expr_evaluator(expr)(message)
+    except (ValueError, ArithmeticError) as e:
+        logger.debug('cannot evaluate {}: {}'.format(expr, e))
+        return default
+
+
+def compile_math_expr(expr):
+    """
+    Compile an arithmetic expression into a function of the message.
+    Supports {field} references, numeric literals, + - * /, parentheses,
+    and the functions in MATH_EXPR_FUNCTIONS. Raises ValueError on anything else.
+    """
+    tokens = MATH_EXPR_TOKENS.findall(expr)
+    evaluate, pos = _compile_math_sum(tokens, 0, expr)
+    if pos != len(tokens):
+        raise _math_expr_error(tokens, pos, expr)
+    return evaluate
+
+
+def _get_math_token(tokens, pos):
+    return tokens[pos] if pos < len(tokens) else ('', '', '', '')
+
+
+def _math_expr_error(tokens, pos, expr):
+    token = ''.join(_get_math_token(tokens, pos)) or 'end of expression'
+    return ValueError('unexpected {} in expression {}'.format(token, expr))
+
+
+def _compile_math_sum(tokens, pos, expr):
+    left, pos = _compile_math_product(tokens, pos, expr)
+    while _get_math_token(tokens, pos)[3] in ('+', '-'):
+        right, next_pos = _compile_math_product(tokens, pos + 1, expr)
+        left = _bind_math_op(MATH_EXPR_OPS[tokens[pos][3]], left, right)
+        pos = next_pos
+    return left, pos
+
+
+def _compile_math_product(tokens, pos, expr):
+    left, pos = _compile_math_factor(tokens, pos, expr)
+    while _get_math_token(tokens, pos)[3] in ('*', '/'):
+        right, next_pos = _compile_math_factor(tokens, pos + 1, expr)
+        left = _bind_math_op(MATH_EXPR_OPS[tokens[pos][3]], left, right)
+        pos = next_pos
+    return left, pos
+
+
+def _compile_math_factor(tokens, pos, expr):
+    field, number, name, op = _get_math_token(tokens, pos)
+    if op in ('+', '-'):
+        operand, pos = _compile_math_factor(tokens, pos + 1, expr)
+        return (_bind_math_func(operator.neg, [operand]) if op == '-' else operand), pos
+    elif field:
+        return _bind_math_field(field[1:-1]), pos + 1
+    elif number:
+        value = parse_math_number(number)
+        return (lambda message: value), pos + 1
+    elif name in MATH_EXPR_FUNCTIONS:
+        func, min_args, max_args = MATH_EXPR_FUNCTIONS[name]
+        if _get_math_token(tokens, pos + 1)[3] != '(':
+            raise _math_expr_error(tokens, pos + 1, expr)
+        args = []
+        pos += 2
+        while True:
+            arg, pos = _compile_math_sum(tokens, pos, expr)
+            args.append(arg)
+            if _get_math_token(tokens, pos)[3] != ',':
+                break
+            pos += 1
+        if _get_math_token(tokens, pos)[3] != ')':
+            raise _math_expr_error(tokens, pos, expr)
+        if not min_args <= len(args) <= max_args:
+            raise ValueError('{} takes {} to {} arguments in expression {}'.format(name, min_args, max_args, expr))
+        return _bind_math_func(func, args), pos + 1
+    elif op == '(':
+        inner, pos = _compile_math_sum(tokens, pos + 1, expr)
+        if _get_math_token(tokens, pos)[3] != ')':
+            raise _math_expr_error(tokens, pos, expr)
+        return inner, pos + 1
+    raise _math_expr_error(tokens, pos, expr)
+
+
+def _bind_math_op(op, left, right):
+    return lambda message: op(left(message), right(message))
+
+
+def _bind_math_func(func, args):
+    return lambda message: func(*[arg(message) for arg in args])
+
+
+def _bind_math_field(field):
+    getter = get_json_field_getter(field)
+
+    def evaluate(message):
+        # same stringified value a format string would see; missing fields count as 0
+        value = json_format_field_value(getter(message, allow_list=False))
+        value = parse_math_number(value) if len(value) != 0 else 0
+        if value is None:
+            raise ValueError('{} is not a number'.format(field))
+        return value
+
+    return evaluate
+
+
 def get_complex_value(message, this_field, metadata, that_field, default='', allow_list=False, remove=False):
     metadata = metadata.split('&')
     data_type, data_return = metadata[0].upper().split('=')
@@ -683,6 +1057,7 @@ def get_complex_value(message, this_field, metadata, that_field, default='', all
         elif data_return == 'CSV':
             data = label_message(agent_config_vars['csv_field_delimiter'].split(data))
         elif data_return == 'XML':
+            import xml2dict
             data = xml2dict.parse(data)
         elif data_return == 'JSON':
             data = json.loads(data)
@@ -750,9 +1125,8 @@ def get_json_field_by_pri(message, pri_list, default='', allow_list=False, remov
 
 def get_json_field(message, setting_value, default='', allow_list=False, remove=False):
     field_val = json_format_field_value(
-        _get_json_field_helper(
+        get_json_field_getter(setting_value)(
             message,
-            setting_value.split(JSON_LEVEL_DELIM),
             allow_list=allow_list,
             remove=remove))
     if len(field_val) == 0:
@@ -760,58 +1134,88 @@ def get_json_field(message, setting_value, default='', allow_list=False, remove=
     return field_val
 
 
-class ListNotAllowedError():
+def get_json_field_getter(setting_value):
+    """ get the compiled getter for a field path, compiling it on first use """
+    getter = JSON_FIELD_GETTERS.get(setting_value)
+    if getter is None:
+        getter = compile_json_field(setting_value)
+        JSON_FIELD_GETTERS[setting_value] = getter
+    return getter
+
+
+def compile_json_fields(setting_values):
+    """ compile the getters for a list of configured field paths """
+    for setting_value in setting_values:
+        if setting_value and not (is_formatted(setting_value) or is_complex(setting_value) or
+                                  is_named_data_field(setting_value)):
+            get_json_field_getter(setting_value)
+
+
+def compile_json_field(setting_value):
+    """
+    Compile a JSON_LEVEL_DELIM-delimited field path into a reusable getter.
+    The getter walks the message in place, without copying it.
+    """
+    fields = tuple(setting_value.split(JSON_LEVEL_DELIM))
+
+    def getter(message, allow_list=False, remove=False):
+        return _get_json_field_helper(message, fields, 0, allow_list=allow_list, remove=remove)
+
+    return getter
+
+
+class ListNotAllowedError(Exception):
     pass
 
 
-def _get_json_field_helper(nested_value, next_fields, allow_list=False, remove=False):
-    # check inputs; need a dict that is a subtree, an _array_ of fields to traverse down
-    if len(next_fields) == 0:
+def _get_json_field_helper(nested_value, fields, index, allow_list=False, remove=False, in_message=True):
+    # check inputs; need a dict that is a subtree, and a tuple of fields to traverse down
+    if index == len(fields):
         # nothing to look for
         return ''
     elif isinstance(nested_value, (list, set, tuple)):
         # for each elem in the list
         # already checked in the recursive call that this is OK
-        return json_gather_list_values(nested_value, next_fields)
+        return json_gather_list_values(nested_value, fields, index)
     elif not isinstance(nested_value, dict):
         # nothing to walk down
         return ''
 
     # get the next value
-    next_field = next_fields.pop(0)
+    next_field = fields[index]
+    index += 1
     next_value = nested_value.get(next_field)
     if isinstance(next_value, datetime):
+        import arrow
         next_value = int(arrow.get(next_value).float_timestamp * 1000)
-    if isinstance(next_value, Decimal):
+    # only something that imported decimal can have made a Decimal, so don't import it for this
+    decimal = sys.modules.get('decimal')
+    if decimal and isinstance(next_value, decimal.Decimal):
         next_value = str(next_value)
 
-    try:
-        if len(next_fields) == 0 and remove:
-            # last field to grab, so remove it
-            nested_value.pop(next_field)
-    except:
-        pass
+    # only fields that hang directly off the message are removed
+    if index == len(fields) and remove and in_message:
+        # last field to grab, so remove it
+        nested_value.pop(next_field, None)
 
     # check the next value
-    if next_value is None or not str(next_value):
+    if next_value is None or (isinstance(next_value, basestring) and len(next_value) == 0):
         # no next value defined
         return ''
 
     # sometimes payloads come in formatted
-    try:
-        next_value = json.loads(next_value)
-    except:
-        pass
+    if isinstance(next_value, basestring):
+        try:
+            next_value = json.loads(next_value)
+        except ValueError:
+            pass
 
     # handle simple lists
     while isinstance(next_value, (list, set, tuple)) and len(next_value) == 1:
-        next_value = next_value.pop()
+        next_value = next(iter(next_value))
 
     # continue traversing?
-    if next_fields is None:
-        # some error, but return the value
-        return next_value
-    elif len(next_fields) == 0:
+    if index == len(fields):
         # final value in the list to walk down
         return next_value
     elif isinstance(next_value, (list, set, tuple)):
@@ -819,33 +1223,38 @@ def _get_json_field_helper(nested_value, next_fields, allow_list=False, remove=F
         if allow_list:
             return json_gather_list_values(
                 next_value,
-                next_fields,
+                fields,
+                index,
                 remove=remove)
         else:
             raise ListNotAllowedError('encountered list or set in json when not allowed')
     elif isinstance(next_value, dict):
         # there's more tree to walk down
         return _get_json_field_helper(
-            json.loads(json.dumps(next_value)),
-            next_fields,
+            next_value,
+            fields,
+            index,
             allow_list=allow_list,
-            remove=remove)
+            remove=remove,
+            in_message=False)
     else:
         # catch-all
         return ''
 
 
-def json_gather_list_values(values, fields, remove=False):
+def json_gather_list_values(values, fields, index, remove=False):
     sub_field_value = []
     # treat each item in the list as a potential tree to walk down
+    # the items are only read, as removing fields from them would change the caller's message
     for sub_value in values:
-        fields_copy = list(fields[i] for i in range(len(fields)))
         json_value = json_format_field_value(
             _get_json_field_helper(
                 sub_value,
-                fields_copy,
+                fields,
+                index,
                 allow_list=True,
-                remove=remove))
+                remove=remove,
+                in_message=False))
         if len(json_value) != 0:
             sub_field_value.append(json_value)
     # return the full list of field values
@@ -874,118 +1283,87 @@ def parse_json_message(messages):
         for message in messages:
             parse_json_message(message)
     else:
-        if len(agent_config_vars['json_top_level']) == 0:
-            parse_json_message_single(messages)
-        else:
-            top_level = _get_json_field_helper(
-                messages,
-                agent_config_vars['json_top_level'].split(JSON_LEVEL_DELIM),
-                allow_list=True)
-            if isinstance(top_level, (list, set, tuple)):
-                for message in top_level:
-                    parse_json_message_single(message)
+        count_telemetry('messages_received_total')
+        previous_stage = switch_telemetry_stage('parse')
+        try:
+            if len(agent_config_vars['json_top_level']) == 0:
+                parse_json_message_single(messages)
             else:
-                parse_json_message_single(top_level)
+                top_level = get_json_field_getter(agent_config_vars['json_top_level'])(
+                    messages,
+                    allow_list=True)
+                if isinstance(top_level, (list, set, tuple)):
+                    for message in top_level:
+                        parse_json_message_single(message)
+                else:
+                    parse_json_message_single(top_level)
+        finally:
+            switch_telemetry_stage(previous_stage)
 
 
 def parse_json_message_single(message):
     # message = json.loads(json.dumps(message))
     # filter
-    if len(agent_config_vars['filters_include']) != 0:
-        # for each provided filter
-        is_valid = False
-        for _filter in agent_config_vars['filters_include']:
-            filter_field = _filter.split(':')[0]
-            filter_vals = _filter.split(':')[1].split(',')
-            filter_check = get_json_field(
-                message,
-                filter_field,
-                allow_list=True)
-            # check if a valid value
-            for filter_val in filter_vals:
-                if filter_val.upper() in filter_check.upper():
-                    is_valid = True
-                    break
-            if is_valid:
-                break
-        if not is_valid:
-            logger.debug('filtered message (inclusion): {} not in {}'.format(
-                filter_check, filter_vals))
-            return
-        else:
-            logger.debug('passed filter (inclusion)')
-
-    if len(agent_config_vars['filters_exclude']) != 0:
-        # for each provided filter
-        for _filter in agent_config_vars['filters_exclude']:
-            filter_field = _filter.split(':')[0]
-            filter_vals = _filter.split(':')[1].split(',')
-            filter_check = get_json_field(
-                message,
-                filter_field,
-                allow_list=True)
-            # check if a valid value
-            for filter_val in filter_vals:
-                if filter_val.upper() in filter_check.upper():
-                    logger.debug('filtered message (exclusion): {} in {}'.format(
-                        filter_val, filter_check))
-                    return
-        logger.debug('passed filter (exclusion)')
+    if not route_message(lambda field: get_json_field(message, field, allow_list=True)):
+        return
 
-    # get project, instance, & device
-    # check_project(get_setting_value(message,
-    #                                'project_field',
-    #                                default=if_config_vars['project_name']),
-    #                                remove=True)
-    instance = get_setting_value(message,
-                                 'instance_field',
-                                 default=HOSTNAME,
-                                 remove=True)
-    logger.debug(instance)
-    device = get_setting_value(message,
-                               'device_field',
-                               remove=True)
-    # get timestamp
     try:
-        timestamp = get_setting_value(message,
-                                      'timestamp_field',
-                                      remove=True)
-        timestamp = [timestamp]
-    except ListNotAllowedError as e:
-        logger.debug(e)
-        timestamp = get_setting_value(message,
-                                      'timestamp_field',
-                                      remove=True,
-                                      allow_list=True)
-    except Exception as e:
-        logger.warn(e)
-        sys.exit(1)
-    logger.debug(timestamp)
-
-    # get data
-    data = get_data_values(timestamp, message)
-
-    # hand off
-    for timestamp, report_data in data.items():
-        # check if this is within the time range
-        ts = get_timestamp_from_date_string(timestamp)
-        if not ts:
-            continue
-        if not if_config_vars['is_replay'] and long((time.time() - if_config_vars['run_interval']) * 1000) > ts:
-            logger.debug('skipping message with timestamp {}'.format(ts))
-            continue
-        if 'METRIC' in if_config_vars['project_type']:
-            data_folded = fold_up(report_data, value_tree=True)  # put metric data in top level
-            for data_field, data_value in data_folded.items():
-                if data_value is not None:
-                    metric_handoff(
-                        ts,
-                        data_field,
-                        data_value,
-                        instance,
-                        device)
-        else:
-            log_handoff(ts, report_data, instance, device)
+        # get project, instance, & device
+        # check_project(get_setting_value(message,
+        #                                'project_field',
+        #                                default=if_config_vars['project_name']),
+        #                                remove=True)
+        instance = get_setting_value(message,
+                                     'instance_field',
+                                     default=HOSTNAME,
+                                     remove=True)
+        logger.debug(instance)
+        device = get_setting_value(message,
+                                   'device_field',
+                                   remove=True)
+        # get timestamp
+        try:
+            timestamp = get_setting_value(message,
+                                          'timestamp_field',
+                                          remove=True)
+            timestamp = [timestamp]
+        except ListNotAllowedError as e:
+            logger.debug(e)
+            timestamp = get_setting_value(message,
+                                          'timestamp_field',
+                                          remove=True,
+                                          allow_list=True)
+        except Exception as e:
+            logger.warn(e)
+            sys.exit(1)
+        logger.debug(timestamp)
+
+        # get data
+        data = get_data_values(timestamp, message)
+
+        # hand off
+        for timestamp, report_data in data.items():
+            # check if this is within the time range
+            ts = get_timestamp_from_date_string(timestamp)
+            if not ts:
+                continue
+            if not if_config_vars['is_replay'] and long((time.time() - if_config_vars['run_interval']) * 1000) > ts:
+                logger.debug('skipping message with timestamp {}'.format(ts))
+                continue
+            if 'METRIC' in if_config_vars['project_type']:
+                data_folded = fold_up(report_data, value_tree=True)  # put metric data in top level
+                for data_field, data_value in data_folded.items():
+                    if data_value is not None:
+                        metric_handoff(
+                            ts,
+                            data_field,
+                            data_value,
+                            instance,
+                            device)
+            else:
+                log_handoff(ts, report_data, instance, device)
+    finally:
+        end_route()
 
 
 def label_message(message, fields=None):
@@ -1005,63 +1383,33 @@ def minlen(one, two):
 
 
 def parse_csv_message(message):
+    count_telemetry('messages_received_total')
     # filter
-    if len(agent_config_vars['filters_include']) != 0:
-        # for each provided filter, check if there are any allowed valued
-        is_valid = False
-        filter_check = None
-        filter_vals = None
-        for _filter in agent_config_vars['filters_include']:
-            filter_field = _filter.split(':')[0]
-            filter_vals = _filter.split(':')[1].split(',')
-            filter_check = message[int(filter_field)]
-            # check if a valid value
-            for filter_val in filter_vals:
-                if filter_val.upper() in filter_check.upper():
-                    is_valid = True
-                    break
-            if is_valid:
-                break
-        if not is_valid:
-            logger.debug('filtered message (inclusion): {} not in {}'.format(
-                filter_check, filter_vals))
-            return
-        else:
-            logger.debug('passed filter (inclusion)')
-
-    if len(agent_config_vars['filters_exclude']) != 0:
-        # for each provided filter, check if there are any disallowed values
-        for _filter in agent_config_vars['filters_exclude']:
-            filter_field = _filter.split(':')[0]
-            filter_vals = _filter.split(':')[1].split(',')
-            filter_check = message[int(filter_field)]
-            # check if a valid value
-            for filter_val in filter_vals:
-                if filter_val.upper() in filter_check.upper():
-                    logger.debug('filtered message (exclusion): {} in {}'.format(
-                        filter_check, filter_val))
-                    return
-        logger.debug('passed filter (exclusion)')
-
-    # project
-    # if isinstance(agent_config_vars['project_field'], int):
-    #    check_project(message[agent_config_vars['project_field']])
-
-    # instance
-    instance = HOSTNAME
-    if isinstance(agent_config_vars['instance_field'], int):
-        instance = message[agent_config_vars['instance_field']]
-
-    # device
-    device = ''
-    if isinstance(agent_config_vars['device_field'], int):
-        device = message[agent_config_vars['device_field']]
+    if not route_message(lambda field: message[int(field)]):
+        return
 
-    # data & timestamp
-    columns = [agent_config_vars['timestamp_field']] + agent_config_vars['data_fields']
-    row = list(message[i] for i in columns)
-    fields = list(agent_config_vars['csv_field_names'][j] for j in agent_config_vars['data_fields'])
-    parse_csv_row(row, fields, instance, device)
+    try:
+        # project
+        # if isinstance(agent_config_vars['project_field'], int):
+        #    check_project(message[agent_config_vars['project_field']])
+
+        # instance
+        instance = HOSTNAME
+        if isinstance(agent_config_vars['instance_field'], int):
+            instance = message[agent_config_vars['instance_field']]
+
+        # device
+        device = ''
+        if isinstance(agent_config_vars['device_field'], int):
+            device = message[agent_config_vars['device_field']]
+
+        # data & timestamp
+        columns = [agent_config_vars['timestamp_field']] + agent_config_vars['data_fields']
+        row = list(message[i] for i in columns)
+        fields = list(agent_config_vars['csv_field_names'][j] for j in agent_config_vars['data_fields'])
+        parse_csv_row(row, fields, instance, device)
+    finally:
+        end_route()
 
 
 def parse_csv_data(csv_data, instance, device=''):
@@ -1096,48 +1444,192 @@ def parse_csv_row(row, field_names, instance, device=''):
 
 def get_timestamp_from_date_string(date_string):
     """ parse a date string into unix epoch (ms) """
-    datetime_obj = None
     epoch = None
     if 'timestamp_format' in agent_config_vars:
-        for timestamp_format in agent_config_vars['timestamp_format']:
+        timestamp_formats = agent_config_vars['timestamp_format']
+        for i, timestamp_format in enumerate(timestamp_formats):
             try:
-                if timestamp_format == 'epoch':
-                    if 13 <= len(date_string) < 15:
-                        timestamp = int(date_string) / 1000
-                        datetime_obj = arrow.get(time.gmtime(timestamp))
-                    elif 9 <= len(date_string) < 13:
-                        timestamp = int(date_string)
-                        datetime_obj = arrow.get(time.gmtime(timestamp))
-                    else:
-                        raise
-                else:
-                    if agent_config_vars['timezone']:
-                        datetime_obj = arrow.get(date_string, timestamp_format,
-                                                 tzinfo=agent_config_vars['timezone'].zone)
-                    else:
-                        datetime_obj = arrow.get(date_string, timestamp_format)
-                break
+                epoch = get_timestamp_parser(timestamp_format)(date_string)
             except Exception as e:
                 logger.debug(e)
                 logger.debug('timestamp {} does not match {}'.format(date_string, timestamp_format))
                 continue
+            if i != 0 and timestamp_format != 'epoch':
+                # pin the matching format so it is tried first from now on.
+                # epoch is left in place, as it would take numeric timestamps meant for the formats before it
+                timestamp_formats.insert(0, timestamp_formats.pop(i))
+            break
     else:
+        import arrow
         try:
             if agent_config_vars['timezone']:
                 datetime_obj = arrow.get(date_string, tzinfo=agent_config_vars['timezone'].zone)
             else:
                 datetime_obj = arrow.get(date_string)
+            epoch = int(datetime_obj.float_timestamp * 1000)
         except Exception as e:
             logger.debug(e)
             logger.error('timestamp {} can not parse'.format(date_string))
 
-    # get epoch (misc)
-    if datetime_obj:
-        epoch = int(datetime_obj.float_timestamp * 1000)
-
     return epoch
 
 
+def get_timestamp_parser(timestamp_format):
+    """ get the (memoized) parser for a timestamp format """
+    parser = TIMESTAMP_PARSERS.get(timestamp_format)
+    if parser is None:
+        parser = compile_timestamp_parser(timestamp_format)
+        TIMESTAMP_PARSERS[timestamp_format] = parser
+    return parser
+
+
+def compile_timestamp_parser(timestamp_format):
+    """ returns a function that parses a date string in the given format into unix epoch (ms) """
+    if timestamp_format == 'epoch':
+        return parse_epoch_timestamp
+
+    fixed_layout = compile_fixed_layout(timestamp_format)
+    if fixed_layout is None:
+        return lambda date_string: parse_timestamp_with_arrow(date_string, timestamp_format)
+
+    layout_c, layout_search_c, tokens = fixed_layout
+    tzinfo = None
+    if agent_config_vars['timezone']:
+        # resolved the same way arrow resolves tzinfo=<zone name>
+        import arrow
+        tzinfo = arrow.parser.TzinfoParser.parse(agent_config_vars['timezone'].zone)
+
+    def parse_fixed_layout(date_string):
+        match = layout_c.match(date_string)
+        if not match:
+            # arrow looks for the same layout anywhere in the string, ignoring case
+            if not layout_search_c.search(date_string):
+                raise ValueError('{} does not match {}'.format(date_string, timestamp_format))
+            return parse_timestamp_with_arrow(date_string, timestamp_format)
+        parts = dict(zip(tokens, match.groups()))
+        fields = [int(parts.get('YYYY', 1)),
+                  int(parts.get('MM', 1)),
+                  int(parts.get('DD', 1)),
+                  int(parts.get('HH', 0)),
+                  int(parts.get('mm', 0)),
+                  int(parts.get('ss', 0))]
+        microsecond = get_microsecond(parts['S']) if 'S' in parts else 0
+        increment = None
+        if fields[3] == 24:
+            # arrow reads 24:00:00 as midnight at the end of the day
+            if fields[4] or fields[5] or microsecond:
+                raise ValueError('{} is past midnight'.format(date_string))
+            fields[3] = 0
+            increment = timedelta(days=1)
+        elif microsecond == 1000000:
+            # the fraction rounded up to a whole second
+            microsecond = 0
+            increment = timedelta(seconds=1)
+        # validates the fields as arrow would
+        local_time = datetime(*fields, microsecond=microsecond)
+        if increment:
+            fields = (local_time + increment).timetuple()[:6]
+        seconds = calendar.timegm(fields)
+        if tzinfo:
+            # a configured timezone overrides any offset in the string
+            seconds -= get_utc_offset_seconds(tzinfo, *fields)
+        elif 'Z' in parts:
+            seconds -= get_tz_offset_seconds(parts['Z'])
+        return int((seconds + float(microsecond) / 1000000) * 1000)
+
+    return parse_fixed_layout
+
+
+def compile_fixed_layout(timestamp_format):
+    """ compile an arrow format made only of fixed-width numeric fields into regexes, or None """
+    layout = ''
+    tokens = []
+    for i, part in enumerate(TIMESTAMP_TOKENS.split(timestamp_format)):
+        if i % 2 == 0:
+            # literal text between tokens
+            layout += regex.escape(part)
+            continue
+        if part.startswith('['):
+            layout += regex.escape(part[1:-1])
+            continue
+        token = 'S' if part.startswith('S') else part
+        if token == 'ZZ':
+            token, pattern = 'Z', r'(Z|[\+\-]\d{2}(?:\:\d{2})?)'
+        elif token == 'Z':
+            pattern = r'(Z|[\+\-]\d{2}(?:\d{2})?)'
+        elif token == 'S':
+            pattern = r'(\d+)'
+        elif token == 'YYYY':
+            pattern = r'(\d{4})'
+        elif token in {'MM', 'DD', 'HH', 'mm', 'ss'}:
+            pattern = r'(\d{2})'
+        else:
+            return None
+        if token in tokens:
+            return None
+        tokens.append(token)
+        layout += pattern
+    return regex.compile('^' + layout + '$'), regex.compile(layout, regex.IGNORECASE), tokens
+
+
+def get_microsecond(fraction):
+    """ fractional seconds to microseconds, rounding the 7th digit half-to-even like arrow """
+    fraction = fraction.ljust(7, '0')
+    seventh_digit = int(fraction[6])
+    if seventh_digit == 5:
+        rounding = int(fraction[5]) % 2
+    elif seventh_digit > 5:
+        rounding = 1
+    else:
+        rounding = 0
+    return int(fraction[:6]) + rounding
+
+
+def get_tz_offset_seconds(tz_string):
+    """ seconds east of UTC for 'Z', '+HH', '+HHMM' or '+HH:MM' """
+    if tz_string == 'Z':
+        return 0
+    seconds = int(tz_string[1:3]) * 3600 + int(tz_string[-2:] if len(tz_string) > 3 else 0) * 60
+    return -seconds if tz_string[0] == '-' else seconds
+
+
+def get_utc_offset_seconds(tzinfo, year, month, day, hour, minute, second):
+    """ seconds east of UTC for a local time in the configured timezone, cached per local hour """
+    key = (year, month, day, hour)
+    offset = UTC_OFFSETS.get(key)
+    if offset is None:
+        offset = tzinfo.utcoffset(datetime(year, month, day, hour, tzinfo=tzinfo))
+        if offset != tzinfo.utcoffset(datetime(year, month, day, hour, 59, 59, 999999, tzinfo=tzinfo)):
+            # the offset changes within this hour, so look up this exact time
+            offset = tzinfo.utcoffset(datetime(year, month, day, hour, minute, second, tzinfo=tzinfo))
+            return int(offset.total_seconds())
+        offset = int(offset.total_seconds())
+        UTC_OFFSETS[key] = offset
+    return offset
+
+
+def parse_epoch_timestamp(date_string):
+    """ unix epoch in seconds or ms into unix epoch (ms), at second precision """
+    if 13 <= len(date_string) < 15:
+        return int(date_string) / 1000 * 1000
+    elif 9 <= len(date_string) < 13:
+        seconds = int(date_string)
+        if not MIN_EPOCH_SECONDS <= seconds <= MAX_EPOCH_SECONDS:
+            raise ValueError('{} is out of range'.format(date_string))
+        return seconds * 1000
+    raise ValueError('{} is not a unix epoch'.format(date_string))
+
+
+def parse_timestamp_with_arrow(date_string, timestamp_format):
+    import arrow
+    if agent_config_vars['timezone']:
+        datetime_obj = arrow.get(date_string, timestamp_format,
+                                 tzinfo=agent_config_vars['timezone'].zone)
+    else:
+        datetime_obj = arrow.get(date_string, timestamp_format)
+    return int(datetime_obj.float_timestamp * 1000)
+
+
 def make_safe_instance_string(instance, device=''):
     """ make a safe instance name string, concatenated with device if appropriate """
     # strip underscores
@@ -1157,6 +1649,14 @@ def make_safe_metric_key(metric):
     return metric
 
 
+def get_state_file_name(thread_number):
+    """ <project>-<worker> for a worker's state files, or <project>@<destination>-<worker> for an extra destination """
+    name = make_safe_string(if_config_vars['project_name'])
+    if if_config_vars['destination']:
+        name = '{}@{}'.format(name, make_safe_string(if_config_vars['destination']))
+    return '{}-{}'.format(name, thread_number)
+
+
 def make_safe_string(string):
     """
     Take a single string and return the same string with spaces, slashes,
@@ -1239,6 +1739,13 @@ def print_summary_info():
         post_data_block += '\n\t{}: {}'.format(ik, iv)
     logger.debug(post_data_block)
 
+    # extra destinations
+    for destination in destinations:
+        destination_block = '\n{}{} settings:'.format(DESTINATION_SECTION_PREFIX, destination['name'])
+        for dk, dv in sorted(destination['if_config_vars'].items()):
+            destination_block += '\n\t{}: {}'.format(dk, dv)
+        logger.debug(destination_block)
+
     # variables from agent-specific config
     agent_data_block = '\nAgent settings:'
     for jk, jv in sorted(agent_config_vars.items()):
@@ -1252,19 +1759,314 @@ def print_summary_info():
     logger.debug(cli_data_block)
 
 
-def initialize_data_gathering(thread_number):
+def is_in_worker_partition(key, thread_number):
+    """ whether a stable key (file inode, pod name, database, ...) belongs to this worker """
+    return zlib.crc32(str(key)) % cli_config_vars['threads'] == thread_number
+
+
+def get_worker_partition(items, thread_number):
+    """ this worker's share of a fixed, ordered list (kafka partitions, ...) """
+    return items[thread_number::cli_config_vars['threads']]
+
+
+def get_worker_counters():
+    counters = dict()
+    for counter in WORKER_COUNTERS:
+        counters[counter] = track.get(counter, 0)
+    counters.update(get_transport_stats())
+    counters.update(get_filter_hits())
+    return counters
+
+
+def merge_worker_counters(counter_queue, process_list):
+    """ sum the counters each worker reports at exit, then wait for the workers to finish """
+    # a worker can't exit until what it put on the queue has been read, so read before joining
+    totals = dict()
+    workers = len(process_list)
+    reported = 0
+    while reported < workers:
+        # anything put by workers that have already exited is in the queue by now
+        all_exited = not any(p.is_alive() for p in process_list)
+        try:
+            counters = counter_queue.get(timeout=1)
+        except Queue.Empty:
+            if all_exited:
+                logger.warn('{} of {} workers exited without reporting their counters'.format(
+                    workers - reported, workers))
+                break
+            continue
+        reported += 1
+        for counter, value in counters.items():
+            totals[counter] = totals.get(counter, 0) + value
+    for p in process_list:
+        p.join()
+    logger.info('All {} workers: {}'.format(workers, ', '.join(
+        '{}: {}'.format(counter, value) for counter, value in sorted(totals.items()))))
+    log_suppression_ratio(totals)
+
+
+def import_deferred_modules():
+    """
+    Import the deferred modules this config will use before the workers fork,
+    so they are imported once rather than once per worker.
+    """
+    modules = []
+    if not cli_config_vars['testing']:
+        modules.append('requests')
+    if agent_config_vars['timezone']:
+        modules.append('arrow')
+    for module in modules:
+        __import__(module)
+        record_startup_stage('import {}'.format(module))
+
+
+def record_startup_stage(stage):
+    """ note how long a startup stage took, for --profile-startup """
+    now = time.time()
+    startup['stages'].append((stage, now - startup['last']))
+    startup['last'] = now
+
+
+def report_startup_profile():
+    """ log how long each startup stage took, and warn if startup went over budget """
+    total = startup['last'] - STARTUP_TIME
+    logger.info('Startup took {:.1f} ms (not counting interpreter start):\n{}'.format(
+        total * 1000,
+        '\n'.join('\t{}: {:.1f} ms'.format(stage, seconds * 1000) for stage, seconds in startup['stages'])))
+    if total > STARTUP_BUDGET_SECONDS:
+        logger.warning('Startup took {:.1f} ms, over its {:.0f} ms budget'.format(
+            total * 1000, STARTUP_BUDGET_SECONDS * 1000))
+
+
+def start_profiling(thread_number):
+    """ start profiling this worker, for --profile. the profile carries over between daemon cycles """
+    if not cli_config_vars['profile']:
+        return
+    if profiler.get('pid') != os.getpid():
+        import cProfile
+        profiler.clear()
+        profiler['pid'] = os.getpid()
+        profiler['path'] = os.path.join(cli_config_vars['profile_dir'], '{}-{}-{}'.format(
+            make_safe_string(if_config_vars['project_name']), thread_number, os.getpid()))
+        profiler['profile'] = cProfile.Profile()
+        try:
+            import tracemalloc
+            tracemalloc.start()
+            profiler['tracemalloc'] = tracemalloc
+        except ImportError:
+            # no tracemalloc before python 3.4; report which object types grew instead
+            profiler['tracemalloc'] = None
+            profiler['object_counts'] = count_objects_by_type()
+        if not os.path.exists(cli_config_vars['profile_dir']):
+            os.makedirs(cli_config_vars['profile_dir'])
+    profiler['profile'].enable()
+
+
+def stop_profiling():
+    """ stop profiling this worker, and write its .pstats file and memory report """
+    if not profiler:
+        return
+    profiler['profile'].disable()
+    try:
+        profiler['profile'].dump_stats(profiler['path'] + '.pstats')
+        with open(profiler['path'] + '.memory.txt', 'w') as report_file:
+            report_file.write(get_memory_report())
+        logger.info('Wrote profile to {0}.pstats and memory report to {0}.memory.txt'.format(profiler['path']))
+    except (IOError, OSError) as e:
+        logger.warning('Could not write profile {}: {}'.format(profiler['path'], e))
+
+
+def get_memory_report():
+    """ report peak RSS and the top allocation sites, or the object types that grew most without tracemalloc """
+    lines = ['Peak RSS: {:.1f} MB'.format(get_peak_rss_mb())]
+    tracemalloc = profiler['tracemalloc']
+    if tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        lines.append('Traced memory: {:.1f} MB, peak {:.1f} MB'.format(current / 1048576.0, peak / 1048576.0))
+        lines.append('Top {} allocation sites:'.format(PROFILE_TOP_N))
+        for stat in tracemalloc.take_snapshot().statistics('lineno')[:PROFILE_TOP_N]:
+            lines.append('\t{}'.format(stat))
+    else:
+        object_counts = count_objects_by_type()
+        growth = sorted(((count - profiler['object_counts'].get(name, 0), count, name)
+                         for name, count in object_counts.items()), reverse=True)
+        lines.append('Top {} object types by growth since profiling started (gc-tracked objects only):'.format(
+            PROFILE_TOP_N))
+        for grew, count, name in growth[:PROFILE_TOP_N]:
+            lines.append('\t{}: {:+d} ({} live)'.format(name, grew, count))
+    return '\n'.join(lines) + '\n'
+
+
+def count_objects_by_type():
+    """ count the objects tracked by the garbage collector by type """
+    import gc
+    object_counts = dict()
+    for obj in gc.get_objects():
+        object_type = type(obj)
+        name = '{}.{}'.format(object_type.__module__, object_type.__name__)
+        object_counts[name] = object_counts.get(name, 0) + 1
+    return object_counts
+
+
+def get_peak_rss_mb():
+    """ get the peak resident set size of this process """
+    import resource
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kb elsewhere
+    if sys.platform == 'darwin':
+        return peak_rss / 1048576.0
+    return peak_rss / 1024.0
+
+
+def start_workers(target, counter_queue):
+    """ start a worker process per thread; each only handles its own partition of the input """
+    process_list = []
+    for process_num in range(0, cli_config_vars['threads']):
+        p = Process(target=target,
+                    args=(process_num, counter_queue)
+                    )
+        process_list.append(p)
+
+    for p in process_list:
+        p.start()
+    return process_list
+
+
+def run_daemon(counter_queue):
+    """ keep the agent resident, restarting the workers with a re-read config on SIGHUP """
+    daemon['stopping'] = False
+    daemon['reloading'] = False
+    signal.signal(signal.SIGHUP, request_daemon_reload)
+    signal.signal(signal.SIGTERM, request_daemon_stop)
+    signal.signal(signal.SIGINT, request_daemon_stop)
+    logger.info('Running as a daemon (pid {}), collecting every {}s'.format(os.getpid(), if_config_vars['run_interval']))
+    while True:
+        process_list = start_workers(run_daemon_worker, counter_queue)
+        # wait for a signal, or for every worker to exit on its own
+        while not (daemon['stopping'] or daemon['reloading']) and any(p.is_alive() for p in process_list):
+            time.sleep(1)
+        # workers finish their current cycle before exiting
+        for p in process_list:
+            if p.is_alive():
+                os.kill(p.pid, signal.SIGTERM)
+        merge_worker_counters(counter_queue, process_list)
+        if daemon['stopping'] or not daemon['reloading']:
+            break
+        daemon['reloading'] = False
+        reload_config()
+    logger.info('Daemon stopped')
+
+
+def request_daemon_stop(signum, frame):
+    daemon['stopping'] = True
+
+
+def request_daemon_reload(signum, frame):
+    daemon['reloading'] = True
+
+
+def reload_config():
+    """ re-read the config file, keeping the current config if the new one is invalid """
+    global if_config_vars, agent_config_vars, destinations
+    # caches built from the old config
+    caches = [JSON_FIELD_GETTERS, MATH_EXPRS, FILTERS, TIMESTAMP_PARSERS, UTC_OFFSETS]
+    saved_caches = [dict(cache) for cache in caches]
+    saved_config = (if_config_vars, agent_config_vars, destinations)
+    for cache in caches:
+        cache.clear()
+    try:
+        if_config_vars = get_if_config_vars()
+        agent_config_vars = get_agent_config_vars()
+        destinations = get_destinations()
+    except SystemExit:
+        logger.error('Could not reload {}, keeping the current config'.format(config_ini_path()))
+        if_config_vars, agent_config_vars, destinations = saved_config
+        for cache, saved_cache in zip(caches, saved_caches):
+            cache.clear()
+            cache.update(saved_cache)
+        return
+    logger.info('Reloaded {}'.format(config_ini_path()))
+    print_summary_info()
+
+
+def run_daemon_worker(thread_number, counter_queue):
+    """
+    Run collection cycles on a drift-free schedule until asked to stop.
+    Cycles start every run_interval from the first one, plus up to run_jitter seconds;
+    a cycle that overruns skips the ticks it missed rather than running back to back.
+    """
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, request_daemon_stop)
+    signal.signal(signal.SIGINT, request_daemon_stop)
+    interval = if_config_vars['run_interval']
+    totals = {'cycles': 0, 'cycles_overrun': 0, 'cycles_skipped': 0}
+    next_tick = time.time()
+    run_at = next_tick + random.uniform(0, if_config_vars['run_jitter'])
+    while True:
+        delay = run_at - time.time()
+        # the sleep is cut short by signals
+        while delay > 0 and not daemon['stopping']:
+            time.sleep(delay)
+            delay = run_at - time.time()
+        if daemon['stopping']:
+            break
+
+        initialize_data_gathering(thread_number)
+        totals['cycles'] += 1
+        for counter in WORKER_COUNTERS:
+            totals[counter] = totals.get(counter, 0) + track.get(counter, 0)
+
+        next_tick += interval
+        now = time.time()
+        if now >= next_tick:
+            skipped = int((now - next_tick) // interval) + 1
+            logger.warning('Cycle took {:.1f}s and ran past its next start (run_interval is {}s); skipping {} cycle(s)'.format(
+                now - run_at, interval, skipped))
+            totals['cycles_overrun'] += 1
+            totals['cycles_skipped'] += skipped
+            next_tick += skipped * interval
+        run_at = next_tick + random.uniform(0, if_config_vars['run_jitter'])
+
+    # transport and filter counters are already cumulative
+    counters = get_worker_counters()
+    counters.update(totals)
+    counter_queue.put(counters)
+
+
+def initialize_data_gathering(thread_number, counter_queue=None, fanout_queue=None):
     reset_metric_buffer()
     reset_track()
     track['chunk_count'] = 0
     track['entry_count'] = 0
-
-    start_data_processing(thread_number)
+    track['chunks_completed'] = 0
+    track['chunks_accepted'] = 0
+    track['chunks_rejected'] = 0
+    track['chunks_spooled'] = 0
+    track['metrics_suppressed'] = 0
+    if fanout_queue is None:
+        # before any threads are started, so the destination processes fork cleanly
+        start_fanout(thread_number)
+    start_telemetry(thread_number)
+    start_chunk_sizing(thread_number)
+    start_suppression(thread_number)
+    start_aggregation()
+    open_spool(thread_number)
+    replay_spool()
+    start_sender()
+    start_profiling(thread_number)
+
+    if fanout_queue is None:
+        start_data_processing(thread_number)
+        close_fanout()
+    else:
+        receive_fanout(fanout_queue)
+    flush_aggregation()
 
     # move all buffer data to current data, and send
-    while metric_buffer['buffer_ts_list']:
-        (ts, key) = metric_buffer['buffer_ts_list'].pop()
+    while metric_buffer['buffer_dict']:
+        (ts, key) = get_oldest_metric_buffer_key()
         transpose_metrics(ts, key)
-        if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size']:
+        if track['current_row_size'] >= get_chunk_size():
             logger.debug('Sending buffer chunk')
             send_data_wrapper()
 
@@ -1273,57 +2075,90 @@ def initialize_data_gathering(thread_number):
         logger.debug('Sending last chunk')
         send_data_wrapper()
 
+    # wait for any chunks still in flight
+    stop_sender()
+    stop_fanout()
+    stop_chunk_sizing()
+    stop_suppression()
+    stop_profiling()
+    log_transport_stats()
+    stop_telemetry()
+
     logger.debug('Total chunks created: ' + str(track['chunk_count']))
+    logger.debug('Total chunks accepted: {}, rejected: {}, spooled: {}'.format(
+        track['chunks_accepted'], track['chunks_rejected'], track['chunks_spooled']))
     logger.debug('Total {} entries: {}'.format(
         if_config_vars['project_type'].lower(), track['entry_count']))
+    log_suppression_ratio(track, logging.DEBUG)
+    if counter_queue is not None:
+        counter_queue.put(get_worker_counters())
 
 
 def reset_metric_buffer():
-    metric_buffer['buffer_key_list'] = []
-    metric_buffer['buffer_ts_list'] = []
+    # <ts-instance key>: {'columns': <column table>, 'values': array of floats by slot, 'mask': slots that are set}
     metric_buffer['buffer_dict'] = {}
+    metric_buffer['buffer_size_dict'] = {}
+    metric_buffer['buffer_size'] = 0
+
+    # <timestamp>: ordered <ts-instance key>s, plus a min-heap of the timestamps
+    metric_buffer['buffer_ts_dict'] = {}
+    metric_buffer['buffer_ts_heap'] = []
 
     metric_buffer['buffer_collected_list'] = []
     metric_buffer['buffer_collected_dict'] = {}
 
+    # interned safe names: (instance, device): <instance string>, and <instance string>: <column table>
+    # these are kept across daemon cycles
+    metric_buffer.setdefault('instance_strs', {})
+    metric_buffer.setdefault('column_tables', {})
+
 
 def reset_track():
     """ reset the track global for the next chunk """
     track['start_time'] = time.time()
     track['line_count'] = 0
     track['current_row'] = []
+    track['current_row_size'] = get_json_size_bytes([])
 
 
 #########################################
 # Functions to handle Log/Incident data #
 #########################################
 def incident_handoff(timestamp, data, instance, device=''):
+    if fanout and not fan_out('incident_handoff', timestamp, data, instance, device):
+        return
     send_log(timestamp, data, instance or HOSTNAME, device)
 
 
 def deployment_handoff(timestamp, data, instance, device=''):
+    if fanout and not fan_out('deployment_handoff', timestamp, data, instance, device):
+        return
     send_log(timestamp, data, instance or HOSTNAME, device)
 
 
 def alert_handoff(timestamp, data, instance, device=''):
+    if fanout and not fan_out('alert_handoff', timestamp, data, instance, device):
+        return
     send_log(timestamp, data, instance or HOSTNAME, device)
 
 
 def log_handoff(timestamp, data, instance, device=''):
+    if fanout and not fan_out('log_handoff', timestamp, data, instance, device):
+        return
     send_log(timestamp, data, instance or HOSTNAME, device)
 
 
 def send_log(timestamp, data, instance, device=''):
     entry = prepare_log_entry(str(int(timestamp)), data, instance, device)
-    track['current_row'].append(entry)
+    append_to_current_row(entry)
     track['line_count'] += 1
     track['entry_count'] += 1
-    if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size'] or (
+    if track['current_row_size'] >= get_chunk_size() or (
             time.time() - track['start_time']) >= if_config_vars['sampling_interval']:
         send_data_wrapper()
     elif track['entry_count'] % 100 == 0:
         logger.debug('Current data object size: {} bytes'.format(
-            get_json_size_bytes(track['current_row'])))
+            track['current_row_size']))
 
 
 def prepare_log_entry(timestamp, data, instance, device=''):
@@ -1343,7 +2178,12 @@ def prepare_log_entry(timestamp, data, instance, device=''):
 # Functions to handle Metric data #
 ###################################
 def metric_handoff(timestamp, field_name, data, instance, device=''):
-    send_metric(timestamp, field_name, data, instance or HOSTNAME, device)
+    if fanout and not fan_out('metric_handoff', timestamp, field_name, data, instance, device):
+        return
+    if aggregation:
+        aggregate_metric(timestamp, field_name, data, instance or HOSTNAME, device)
+    else:
+        send_metric(timestamp, field_name, data, instance or HOSTNAME, device)
 
 
 def send_metric(timestamp, field_name, data, instance, device=''):
@@ -1356,67 +2196,349 @@ def send_metric(timestamp, field_name, data, instance, device=''):
             'timestamp: {}\nfield_name: {}\ninstance: {}\ndevice: {}\ndata: {}'.format(
                 timestamp, field_name, instance, device, data))
     else:
+        if is_unchanged_metric(timestamp, field_name, data, instance, device):
+            track['metrics_suppressed'] += 1
+            return
         append_metric_data_to_buffer(timestamp, field_name, data, instance, device)
         track['entry_count'] += 1
 
         # send data if all metrics of instance is collected
         while metric_buffer['buffer_collected_list']:
-            (ts, key, index) = metric_buffer['buffer_collected_list'].pop()
-            del metric_buffer['buffer_ts_list'][index]
-            metric_buffer['buffer_collected_dict'].pop(key)
+            (ts, key) = metric_buffer['buffer_collected_list'].pop(0)
             transpose_metrics(ts, key)
-            if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size']:
+            if track['current_row_size'] >= get_chunk_size():
                 logger.debug('Sending buffer chunk')
                 send_data_wrapper()
 
         # send data if buffer size is bigger than threshold
-        while get_json_size_bytes(metric_buffer['buffer_dict']) >= agent_config_vars['metric_buffer_size'] and \
-                metric_buffer['buffer_ts_list']:
-            (ts, key) = metric_buffer['buffer_ts_list'].pop()
+        while metric_buffer['buffer_size'] >= agent_config_vars['metric_buffer_size'] and \
+                metric_buffer['buffer_dict']:
+            (ts, key) = get_oldest_metric_buffer_key()
             transpose_metrics(ts, key)
-            if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size']:
+            if track['current_row_size'] >= get_chunk_size():
                 logger.debug('Sending buffer chunk')
                 send_data_wrapper()
 
         # send data
-        if get_json_size_bytes(track['current_row']) >= if_config_vars['chunk_size'] or (
+        if track['current_row_size'] >= get_chunk_size() or (
                 time.time() - track['start_time']) >= if_config_vars['run_interval']:
             send_data_wrapper()
         elif track['entry_count'] % 500 == 0:
             logger.debug('Buffer data object size: {} bytes'.format(
-                get_json_size_bytes(metric_buffer['buffer_dict'])))
+                metric_buffer['buffer_size']))
+
+
+def start_aggregation():
+    """ start pre-aggregating metric samples into sampling_interval buckets, if metric_aggregates is set """
+    aggregation.clear()
+    if not agent_config_vars['metric_aggregates'] or 'METRIC' not in if_config_vars['project_type']:
+        return
+    aggregation['interval'] = if_config_vars['sampling_interval'] * 1000
+    aggregation['quantiles'] = any(quantile is not None for (_, quantile) in agent_config_vars['metric_aggregates'])
+    # <bucket timestamp>: {(instance, device, field_name): aggregate}
+    aggregation['buckets'] = dict()
+    aggregation['newest'] = 0
+
+
+def aggregate_metric(timestamp, field_name, data, instance, device=''):
+    """ add a sample to its sampling_interval bucket, sending the buckets it leaves behind """
+    try:
+        data = float(data)
+    except (TypeError, ValueError):
+        # pass it on to be logged
+        send_metric(timestamp, field_name, data, instance, device)
+        return
+    bucket = int(timestamp) // aggregation['interval'] * aggregation['interval']
+    samples = aggregation['buckets'].setdefault(bucket, dict())
+    key = (instance, device, field_name)
+    if key not in samples:
+        samples[key] = new_aggregate()
+    add_to_aggregate(samples[key], data)
+    if bucket > aggregation['newest']:
+        aggregation['newest'] = bucket
+        # samples can arrive up to one interval late
+        flush_aggregation(bucket - aggregation['interval'])
+
+
+def flush_aggregation(before=None):
+    """ send the aggregates of the buckets older than before, or of all of them """
+    if not aggregation:
+        return
+    aggregates = agent_config_vars['metric_aggregates']
+    for bucket in sorted(aggregation['buckets']):
+        if before is not None and bucket >= before:
+            break
+        for (instance, device, field_name), aggregate in aggregation['buckets'].pop(bucket).items():
+            for (name, quantile) in aggregates:
+                metric_name = field_name if len(aggregates) == 1 else '{}_{}'.format(field_name, name)
+                send_metric(bucket, metric_name, get_aggregate_value(aggregate, name, quantile), instance, device)
+
+
+def parse_metric_aggregates(metric_aggregates):
+    """ parse a list of aggregates into (name, quantile) pairs, with quantile set for pNN aggregates """
+    aggregates = []
+    for name in metric_aggregates:
+        if name in METRIC_AGGREGATES:
+            aggregates.append((name, None))
+        elif regex.match(r'^p\d+(\.\d+)?$', name) and float(name[1:]) <= 100:
+            aggregates.append((name, float(name[1:]) / 100))
+        else:
+            raise ValueError('Unknown aggregate {}'.format(name))
+    return aggregates
+
+
+def new_aggregate():
+    aggregate = {'count': 0, 'sum': 0.0, 'min': float('inf'), 'max': float('-inf'), 'last': None}
+    if aggregation['quantiles']:
+        aggregate['sketch'] = new_sketch()
+    return aggregate
+
+
+def add_to_aggregate(aggregate, value):
+    aggregate['count'] += 1
+    aggregate['sum'] += value
+    aggregate['min'] = min(aggregate['min'], value)
+    aggregate['max'] = max(aggregate['max'], value)
+    aggregate['last'] = value
+    if 'sketch' in aggregate:
+        add_to_sketch(aggregate['sketch'], value)
+
+
+def get_aggregate_value(aggregate, name, quantile=None):
+    if quantile is not None:
+        # the exact extremes are known, so keep the estimate within them
+        return min(max(get_sketch_quantile(aggregate['sketch'], quantile), aggregate['min']), aggregate['max'])
+    if name == 'avg':
+        return aggregate['sum'] / aggregate['count']
+    return aggregate[name]
+
+
+def new_sketch():
+    """
+    A quantile sketch in the style of DDSketch. Values are counted in logarithmically sized bins, so
+    quantiles are within SKETCH_RELATIVE_ACCURACY of the true value, and memory is bounded by SKETCH_MAX_BINS
+    however many values are added.
+    """
+    return {'positive': dict(), 'negative': dict(), 'zero': 0, 'count': 0}
+
+
+def add_to_sketch(sketch, value, count=1):
+    sketch['count'] += count
+    if value > SKETCH_MIN_VALUE:
+        bins = sketch['positive']
+    elif value < -SKETCH_MIN_VALUE:
+        bins = sketch['negative']
+        value = -value
+    else:
+        sketch['zero'] += count
+        return
+    index = int(math.ceil(math.log(value) / SKETCH_LOG_GAMMA))
+    bins[index] = bins.get(index, 0) + count
+    if len(bins) > SKETCH_MAX_BINS:
+        collapse_sketch_bins(bins)
+
+
+def collapse_sketch_bins(bins):
+    """ fold the bins of the smallest magnitudes together, so only their accuracy is lost """
+    indexes = sorted(bins)
+    excess = len(indexes) - SKETCH_MAX_BINS
+    bins[indexes[excess]] += sum(bins.pop(index) for index in indexes[:excess])
+
+
+def get_sketch_quantile(sketch, quantile):
+    """ estimate a quantile (0 to 1) of the values added """
+    rank = quantile * (sketch['count'] - 1)
+    seen = 0
+    # from the most negative value up
+    for index in sorted(sketch['negative'], reverse=True):
+        seen += sketch['negative'][index]
+        if seen > rank:
+            return -get_sketch_bin_value(index)
+    seen += sketch['zero']
+    if seen > rank or not sketch['positive']:
+        return 0.0
+    for index in sorted(sketch['positive']):
+        seen += sketch['positive'][index]
+        if seen > rank:
+            break
+    return get_sketch_bin_value(index)
+
+
+def get_sketch_bin_value(index):
+    """ the value a bin stands for, within SKETCH_RELATIVE_ACCURACY of every value counted in it """
+    return 2 * SKETCH_GAMMA ** index / (SKETCH_GAMMA + 1)
+
+
+def start_suppression(thread_number):
+    """ start dropping unchanged metric values, if suppression_heartbeat is set """
+    if not agent_config_vars['suppression_heartbeat'] or 'METRIC' not in if_config_vars['project_type']:
+        return
+    if suppression.get('pid') != os.getpid():
+        suppression.clear()
+        suppression['pid'] = os.getpid()
+        suppression['path'] = abs_path_from_cur('.suppression-' + get_state_file_name(thread_number))
+        # (instance, device, field_name): (last value sent, its timestamp)
+        suppression['last_sent'] = dict()
+        # pick up where the last run left off
+        try:
+            with open(suppression['path']) as state_file:
+                for instance, device, field_name, value, timestamp in json.load(state_file):
+                    suppression['last_sent'][(instance, device, field_name)] = (value, timestamp)
+        except (IOError, OSError, ValueError, TypeError):
+            pass
+    # the interval may have changed on reload
+    suppression['heartbeat'] = agent_config_vars['suppression_heartbeat'] * if_config_vars['sampling_interval'] * 1000
+    logger.debug('Suppressing unchanged values of {} metrics'.format(len(suppression['last_sent'])))
+
+
+def stop_suppression():
+    """ save the last values sent for the next run """
+    if not suppression:
+        return
+    try:
+        with open(suppression['path'] + '.tmp', 'w') as state_file:
+            json.dump([list(key) + list(last) for key, last in suppression['last_sent'].items()], state_file)
+        os.rename(suppression['path'] + '.tmp', suppression['path'])
+    except (IOError, OSError) as e:
+        logger.warning('Could not save the last metric values to {}: {}'.format(suppression['path'], e))
+
+
+def is_unchanged_metric(timestamp, field_name, data, instance, device=''):
+    """
+    Whether a value is within suppression_tolerance of the last one sent for its metric, and can be dropped.
+    A value is always sent once suppression_heartbeat sampling intervals have passed since the last one.
+    """
+    if not suppression:
+        return False
+    key = (instance, device, field_name)
+    last = suppression['last_sent'].get(key)
+    if last is not None:
+        (last_value, last_timestamp) = last
+        if abs(data - last_value) <= agent_config_vars['suppression_tolerance'] * abs(last_value) and \
+                0 <= timestamp - last_timestamp < suppression['heartbeat']:
+            return True
+    suppression['last_sent'][key] = (data, timestamp)
+    return False
+
+
+def log_suppression_ratio(counters, level=logging.INFO):
+    """ log how much smaller suppression made the metric payload """
+    if not counters.get('metrics_suppressed'):
+        return
+    total = counters['metrics_suppressed'] + counters['entry_count']
+    logger.log(level, 'Suppressed {} of {} metric values, a {:.1%} reduction'.format(
+        counters['metrics_suppressed'], total, float(counters['metrics_suppressed']) / total))
 
 
 def append_metric_data_to_buffer(timestamp, field_name, data, instance, device=''):
     """ creates the metric entry """
-    ts_str = str(timestamp)
-    instance_str = make_safe_instance_string(instance, device)
-    key = '{}-{}'.format(ts_str, instance_str)
-    metric_str = make_safe_metric_key(field_name)
-    metric_key = '{}[{}]'.format(metric_str, instance_str)
-
-    if key not in metric_buffer['buffer_key_list']:
-        # add timestamp in buffer_ts_list and buffer_dict
-        metric_buffer['buffer_key_list'].append(key)
-        metric_buffer['buffer_ts_list'].append((timestamp, key))
-        metric_buffer['buffer_ts_list'].sort(key=lambda elem: elem[0], reverse=True)
-        metric_buffer['buffer_dict'][key] = dict()
-        metric_buffer['buffer_collected_dict'][key] = []
-    metric_buffer['buffer_dict'][key][metric_key] = str(data)
-    metric_buffer['buffer_collected_dict'][key].append(metric_str)
+    columns = get_metric_columns(instance, device)
+    slot = get_metric_column_slot(columns, field_name)
+    key = '{}-{}'.format(str(timestamp), columns['instance'])
+
+    if key not in metric_buffer['buffer_dict']:
+        # add key to its timestamp bucket and buffer_dict
+        if timestamp not in metric_buffer['buffer_ts_dict']:
+            metric_buffer['buffer_ts_dict'][timestamp] = OrderedDict()
+            heapq.heappush(metric_buffer['buffer_ts_heap'], timestamp)
+        metric_buffer['buffer_ts_dict'][timestamp][key] = True
+        metric_buffer['buffer_dict'][key] = {'columns': columns, 'values': array('d'), 'mask': bytearray()}
+        # '"key": {}' plus the ', ' separator
+        metric_buffer['buffer_size_dict'][key] = get_json_size_bytes(key) + 6
+        metric_buffer['buffer_size'] += metric_buffer['buffer_size_dict'][key]
+        metric_buffer['buffer_collected_dict'][key] = set()
+    row = metric_buffer['buffer_dict'][key]
+    if slot >= len(row['values']):
+        # the instance has gained columns since this row was started
+        grow_by = len(columns['keys']) - len(row['values'])
+        row['values'].extend([0.0] * grow_by)
+        row['mask'].extend(bytearray(grow_by))
+    # keep a running estimate of the buffer size rather than re-serializing it
+    # values are serialized as quoted strings
+    value_size = len(str(data)) + 2
+    if row['mask'][slot]:
+        value_size -= len(str(row['values'][slot])) + 2
+    else:
+        # '"key": ' plus the ', ' separator
+        value_size += columns['sizes'][slot]
+    row['values'][slot] = data
+    row['mask'][slot] = 1
+    metric_buffer['buffer_size_dict'][key] += value_size
+    metric_buffer['buffer_size'] += value_size
 
     # if all metrics of ts_instance is collected, then send these data
-    if agent_config_vars['all_metrics'] and set(agent_config_vars['all_metrics']) <= set(
-            metric_buffer['buffer_collected_dict'][key]):
-        metric_buffer['buffer_collected_list'].append(
-            (timestamp, key, metric_buffer['buffer_ts_list'].index((timestamp, key))))
+    metric_str = columns['names'][slot]
+    if agent_config_vars['all_metrics'] and metric_str in agent_config_vars['all_metrics']:
+        collected = metric_buffer['buffer_collected_dict'][key]
+        if metric_str not in collected:
+            collected.add(metric_str)
+            if len(collected) == len(agent_config_vars['all_metrics']):
+                metric_buffer['buffer_collected_list'].append((timestamp, key))
+
+
+def get_metric_columns(instance, device=''):
+    """ get the interned column table for an instance, so its safe names are only built once """
+    instance_str = metric_buffer['instance_strs'].get((instance, device))
+    if instance_str is None:
+        instance_str = make_safe_instance_string(instance, device)
+        metric_buffer['instance_strs'][(instance, device)] = instance_str
+    columns = metric_buffer['column_tables'].get(instance_str)
+    if columns is None:
+        # <field name>: slot and <metric name>: slot, and per slot the metric name,
+        # 'metric[instance]' key, and its serialized size
+        columns = {'instance': instance_str, 'slots': dict(), 'name_slots': dict(), 'names': [], 'keys': [], 'sizes': []}
+        metric_buffer['column_tables'][instance_str] = columns
+    return columns
+
+
+def get_metric_column_slot(columns, field_name):
+    """ get the slot of a metric in an instance's column table, adding it on first use """
+    slot = columns['slots'].get(field_name)
+    if slot is None:
+        # field names that make the same safe name share a slot
+        metric_str = make_safe_metric_key(field_name)
+        slot = columns['name_slots'].get(metric_str)
+        if slot is None:
+            metric_key = '{}[{}]'.format(metric_str, columns['instance'])
+            slot = len(columns['keys'])
+            columns['name_slots'][metric_str] = slot
+            columns['names'].append(metric_str)
+            columns['keys'].append(metric_key)
+            # '"key": ' plus the ', ' separator
+            columns['sizes'].append(get_json_size_bytes(metric_key) + 4)
+        columns['slots'][field_name] = slot
+    return slot
+
+
+def get_oldest_metric_buffer_key():
+    """ get the (timestamp, key) of the oldest entry in the metric buffer """
+    ts_heap = metric_buffer['buffer_ts_heap']
+    # skip over timestamps whose buckets have already been emptied
+    while ts_heap[0] not in metric_buffer['buffer_ts_dict']:
+        heapq.heappop(ts_heap)
+    ts = ts_heap[0]
+    # the last key added at that timestamp, which is the one the sorted buffer list used to pop
+    key = next(reversed(metric_buffer['buffer_ts_dict'][ts]))
+    return ts, key
 
 
 def transpose_metrics(ts, key):
-    metric_buffer['buffer_key_list'].remove(key)
-    track['current_row'].append(
-        dict({'timestamp': str(ts)}, **metric_buffer['buffer_dict'].pop(key))
-    )
+    # remove the key from its timestamp bucket
+    ts_bucket = metric_buffer['buffer_ts_dict'][ts]
+    del ts_bucket[key]
+    if len(ts_bucket) == 0:
+        del metric_buffer['buffer_ts_dict'][ts]
+    metric_buffer['buffer_collected_dict'].pop(key)
+    metric_buffer['buffer_size'] -= metric_buffer['buffer_size_dict'].pop(key)
+    append_to_current_row(build_metric_row(ts, metric_buffer['buffer_dict'].pop(key)))
+
+
+def build_metric_row(ts, row):
+    """ serialize a buffered row into a {'timestamp': ts, 'metric[instance]': value} entry """
+    entry = {key: str(value) for key, value, present in zip(row['columns']['keys'], row['values'], row['mask'])
+             if present}
+    entry['timestamp'] = str(ts)
+    return entry
 
 
 def build_metric_name_map():
@@ -1522,6 +2644,302 @@ def fold_up_helper(current_path, node_name, node, sentence_tree=False, value_tre
                 value_tree=value_tree)
 
 
+############################################################
+# Functions to fan data out to more InsightFinder projects #
+############################################################
+def get_destinations():
+    """ read the extra [insightfinder:<name>] sections to send the same data to """
+    destinations = []
+    config_parser = ConfigParser.SafeConfigParser()
+    config_parser.read(config_ini_path())
+    for section in config_parser.sections():
+        if not section.startswith(DESTINATION_SECTION_PREFIX):
+            continue
+        name = section[len(DESTINATION_SECTION_PREFIX):]
+        destination = {'name': name, 'if_config_vars': get_if_config_vars(section), 'filters': dict()}
+        # data is parsed once, as the data type of [insightfinder]
+        if destination['if_config_vars']['project_type'].replace('REPLAY', '') != \
+                if_config_vars['project_type'].replace('REPLAY', ''):
+            config_error('{} project_type'.format(section))
+        # keep each destination's undelivered chunks apart
+        if if_config_vars['spool_dir'] and not config_parser.has_option(section, 'spool_dir'):
+            destination['if_config_vars']['spool_dir'] = os.path.join(if_config_vars['spool_dir'], make_safe_string(name))
+        # filters default to the agent's
+        for setting in ('include', 'exclude'):
+            option = 'filters_{}'.format(setting)
+            filters = config_parser.get(section, option) if config_parser.has_option(section, option) else \
+                '|'.join(agent_config_vars[option])
+            try:
+                destination['filters'][setting] = compile_filters(filter(lambda x: x, filters.split('|')))
+            except IndexError:
+                config_error('{} {}'.format(section, option))
+        destinations.append(destination)
+    return destinations
+
+
+def start_fanout(thread_number):
+    """ start a process for each extra destination, fed what this worker collects """
+    fanout.clear()
+    if not destinations:
+        return
+    fanout['destinations'] = []
+    for destination in destinations:
+        queue = ProcessQueue(FANOUT_QUEUE_BATCHES)
+        process = Process(target=run_destination, args=(destination, thread_number, queue))
+        process.start()
+        fanout['destinations'].append({'name': destination['name'], 'filters': destination['filters'],
+                                       'queue': queue, 'process': process, 'batch': []})
+    # messages that don't go through the filters go everywhere
+    end_route()
+
+
+def fan_out(handoff, *args):
+    """ queue a handoff for the extra destinations the current message goes to, returning whether it stays here too """
+    for destination in fanout['targets']:
+        destination['batch'].append((handoff, args))
+        if len(destination['batch']) >= FANOUT_BATCH_SIZE:
+            send_fanout_batch(destination)
+    return fanout['to_primary']
+
+
+def send_fanout_batch(destination):
+    batch = destination['batch']
+    destination['batch'] = []
+    # a full queue means the destination is behind, so wait for it unless it has died
+    while destination['process'].is_alive():
+        try:
+            destination['queue'].put(batch, timeout=1)
+            return
+        except Queue.Full:
+            pass
+
+
+def close_fanout():
+    """ send the last batches and tell the extra destinations there is no more to come """
+    if not fanout:
+        return
+    for destination in fanout['destinations']:
+        destination['batch'].append(None)
+        send_fanout_batch(destination)
+
+
+def stop_fanout():
+    """ wait for the extra destinations to finish sending """
+    if not fanout:
+        return
+    for destination in fanout['destinations']:
+        destination['process'].join()
+        if destination['process'].exitcode:
+            logger.warning('Sending to {} failed with exit code {}'.format(
+                destination['name'], destination['process'].exitcode))
+    fanout.clear()
+
+
+def run_destination(destination, thread_number, queue):
+    """ send what a worker fans out to one extra destination, with its own chunking, delivery and state """
+    global if_config_vars
+    if_config_vars = destination['if_config_vars']
+    fanout.clear()
+    initialize_data_gathering(thread_number, fanout_queue=queue)
+    logger.info('Sent to {} ({}): {}'.format(destination['name'], if_config_vars['project_name'], ', '.join(
+        '{}: {}'.format(counter, value) for counter, value in sorted(get_worker_counters().items()))))
+
+
+def receive_fanout(queue):
+    """ replay the handoffs a worker fans out, until it says it is done """
+    handoffs = globals()
+    while True:
+        for item in queue.get():
+            if item is None:
+                return
+            (handoff, args) = item
+            handoffs[handoff](*args)
+
+
+######################################
+# Functions for agent self-telemetry #
+######################################
+def start_telemetry(thread_number):
+    """ start this worker's self-telemetry, if configured. counters carry over between daemon cycles """
+    if not (if_config_vars['telemetry_dir'] or if_config_vars['telemetry_project']):
+        return
+    if telemetry.get('pid') != os.getpid():
+        telemetry.clear()
+        telemetry['pid'] = os.getpid()
+        telemetry['worker'] = thread_number
+        telemetry['lock'] = threading.Lock()
+        # (name, ((label, value), ...)): value
+        telemetry['counters'] = dict()
+        # name: {'buckets': counts per TELEMETRY_LATENCY_BUCKETS bound plus +Inf, 'sum': total, 'count': n}
+        telemetry['histograms'] = dict()
+        # stage: seconds. only the thread running the pipeline switches stages, so this is kept outside the lock
+        telemetry['stage_seconds'] = dict()
+        # entries from previous daemon cycles
+        telemetry['entries'] = 0
+    # time not spent parsing, assembling or sending is spent in the agent reading its source
+    telemetry['stage'] = 'read'
+    telemetry['stage_start'] = time.time()
+    if if_config_vars['telemetry_dir']:
+        if not os.path.exists(if_config_vars['telemetry_dir']):
+            os.makedirs(if_config_vars['telemetry_dir'])
+        telemetry['stop'] = threading.Event()
+        telemetry['thread'] = threading.Thread(target=telemetry_loop, name='telemetry')
+        telemetry['thread'].daemon = True
+        telemetry['thread'].start()
+
+
+def stop_telemetry():
+    """ stop the stats file writer, then write the stats file and forward the counters one last time """
+    if not telemetry:
+        return
+    charge_telemetry_stage()
+    if 'thread' in telemetry:
+        telemetry['stop'].set()
+        telemetry.pop('thread').join()
+        write_telemetry_file()
+    forward_telemetry()
+    # entries are counted by the track global, which starts over each cycle
+    telemetry['entries'] += track['entry_count']
+
+
+def telemetry_loop():
+    while not telemetry['stop'].wait(if_config_vars['telemetry_interval']):
+        write_telemetry_file()
+
+
+def count_telemetry(name, value=1, labels=()):
+    """ add to a self-telemetry counter """
+    if not telemetry:
+        return
+    key = (name, labels)
+    with telemetry['lock']:
+        telemetry['counters'][key] = telemetry['counters'].get(key, 0) + value
+
+
+def observe_telemetry(name, value):
+    """ add an observation to a self-telemetry histogram """
+    if not telemetry:
+        return
+    with telemetry['lock']:
+        histogram = telemetry['histograms'].get(name)
+        if histogram is None:
+            histogram = {'buckets': [0] * (len(TELEMETRY_LATENCY_BUCKETS) + 1), 'sum': 0, 'count': 0}
+            telemetry['histograms'][name] = histogram
+        histogram['buckets'][bisect.bisect_left(TELEMETRY_LATENCY_BUCKETS, value)] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def switch_telemetry_stage(stage):
+    """ charge the time since the last switch to the current pipeline stage, and move to another; returns the old one """
+    if not telemetry:
+        return
+    previous_stage = telemetry['stage']
+    if stage != previous_stage:
+        charge_telemetry_stage()
+        telemetry['stage'] = stage
+    return previous_stage
+
+
+def charge_telemetry_stage():
+    """ add the time since the last switch to the current stage """
+    now = time.time()
+    stage_seconds = telemetry['stage_seconds']
+    stage_seconds[telemetry['stage']] = stage_seconds.get(telemetry['stage'], 0) + now - telemetry['stage_start']
+    telemetry['stage_start'] = now
+
+
+def get_telemetry_counters():
+    """ get a snapshot of this worker's counters, including the seconds spent in each stage """
+    with telemetry['lock']:
+        counters = dict(telemetry['counters'])
+    for stage, seconds in telemetry['stage_seconds'].items():
+        counters[('stage_seconds_total', (('stage', stage),))] = seconds
+    counters[('entries_total', ())] = telemetry['entries'] + track.get('entry_count', 0)
+    return counters
+
+
+def get_telemetry_gauges():
+    """ current depth of each buffer in the pipeline """
+    gauges = {
+        'metric_buffer_bytes': metric_buffer.get('buffer_size', 0),
+        'chunk_bytes': track.get('current_row_size', 0)
+    }
+    queue = sender.get('queue')
+    if queue is not None:
+        gauges['sender_queue_depth'] = queue.qsize()
+    if chunk_sizing:
+        gauges['chunk_size_target_bytes'] = chunk_sizing['size']
+    return gauges
+
+
+def render_telemetry():
+    """ render this worker's self-telemetry in the Prometheus text format """
+    counters = get_telemetry_counters()
+    with telemetry['lock']:
+        histograms = {name: dict(histogram, buckets=list(histogram['buckets']))
+                      for name, histogram in telemetry['histograms'].items()}
+    worker_labels = (('project', if_config_vars['project_name']), ('worker', telemetry['worker']))
+
+    def series(name, labels=()):
+        return 'insightagent_{}{{{}}}'.format(name, ','.join(
+            '{}="{}"'.format(label, value) for label, value in worker_labels + labels))
+
+    lines = []
+    previous_name = None
+    for name, labels in sorted(counters):
+        if name != previous_name:
+            lines.append('# TYPE insightagent_{} counter'.format(name))
+            previous_name = name
+        lines.append('{} {}'.format(series(name, labels), counters[(name, labels)]))
+    for name, value in sorted(get_telemetry_gauges().items()):
+        lines.append('# TYPE insightagent_{} gauge'.format(name))
+        lines.append('{} {}'.format(series(name), value))
+    for name, histogram in sorted(histograms.items()):
+        lines.append('# TYPE insightagent_{} histogram'.format(name))
+        cumulative = 0
+        for bound, count in zip(TELEMETRY_LATENCY_BUCKETS + ('+Inf',), histogram['buckets']):
+            cumulative += count
+            lines.append('{} {}'.format(series(name + '_bucket', (('le', bound),)), cumulative))
+        lines.append('{} {}'.format(series(name + '_sum'), histogram['sum']))
+        lines.append('{} {}'.format(series(name + '_count'), histogram['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def write_telemetry_file():
+    """ atomically rewrite this worker's <project>-<worker>.prom stats file """
+    telemetry_file = os.path.join(if_config_vars['telemetry_dir'], get_state_file_name(telemetry['worker']) + '.prom')
+    try:
+        with open(telemetry_file + '.tmp', 'w') as stats_file:
+            stats_file.write(render_telemetry())
+        os.rename(telemetry_file + '.tmp', telemetry_file)
+    except (IOError, OSError) as e:
+        logger.warning('Could not write {}: {}'.format(telemetry_file, e))
+
+
+def forward_telemetry():
+    """ post this worker's counters, gauges and histogram totals to the telemetry metric project """
+    if not if_config_vars['telemetry_project'] or cli_config_vars['testing']:
+        return
+    values = dict()
+    for (name, labels), value in get_telemetry_counters().items():
+        values['_'.join([name] + [str(label_value) for _, label_value in labels])] = value
+    values.update(get_telemetry_gauges())
+    for name, histogram in telemetry['histograms'].items():
+        values[name + '_sum'] = histogram['sum']
+        values[name + '_count'] = histogram['count']
+    instance = make_safe_instance_string('{}-{}'.format(HOSTNAME, telemetry['worker']))
+    row = {'{}[{}]'.format(make_safe_metric_key(name), instance): str(value) for name, value in values.items()}
+    row['timestamp'] = str(int(time.time() * 1000))
+
+    data_to_post = initialize_api_post_data()
+    data_to_post['projectName'] = if_config_vars['telemetry_project']
+    data_to_post['agentType'] = 'CUSTOM'
+    data_to_post['samplingInterval'] = str(if_config_vars['run_interval'])
+    data_to_post['metricData'] = json.dumps([row])
+    post_data_to_if(data_to_post, 'customprojectrawdata')
+
+
 ################################
 # Functions to send data to IF #
 ################################
@@ -1529,54 +2947,452 @@ def send_data_wrapper():
     """ wrapper to send data """
     logger.debug('--- Chunk creation time: {} seconds ---'.format(
         round(time.time() - track['start_time'], 2)))
-    send_data_to_if(track['current_row'])
+    chunk_id = track['chunk_count']
     track['chunk_count'] += 1
+    count_telemetry('chunks_created_total')
+    count_telemetry('bytes_serialized_total', track['current_row_size'])
+    previous_stage = switch_telemetry_stage('send')
+    if sender:
+        # blocks while max_in_flight_chunks are already queued
+        sender['queue'].put((chunk_id, track['current_row']))
+    else:
+        complete_chunk(chunk_id, send_data_to_if(track['current_row']))
+    switch_telemetry_stage(previous_stage)
     reset_track()
 
 
+def start_sender():
+    """ start the background threads that post chunks to IF, if configured """
+    sender.clear()
+    if if_config_vars['max_in_flight_chunks'] <= 0:
+        return
+    sender['queue'] = Queue.Queue(maxsize=if_config_vars['max_in_flight_chunks'])
+    sender['lock'] = threading.Lock()
+    # chunk_id: accepted, for chunks that finished ahead of an earlier chunk
+    sender['completed'] = dict()
+    sender['threads'] = []
+    for i in range(if_config_vars['max_in_flight_chunks']):
+        sender_thread = threading.Thread(target=sender_loop, name='sender-{}'.format(i))
+        sender_thread.daemon = True
+        sender_thread.start()
+        sender['threads'].append(sender_thread)
+
+
+def stop_sender():
+    """ wait for queued chunks to be sent, then stop the sender threads """
+    if not sender:
+        return
+    for _ in sender['threads']:
+        sender['queue'].put(None)
+    for sender_thread in sender['threads']:
+        sender_thread.join()
+    sender.clear()
+
+
+def sender_loop():
+    while True:
+        item = sender['queue'].get()
+        if item is None:
+            break
+        chunk_id, chunk = item
+        accepted = False
+        try:
+            accepted = send_data_to_if(chunk)
+        except Exception as e:
+            logger.exception(e)
+        complete_chunk(chunk_id, accepted)
+
+
+def complete_chunk(chunk_id, accepted):
+    """ record a finished chunk, advancing track['chunks_completed'] over chunks that finished in order """
+    count_telemetry('chunks_sent_total', labels=(('result', 'accepted' if accepted else 'rejected'),))
+    if not sender:
+        track['chunks_completed'] = chunk_id + 1
+        track['chunks_accepted' if accepted else 'chunks_rejected'] += 1
+        return
+    with sender['lock']:
+        sender['completed'][chunk_id] = accepted
+        while track['chunks_completed'] in sender['completed']:
+            accepted = sender['completed'].pop(track['chunks_completed'])
+            track['chunks_completed'] += 1
+            track['chunks_accepted' if accepted else 'chunks_rejected'] += 1
+
+
+def open_spool(thread_number):
+    """ set up this worker's spool of chunks that could not be delivered, if configured """
+    spool.clear()
+    if not if_config_vars['spool_dir'] or cli_config_vars['testing']:
+        return
+    spool['dir'] = os.path.join(if_config_vars['spool_dir'], str(thread_number))
+    if not os.path.exists(spool['dir']):
+        os.makedirs(spool['dir'])
+    spool['lock'] = threading.Lock()
+
+
+def get_spool_segments():
+    """ segment file names, oldest first """
+    return sorted(f for f in os.listdir(spool['dir']) if f.endswith(SPOOL_SEGMENT_EXT))
+
+
+def get_spool_cursor():
+    """ the (segment, offset) up to which the spool has been replayed """
+    try:
+        with open(os.path.join(spool['dir'], SPOOL_CURSOR_FILE)) as cursor_file:
+            segment, offset = cursor_file.read().split()
+            return segment, int(offset)
+    except (IOError, ValueError):
+        return '', 0
+
+
+def set_spool_cursor(segment, offset):
+    cursor_path = os.path.join(spool['dir'], SPOOL_CURSOR_FILE)
+    with open(cursor_path + '.tmp', 'w') as cursor_file:
+        cursor_file.write('{} {}'.format(segment, offset))
+    os.rename(cursor_path + '.tmp', cursor_path)
+
+
+def spool_chunk(data_to_post):
+    """ append a chunk to the newest spool segment as '<length> <crc32>\n<payload>\n' """
+    payload = json.dumps(data_to_post)
+    record = '{} {}\n{}\n'.format(len(payload), zlib.crc32(payload) & 0xffffffff, payload)
+    with spool['lock']:
+        segments = get_spool_segments()
+        if not segments or os.path.getsize(os.path.join(spool['dir'], segments[-1])) >= SPOOL_SEGMENT_SIZE:
+            next_segment = int(segments[-1][:-len(SPOOL_SEGMENT_EXT)]) + 1 if segments else 0
+            segments.append('{:012d}{}'.format(next_segment, SPOOL_SEGMENT_EXT))
+        with open(os.path.join(spool['dir'], segments[-1]), 'ab') as segment_file:
+            segment_file.write(record)
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+        track['chunks_spooled'] += 1
+        count_telemetry('chunks_spooled_total')
+        logger.warn('Spooled undelivered chunk to {}'.format(segments[-1]))
+        trim_spool(segments)
+
+
+def trim_spool(segments):
+    """ drop the oldest segments while the spool is over spool_max_size """
+    sizes = [os.path.getsize(os.path.join(spool['dir'], segment)) for segment in segments]
+    while len(segments) > 1 and sum(sizes) > if_config_vars['spool_max_size']:
+        logger.warn('Spool is over {} bytes, dropping {}'.format(
+            if_config_vars['spool_max_size'], segments[0]))
+        os.remove(os.path.join(spool['dir'], segments.pop(0)))
+        sizes.pop(0)
+
+
+def read_spool_segment(segment, offset=0):
+    """ yield (next offset, payload) for each intact record in a segment, starting at offset """
+    with open(os.path.join(spool['dir'], segment), 'rb') as segment_file:
+        segment_file.seek(offset)
+        while True:
+            header = segment_file.readline()
+            if not header:
+                return
+            try:
+                length, checksum = [int(i) for i in header.split()]
+            except ValueError:
+                logger.warn('Corrupt record header in spool segment {} at {}'.format(segment, offset))
+                return
+            payload = segment_file.read(length)
+            if len(payload) != length or segment_file.read(1) != '\n':
+                logger.warn('Truncated record in spool segment {} at {}'.format(segment, offset))
+                return
+            record_offset = offset
+            offset = segment_file.tell()
+            # the length header still says where the next record starts
+            if zlib.crc32(payload) & 0xffffffff != checksum:
+                logger.warn('Skipping corrupt record in spool segment {} at {}'.format(segment, record_offset))
+                continue
+            yield offset, payload
+
+
+def replay_spool():
+    """ resend spooled chunks in order at no more than spool_replay_rate chunks per second """
+    if not spool:
+        return
+    interval = 1.0 / if_config_vars['spool_replay_rate']
+    cursor_segment, cursor_offset = get_spool_cursor()
+    replayed = 0
+    for segment in get_spool_segments():
+        if segment < cursor_segment:
+            continue
+        offset = cursor_offset if segment == cursor_segment else 0
+        for offset, payload in read_spool_segment(segment, offset):
+            start_time = time.time()
+            attempts = []
+            if not post_data_to_if(json.loads(payload), attempts=attempts):
+                if is_retryable_failure(attempts):
+                    logger.warn('Stopped replaying spool after {} chunks'.format(replayed))
+                    return
+                # so one chunk IF refuses doesn't hold back the rest
+                logger.error('Dropping a spooled chunk IF rejected with a client error')
+            else:
+                replayed += 1
+            set_spool_cursor(segment, offset)
+            time.sleep(max(0, interval - (time.time() - start_time)))
+        # fully replayed (or unreadable past this point)
+        os.remove(os.path.join(spool['dir'], segment))
+        if os.path.exists(os.path.join(spool['dir'], SPOOL_CURSOR_FILE)):
+            os.remove(os.path.join(spool['dir'], SPOOL_CURSOR_FILE))
+    logger.info('Replayed {} spooled chunks'.format(replayed))
+
+
+def start_chunk_sizing(thread_number):
+    """ start adapting this worker's chunk size to how IF responds, if max_chunk_size_kb is set """
+    if not if_config_vars['max_chunk_size']:
+        return
+    if chunk_sizing.get('pid') != os.getpid():
+        chunk_sizing.clear()
+        chunk_sizing['pid'] = os.getpid()
+        chunk_sizing['lock'] = threading.Lock()
+        chunk_sizing['path'] = abs_path_from_cur('.chunk_size-' + get_state_file_name(thread_number))
+        # pick up where the last run left off
+        size = if_config_vars['chunk_size']
+        try:
+            with open(chunk_sizing['path']) as size_file:
+                size = int(size_file.read())
+        except (IOError, OSError, ValueError):
+            pass
+        chunk_sizing['size'] = chunk_sizing['saved_size'] = size
+    # the bounds may have changed on reload
+    chunk_sizing['size'] = min(max(chunk_sizing['size'], if_config_vars['min_chunk_size']),
+                               if_config_vars['max_chunk_size'])
+    # the smallest chunk IF said was too large. forgotten each run, in case the limit was raised
+    chunk_sizing['too_large'] = if_config_vars['max_chunk_size'] + if_config_vars['min_chunk_size']
+    logger.debug('Starting with {} byte chunks'.format(chunk_sizing['size']))
+
+
+def stop_chunk_sizing():
+    """ save the chunk size for the next run """
+    if not chunk_sizing or chunk_sizing['size'] == chunk_sizing['saved_size']:
+        return
+    try:
+        with open(chunk_sizing['path'] + '.tmp', 'w') as size_file:
+            size_file.write(str(chunk_sizing['size']))
+        os.rename(chunk_sizing['path'] + '.tmp', chunk_sizing['path'])
+        chunk_sizing['saved_size'] = chunk_sizing['size']
+    except (IOError, OSError) as e:
+        logger.warning('Could not save the chunk size to {}: {}'.format(chunk_sizing['path'], e))
+
+
+def get_chunk_size():
+    """ the size to close chunks at """
+    if chunk_sizing:
+        return chunk_sizing['size']
+    return if_config_vars['chunk_size']
+
+
+def adjust_chunk_size(attempts, chunk_bytes):
+    """
+    Additive increase, multiplicative decrease: grow chunks by min_chunk_size_kb after each chunk IF took
+    promptly on the first try, and halve them after a timeout, a 413, or a server error.
+    Growth stops a step short of the smallest chunk IF has said was too large.
+    """
+    if not chunk_sizing:
+        return
+    statuses = [status for status, seconds in attempts]
+    with chunk_sizing['lock']:
+        size = chunk_sizing['size']
+        if 413 in statuses:
+            chunk_sizing['too_large'] = min(chunk_sizing['too_large'], chunk_bytes)
+        if any(status is None or status == 413 or status == 429 or status >= 500 for status in statuses):
+            chunk_sizing['size'] = max(if_config_vars['min_chunk_size'], int(size * CHUNK_SIZE_BACKOFF))
+        elif statuses == [200] and attempts[0][1] < CHUNK_SIZE_SLOW_POST_SECONDS:
+            chunk_sizing['size'] = max(size, min(if_config_vars['max_chunk_size'],
+                                                 size + if_config_vars['min_chunk_size'],
+                                                 chunk_sizing['too_large'] - if_config_vars['min_chunk_size']))
+        if chunk_sizing['size'] < size:
+            logger.info('Shrank chunks from {} to {} bytes after {}'.format(size, chunk_sizing['size'], statuses))
+        elif chunk_sizing['size'] > size:
+            logger.debug('Grew chunks from {} to {} bytes'.format(size, chunk_sizing['size']))
+
+
 def send_data_to_if(chunk_metric_data):
+    """ send a chunk to IF, returning whether it was accepted """
     send_data_time = time.time()
 
     # prepare data for metric streaming agent
-    data_to_post = initialize_api_post_data()
     if 'DEPLOYMENT' in if_config_vars['project_type'] or 'INCIDENT' in if_config_vars['project_type']:
         for chunk in chunk_metric_data:
             chunk['data'] = json.dumps(chunk['data'])
-    data_to_post[get_data_field_from_project_type()] = json.dumps(chunk_metric_data)
+    data_to_post = get_chunk_post_data(chunk_metric_data)
 
     logger.debug('First:\n' + str(chunk_metric_data[0] if len(chunk_metric_data) > 0 else ''))
     logger.debug('Last:\n' + str(chunk_metric_data[-1] if len(chunk_metric_data) > 0 else ''))
     logger.debug('Total Data (bytes): ' + str(get_json_size_bytes(data_to_post)))
-    logger.debug('Total Lines: ' + str(track['line_count']))
+    logger.debug('Total Lines: ' + str(len(chunk_metric_data)))
 
     # do not send if only testing or empty chunk
     if cli_config_vars['testing'] or len(chunk_metric_data) == 0:
         logger.debug('Skipping data ingestion...')
-        return
+        return True
 
     # send the data
-    post_url = urlparse.urljoin(if_config_vars['if_url'], get_api_from_project_type())
-    send_request(post_url, 'POST', 'Could not send request to IF',
-                 str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.',
-                 data=data_to_post, verify=False, proxies=if_config_vars['if_proxies'])
+    post_time = time.time()
+    rejected = post_chunk_to_if(chunk_metric_data, data_to_post)
+    observe_telemetry('chunk_send_seconds', time.time() - post_time)
+    if spool:
+        for rejected_data_to_post, retryable in rejected:
+            # resending what IF refused outright would only be refused again
+            if retryable:
+                spool_chunk(rejected_data_to_post)
+            else:
+                logger.error('Not spooling a chunk IF rejected with a client error')
     logger.debug('--- Send data time: %s seconds ---' % round(time.time() - send_data_time, 2))
+    return not rejected
+
+
+def get_chunk_post_data(chunk_metric_data):
+    """ prepare a chunk to post """
+    data_to_post = initialize_api_post_data()
+    data_to_post[get_data_field_from_project_type()] = json.dumps(chunk_metric_data)
+    return data_to_post
 
 
-def send_request(url, mode='GET', failure_message='Failure!', success_message='Success!', **request_passthrough):
-    """ sends a request to the given url """
+def post_chunk_to_if(chunk_metric_data, data_to_post):
+    """
+    post a chunk, splitting it in half for as long as IF says it is too large.
+    returns (data_to_post, whether it is worth retrying) for each post IF rejected
+    """
+    attempts = []
+    accepted = post_data_to_if(data_to_post, attempts=attempts)
+    adjust_chunk_size(attempts, len(data_to_post[get_data_field_from_project_type()]))
+    if accepted:
+        return []
+    if attempts and attempts[-1][0] == 413 and len(chunk_metric_data) > 1:
+        logger.warn('Splitting a chunk of {} entries that was too large for IF'.format(len(chunk_metric_data)))
+        rejected = []
+        for half in (chunk_metric_data[:len(chunk_metric_data) // 2], chunk_metric_data[len(chunk_metric_data) // 2:]):
+            rejected.extend(post_chunk_to_if(half, get_chunk_post_data(half)))
+        return rejected
+    return [(data_to_post, is_retryable_failure(attempts))]
+
+
+def is_retryable_failure(attempts):
+    """ whether a failed post could succeed later: after a network failure, throttling or a server error """
+    if not attempts:
+        return True
+    status = attempts[-1][0]
+    return status is None or status == 429 or status >= 500
+
+
+def post_data_to_if(data_to_post, api=None, attempts=None):
+    """ post prepared data to IF, returning whether it was accepted. attempts gets each attempt's (status, seconds) """
+    post_url = urlparse.urljoin(if_config_vars['if_url'], api or get_api_from_project_type())
+    success_message = str(get_json_size_bytes(data_to_post)) + ' bytes of data are reported.'
+    headers = dict()
+    if if_config_vars['if_compression']:
+        import urllib
+        data_to_post = compress_body(urllib.urlencode(data_to_post), if_config_vars['if_compression'])
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        headers['Content-Encoding'] = if_config_vars['if_compression']
+    response = send_request(post_url, 'POST', 'Could not send request to IF', success_message, attempts,
+                            data=data_to_post, headers=headers, verify=False, proxies=if_config_vars['if_proxies'])
+    return response != -1
+
+
+def compress_body(body, encoding):
+    """ compress a request body as gzip or deflate """
+    if encoding == 'gzip':
+        buf = StringIO()
+        gz = gzip.GzipFile(fileobj=buf, mode='wb')
+        gz.write(body)
+        gz.close()
+        return buf.getvalue()
+    return zlib.compress(body)
+
+
+def get_session():
+    """ get this process's pooled, keep-alive session """
+    # sessions are not shared across forks, as the pooled sockets would be
+    if transport.get('pid') != os.getpid():
+        # sender threads can get here at once; only the first makes the session
+        with TRANSPORT_LOCK:
+            if transport.get('pid') != os.getpid():
+                start_session()
+    return transport['session']
+
+
+def start_session():
+    import requests
+    session = requests.Session()
+    pool_size = max(10, if_config_vars.get('max_in_flight_chunks', 0))
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    transport.clear()
+    transport['session'] = session
+    transport['adapter'] = adapter
+    transport['lock'] = threading.Lock()
+    transport['requests'] = 0
+    transport['bytes_sent'] = 0
+    transport['bytes_received'] = 0
+    # set last, as get_session checks it without the lock
+    transport['pid'] = os.getpid()
+
+
+def record_transport_stats(response):
+    body = response.request.body or ''
+    with transport['lock']:
+        transport['requests'] += 1
+        transport['bytes_sent'] += len(body)
+        transport['bytes_received'] += len(response.content)
+
+
+def get_transport_stats():
+    """ bytes on the wire and connections opened by this process """
+    if transport.get('pid') != os.getpid():
+        return dict()
+    connections = 0
+    for pool_key in transport['adapter'].poolmanager.pools.keys():
+        connections += transport['adapter'].poolmanager.pools[pool_key].num_connections
+    return {
+        'requests': transport['requests'],
+        'connections': connections,
+        'bytes_sent': transport['bytes_sent'],
+        'bytes_received': transport['bytes_received']
+    }
+
+
+def log_transport_stats():
+    stats = get_transport_stats()
+    if stats:
+        logger.info('Requests: {}, connections opened: {}, body bytes sent: {}, received: {}'.format(
+            stats['requests'], stats['connections'], stats['bytes_sent'], stats['bytes_received']))
+
+
+def get_retry_delay(attempt):
+    """ exponential backoff with full jitter """
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def send_request(url, mode='GET', failure_message='Failure!', success_message='Success!', attempts=None,
+                 **request_passthrough):
+    """ sends a request to the given url, appending each attempt's (status, seconds) to attempts if given """
+    import httplib
+    import requests
     # determine if post or get (default)
-    req = requests.get
+    method = 'GET'
     if mode.upper() == 'POST':
-        req = requests.post
+        method = 'POST'
 
     global REQUESTS
     REQUESTS.update(request_passthrough)
     # logger.debug(REQUESTS)
 
+    session = get_session()
     req_num = 0
     for req_num in range(ATTEMPTS):
+        if req_num > 0:
+            count_telemetry('post_retries_total')
+            time.sleep(get_retry_delay(req_num - 1))
         try:
-            response = req(url, **request_passthrough)
+            request_time = time.time()
+            response = session.request(method, url, **request_passthrough)
+            observe_telemetry('post_latency_seconds', time.time() - request_time)
+            if attempts is not None:
+                attempts.append((response.status_code, time.time() - request_time))
+            record_transport_stats(response)
             if response.status_code == httplib.OK:
                 logger.info(success_message)
                 return response
@@ -1584,9 +3400,19 @@ def send_request(url, mode='GET', failure_message='Failure!', success_message='S
                 logger.warn(failure_message)
                 logger.info('Response Code: {}\nTEXT: {}'.format(
                     response.status_code, response.text))
+                # only server errors and throttling are worth retrying
+                if response.status_code < 500 and response.status_code != 429:
+                    break
         # handle various exceptions
         except requests.exceptions.Timeout:
             logger.exception('Timed out. Reattempting...')
+            if attempts is not None:
+                attempts.append((None, time.time() - request_time))
+            continue
+        except requests.exceptions.ConnectionError:
+            logger.exception('Connection failed. Reattempting...')
+            if attempts is not None:
+                attempts.append((None, time.time() - request_time))
             continue
         except requests.exceptions.TooManyRedirects:
             logger.exception('Too many redirects.')
@@ -1694,33 +3520,80 @@ if __name__ == "__main__":
     COMMA = regex.compile(r"\,")
     NON_ALNUM = regex.compile(r"[^a-zA-Z0-9]")
     FORMAT_STR = regex.compile(r"{(.*?)}")
+    MATH_EXPR_TOKENS = regex.compile(r"\s*(?:(\{.*?\})|(\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?)|([A-Za-z_]\w*)|(\S))")
+    MATH_EXPR_OPS = {'+': operator.add, '-': operator.sub, '*': operator.mul, '/': operator.div}
+    MATH_EXPR_FUNCTIONS = {'min': (min, 2, 255), 'max': (max, 2, 255), 'abs': (abs, 1, 1), 'round': (round, 1, 2)}
+    TIMESTAMP_TOKENS = regex.compile(r"(\[[^\[\]]*\]|YYY?Y?|MM?M?M?|Do|DD?D?D?|d?d?d?d|HH?|hh?|mm?|ss?|S+|ZZ?Z?|a|A|x|X)")
     HOSTNAME = socket.gethostname().partition('.')[0]
     ISO8601 = ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S', '%Y%m%dT%H%M%SZ', 'epoch']
     JSON_LEVEL_DELIM = '.'
     CSV_DELIM = r",|\t"
     ATTEMPTS = 3
+    WORKER_COUNTERS = ['chunk_count', 'entry_count', 'chunks_accepted', 'chunks_rejected', 'chunks_spooled',
+                       'metrics_suppressed']
+    SPOOL_SEGMENT_SIZE = 8 * 1024 * 1024
+    SPOOL_SEGMENT_EXT = '.seg'
+    SPOOL_CURSOR_FILE = 'cursor'
+    BACKOFF_BASE_SECONDS = 1
+    BACKOFF_MAX_SECONDS = 30
+    CHUNK_SIZE_BACKOFF = 0.5
+    CHUNK_SIZE_SLOW_POST_SECONDS = 5
+    STARTUP_BUDGET_SECONDS = 0.25
+    TELEMETRY_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    PROFILE_TOP_N = 25
+    DESTINATION_SECTION_PREFIX = 'insightfinder:'
+    FANOUT_BATCH_SIZE = 1000
+    FANOUT_QUEUE_BATCHES = 16
+    METRIC_AGGREGATES = {'last', 'min', 'max', 'sum', 'avg', 'count'}
+    SKETCH_RELATIVE_ACCURACY = 0.01
+    SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+    SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA)
+    SKETCH_MIN_VALUE = 1e-9
+    SKETCH_MAX_BINS = 2048
     REQUESTS = dict()
+    JSON_FIELD_GETTERS = dict()
+    MATH_EXPRS = dict()
+    FILTERS = dict()
+    TIMESTAMP_PARSERS = dict()
+    MIN_EPOCH_SECONDS = calendar.timegm(datetime.min.timetuple())
+    MAX_EPOCH_SECONDS = calendar.timegm(datetime.max.timetuple())
+    UTC_OFFSETS = dict()
+    TRANSPORT_LOCK = threading.Lock()
     track = dict()
     metric_buffer = dict()
+    sender = dict()
+    transport = dict()
+    spool = dict()
+    telemetry = dict()
+    profiler = dict()
+    chunk_sizing = dict()
+    suppression = dict()
+    aggregation = dict()
+    fanout = dict()
+    daemon = dict()
+    startup = {'last': STARTUP_TIME, 'stages': []}
+    record_startup_stage('imports and definitions')
 
     # get config
     cli_config_vars = get_cli_config_vars()
     logger = set_logger_config(cli_config_vars['log_level'])
     logger.debug(cli_config_vars)
+    record_startup_stage('options and logging')
     if_config_vars = get_if_config_vars()
+    record_startup_stage('insightfinder config')
     agent_config_vars = get_agent_config_vars()
+    destinations = get_destinations()
+    record_startup_stage('agent config')
     print_summary_info()
+    import_deferred_modules()
+    if cli_config_vars['profile_startup']:
+        report_startup_profile()
 
     # start data processing
-    process_list = []
-    for process_num in range(0, cli_config_vars['threads']):
-        p = Process(target=initialize_data_gathering,
-                    args=(process_num,)
-                    )
-        process_list.append(p)
-
-    for p in process_list:
-        p.start()
-
-    for p in process_list:
-        p.join()
+    # each worker only handles its own partition of the input, see get_worker_partition
+    counter_queue = ProcessQueue()
+    if cli_config_vars['daemon']:
+        run_daemon(counter_queue)
+    else:
+        process_list = start_workers(initialize_data_gathering, counter_queue)
+        merge_worker_counters(counter_queue, process_list)
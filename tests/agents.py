@@ -0,0 +1,52 @@
+# coding=utf-8
+"""
+Helpers for tests: loading an agent script as a module (see benchmark/agent_module.py), writing its
+config.ini, running it to see what it imports, and running the benchmark's mock InsightFinder API.
+"""
+import os
+import re
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmark'))
+
+import mock_insightfinder
+from agent_module import load_agent
+
+# run a script in this interpreter, then list which of the given modules it imported
+LIST_IMPORTS = '''import runpy, sys
+modules = sys.argv[1].split(',')
+sys.argv = sys.argv[2:]
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+print('imported: ' + ' '.join(module for module in modules if sys.modules.get(module)))
+'''
+
+
+def write_config(path, sections):
+    """ write a config.ini of {section: {option: value}} """
+    with open(path, 'w') as config_file:
+        for section, options in sections.items():
+            config_file.write('[{}]\n'.format(section))
+            for option, value in options.items():
+                config_file.write('{} = {}\n'.format(option, value))
+            config_file.write('\n')
+
+
+def start_mock_server(**options):
+    """ start the benchmark's mock InsightFinder API on a free port, returning it and its url """
+    server = mock_insightfinder.start_server(**options)
+    return server, 'http://{}:{}'.format(*server.server_address)
+
+
+def list_imports(script, args, modules, cwd):
+    """ run an agent script with args in a new interpreter, returning which of modules it imported """
+    output = subprocess.check_output([sys.executable, '-c', LIST_IMPORTS, ','.join(modules),
+                                      os.path.join(REPO_DIR, script)] + args, cwd=cwd)
+    imported = re.search(r'^imported:(.*)$', output, re.MULTILINE)
+    if not imported:
+        raise ValueError('{} did not finish: {}'.format(script, output))
+    return imported.group(1).split()
@@ -0,0 +1,54 @@
+# coding=utf-8
+import time
+import unittest
+
+from agents import load_agent
+
+LINE_SIZE = 10
+
+
+class AggregationCheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.agent = load_agent('file_replay/getmessages_file_replay.py')
+        self.agent.cli_config_vars = {'testing': True}
+        self.agent.if_config_vars = {'project_type': 'METRIC', 'sampling_interval': 60}
+        self.agent.agent_config_vars = {'metric_aggregates': self.agent.parse_metric_aggregates(['avg'])}
+        self.sent = []
+        self.agent.add_and_send_metric = lambda timestamp, *args: self.sent.append(timestamp)
+        self.agent.start_aggregation()
+        self.agent.checkpoint.update({'files': dict(), 'pending': dict(), 'reading': None, 'failed': False,
+                                      'dirty': False, 'written': time.time()})
+        self.agent.open_checkpoint_file('1', 'tailed.log', 0)
+
+    def read_line(self, timestamp):
+        """ tail a line holding a sample at timestamp """
+        self.agent.advance_checkpoint(LINE_SIZE)
+        self.agent.aggregate_metric(timestamp, 'cpu', 1, 'host')
+
+    def get_committed(self):
+        self.agent.commit_checkpoint([])
+        return self.agent.checkpoint['files']['1']
+
+    def test_checkpoint_stays_at_the_oldest_buffered_sample(self):
+        self.read_line(60000)
+        self.read_line(61000)
+        self.assertEqual(self.get_committed()['offset'], 0)
+        self.read_line(120000)
+        self.read_line(180000)
+        # the first bucket has been sent, the second is still buffered from the third line
+        self.assertEqual(self.sent, [60000])
+        self.assertEqual(self.get_committed()['offset'], 2 * LINE_SIZE)
+
+    def test_closed_file_completes_once_its_samples_are_sent(self):
+        self.read_line(60000)
+        self.read_line(120000)
+        self.agent.close_checkpoint_file(completed=True)
+        committed = self.get_committed()
+        self.assertEqual((committed['offset'], committed['completed']), (0, False))
+        self.agent.flush_aggregation()
+        committed = self.get_committed()
+        self.assertEqual((committed['offset'], committed['completed']), (2 * LINE_SIZE, True))
+
+
+if __name__ == '__main__':
+    unittest.main()
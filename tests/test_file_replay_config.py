@@ -0,0 +1,47 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+from agents import load_agent, write_config
+
+# file_replay's config.ini before options were added to it
+OLD_CONFIG = OrderedDict([
+    ('agent', OrderedDict([
+        ('file_path', ''), ('file_name_regex', ''), ('filters_include', ''), ('filters_exclude', ''),
+        ('data_format', 'json'), ('raw_regex', ''), ('raw_start_regex', ''), ('csv_field_names', ''),
+        ('csv_field_delimiter', r',|\t'), ('json_top_level', ''), ('timestamp_format', 'epoch'), ('timezone', ''),
+        ('timestamp_field', 'timestamp'), ('instance_field', 'host'), ('device_field', ''), ('data_fields', '')])),
+    ('insightfinder', OrderedDict([
+        ('user_name', 'user'), ('license_key', 'key'), ('token', ''), ('project_name', 'project'),
+        ('project_type', 'metric'), ('sampling_interval', '1'), ('run_interval', '10'), ('chunk_size_kb', '2048'),
+        ('if_url', 'https://app.insightfinder.com'), ('if_http_proxy', ''), ('if_https_proxy', '')])),
+    ('state', OrderedDict([('current_file', ''), ('current_file_offset', ''), ('completed_files_st_ino', '')]))
+])
+
+
+class OldConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.agent = load_agent('file_replay/getmessages_file_replay.py')
+        self.work_dir = tempfile.mkdtemp()
+        config_ini = os.path.join(self.work_dir, 'config.ini')
+        OLD_CONFIG['agent']['file_path'] = self.work_dir
+        write_config(config_ini, OLD_CONFIG)
+        self.agent.cli_config_vars = {'config': config_ini, 'testing': True, 'threads': 1}
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_agent_options_default_to_old_behaviour(self):
+        self.agent.if_config_vars = self.agent.get_if_config_vars()
+        agent_config_vars = self.agent.get_agent_config_vars()
+        self.assertEqual(agent_config_vars['replay_order'], '')
+        self.assertEqual(agent_config_vars['split_file_bytes'], 0)
+        self.assertEqual(agent_config_vars['csv_block_rows'], 0)
+        self.assertFalse(agent_config_vars['metric_aggregates'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# coding=utf-8
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+from agents import load_agent, write_config
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+CSV_FIELD_NAMES = 'timestamp,host,cpu,mem,disk'
+# rows the block path reads a column at a time, then blocks it has to hand off a row at a time
+PLAIN_ROWS = ['{},host-{},{},{},{}'.format(1600000000000 + (i // 4) * 60000, i % 4, i * 1.5, i % 7, 100 - i)
+              for i in range(40)]
+AWKWARD_ROWS = [
+    '1600003000000,host-0,,5,6',  # a blank value
+    '1600003000000,host-1,n/a,5,6',  # a non-numeric value
+    '1600003060000,host-2,1,2',  # a short line
+    '1600003060000\thost-3\t1\t2\t3',  # tabs, which the default delimiter also splits on
+    '1600003120000,host-0,1,2,3\r',  # a windows line ending
+    '1600003120000,,7,8,9',  # no instance
+    '',  # a blank line
+]
+IFEXPORT_ROWS = ['timestamp,cpu[host-0],mem[host-0]'] + [
+    '{},{},{}'.format(1600000000000 + i * 60000, i, i * 2) for i in range(30)] + ['1600001800000,,1']
+
+
+@unittest.skipIf(pandas is None, 'csv_block_rows needs pandas')
+class CsvBlocksTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.work_dir, 'data')
+        os.makedirs(self.data_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_fixture(self, lines):
+        with open(os.path.join(self.data_dir, 'fixture.csv'), 'w') as fixture:
+            fixture.write('\n'.join(lines) + '\n')
+
+    def replay(self, data_format, project_type, csv_block_rows):
+        """ replay the fixture, returning the chunks file_replay would have sent """
+        agent = load_agent('file_replay/getmessages_file_replay.py')
+        config_ini = os.path.join(self.work_dir, 'config.ini')
+        write_config(config_ini, OrderedDict([
+            ('agent', OrderedDict([
+                ('file_path', self.data_dir), ('file_name_regex', r'^fixture\.csv$'), ('filters_include', ''),
+                ('filters_exclude', ''), ('data_format', data_format), ('raw_regex', ''), ('raw_start_regex', ''),
+                ('csv_field_names', CSV_FIELD_NAMES), ('csv_field_delimiter', r',|\t'),
+                ('csv_block_rows', csv_block_rows), ('json_top_level', ''), ('timestamp_format', 'epoch'),
+                ('timezone', ''), ('timestamp_field', 'timestamp'), ('instance_field', 'host'),
+                ('device_field', ''), ('data_fields', '' if 'METRIC' in project_type.upper() else 'cpu,mem,disk')])),
+            ('insightfinder', OrderedDict([
+                ('user_name', 'user'), ('license_key', 'key'), ('token', ''), ('project_name', 'project'),
+                ('project_type', project_type), ('sampling_interval', '1'), ('run_interval', '10'),
+                ('chunk_size_kb', '2048'), ('if_url', 'https://app.insightfinder.com'), ('if_http_proxy', ''),
+                ('if_https_proxy', '')])),
+            ('state', OrderedDict([('current_file', ''), ('current_file_offset', ''),
+                                   ('completed_files_st_ino', '')]))
+        ]))
+        agent.cli_config_vars = {'config': config_ini, 'testing': True, 'threads': 1}
+        agent.if_config_vars = agent.get_if_config_vars()
+        # so a slow run doesn't close chunks at different places
+        agent.if_config_vars['sampling_interval'] = 3600
+        agent.agent_config_vars = agent.get_agent_config_vars()
+        chunks = []
+
+        def send_data_to_if(chunk_metric_data):
+            chunks.append(json.loads(json.dumps(chunk_metric_data)))
+            return True
+
+        agent.send_data_to_if = send_data_to_if
+        agent.initialize_data_gathering(0)
+        return chunks
+
+    def assert_same_output(self, data_format, project_type):
+        by_row = self.replay(data_format, project_type, '')
+        self.assertTrue(by_row)
+        for csv_block_rows in ('1', '7', '1000'):
+            self.assertEqual(self.replay(data_format, project_type, csv_block_rows), by_row,
+                             'csv_block_rows = {}'.format(csv_block_rows))
+
+    def test_metric_columns(self):
+        self.write_fixture(PLAIN_ROWS)
+        self.assert_same_output('csv', 'metricreplay')
+
+    def test_metric_rows_with_awkward_values(self):
+        self.write_fixture(PLAIN_ROWS + AWKWARD_ROWS + PLAIN_ROWS)
+        self.assert_same_output('csv', 'metricreplay')
+
+    def test_log_rows(self):
+        self.write_fixture(PLAIN_ROWS + AWKWARD_ROWS)
+        self.assert_same_output('csv', 'logreplay')
+
+    def test_ifexport(self):
+        self.write_fixture(IFEXPORT_ROWS)
+        self.assert_same_output('ifexport', 'metricreplay')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+# coding=utf-8
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+
+from agents import list_imports, write_config
+from test_file_replay_config import OLD_CONFIG
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+SCRIPT = 'file_replay/getmessages_file_replay.py'
+# modules only some data formats and project types use
+DEFERRED_MODULES = ('requests', 'httplib', 'pandas', 'xlrd', 'avro', 'xml2dict', 'statistics')
+
+
+class StartupTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.config = copy.deepcopy(OLD_CONFIG)
+        self.config['agent']['file_path'] = self.work_dir
+        self.config['insightfinder']['project_type'] = 'log'
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def list_imports(self, args=('-t', '-q')):
+        """ the deferred modules a run over an empty directory imports """
+        config_ini = os.path.join(self.work_dir, 'config.ini')
+        write_config(config_ini, self.config)
+        return list_imports(SCRIPT, ['-c', config_ini] + list(args), DEFERRED_MODULES, self.work_dir)
+
+    def test_optional_modules_stay_deferred(self):
+        self.assertEqual(self.list_imports(), [])
+
+    def test_metric_project_imports_statistics(self):
+        self.config['insightfinder']['project_type'] = 'metric'
+        self.assertEqual(self.list_imports(), ['statistics'])
+
+    @unittest.skipIf(pandas is None, 'csv_block_rows needs pandas')
+    def test_csv_blocks_import_pandas(self):
+        self.config['agent'].update({'data_format': 'csv', 'csv_field_names': 'timestamp,host,message',
+                                     'csv_block_rows': '1000'})
+        imported = self.list_imports()
+        self.assertIn('pandas', imported)
+        self.assertNotIn('requests', imported)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import Queue
+
+from agents import load_agent
+
+# how long a tail waits for a write before it gives up on the file
+RUN_INTERVAL = 2
+# longer than a poll, so anything the tail would read has been read
+SETTLE_SECONDS = 0.5
+
+
+class Tail(object):
+    """ run a tail in the background, collecting the lines it yields """
+    def __init__(self, lines):
+        self.queue = Queue.Queue()
+        self.finished = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(lines,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, lines):
+        try:
+            for line in lines:
+                self.queue.put(line)
+        finally:
+            self.finished.set()
+
+    def get_lines(self):
+        """ the lines yielded so far """
+        lines = []
+        while not self.queue.empty():
+            lines.append(self.queue.get())
+        return lines
+
+    def wait_for_lines(self, count, timeout=5):
+        lines = []
+        for _ in range(count):
+            lines.append(self.queue.get(timeout=timeout))
+        return lines
+
+    def join(self, timeout):
+        """ wait for the tail to run out of lines, returning whether it did """
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+
+class TailTest(object):
+    use_inotify = None
+
+    def setUp(self):
+        self.agent = load_agent('file_replay/getmessages_file_replay.py')
+        if not self.use_inotify:
+            # as where inotify isn't available
+            self.agent.INOTIFY['libc'] = None
+        elif not self.agent.get_inotify():
+            self.skipTest('inotify is not available')
+        self.agent.if_config_vars = {'run_interval': RUN_INTERVAL}
+        self.agent.agent_config_vars = {'data_format': 'RAWTAILF'}
+        self.agent.checkpoint.update({'files': dict(), 'pending': dict(), 'reading': None})
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.work_dir, 'tailed.log')
+        self.write('first\nsecond\n', 'w')
+        self.data = None
+        self.tails = []
+
+    def tearDown(self):
+        # the tails read from self.data, so they have to stop before it is closed
+        self.stop_tails()
+        if self.data:
+            self.data.close()
+        shutil.rmtree(self.work_dir)
+
+    def follow(self, lines):
+        """ collect the lines in the background, until stop_tails """
+        tail = Tail(lines)
+        self.tails.append(tail)
+        return tail
+
+    def stop_tails(self):
+        """ make the tailed file go idle at once, and wait for the tails to see it and finish """
+        self.agent.if_config_vars['run_interval'] = 0
+        if os.path.exists(self.path):
+            # wakes a tail waiting on inotify
+            os.utime(self.path, None)
+        for tail in self.tails:
+            self.assertTrue(tail.join(RUN_INTERVAL + 5), 'a tail is still running')
+
+    def write(self, text, mode='a', path=None):
+        with open(path or self.path, mode) as log_file:
+            log_file.write(text)
+
+    def start_tail(self):
+        """ tail the file from its end, as the reader does once it has read what was already there """
+        self.data = open(self.path)
+        self.data.read()
+        self.agent.open_checkpoint_file(str(os.fstat(self.data.fileno()).st_ino), self.path, self.data.tell())
+        return self.follow(self.agent.tail_file(self.path, self.data))
+
+    def test_append(self):
+        tail = self.start_tail()
+        self.write('third\n')
+        self.assertEqual(tail.wait_for_lines(1), ['third\n'])
+        self.write('fourth\nfifth\n')
+        self.assertEqual(tail.wait_for_lines(2), ['fourth\n', 'fifth\n'])
+
+    def test_half_written_line(self):
+        tail = self.start_tail()
+        self.write('thi')
+        time.sleep(SETTLE_SECONDS)
+        self.assertEqual(tail.get_lines(), [])
+        self.write('rd\n')
+        self.assertEqual(tail.wait_for_lines(1), ['third\n'])
+
+    def test_half_written_line_at_start(self):
+        self.write('thi')
+        with open(self.path) as data:
+            st_ino = str(os.fstat(data.fileno()).st_ino)
+        tail = self.follow(self.agent.reader('RAWTAILF', self.path, st_ino))
+        self.assertEqual(tail.wait_for_lines(2), ['first\n', 'second\n'])
+        time.sleep(SETTLE_SECONDS)
+        self.assertEqual(tail.get_lines(), [])
+        self.write('rd\n')
+        self.assertEqual(tail.wait_for_lines(1), ['third\n'])
+        self.assertTrue(tail.finished.wait(RUN_INTERVAL + 5))
+        # the file is done with once it stops being written to
+        self.assertTrue(self.agent.checkpoint['pending'][st_ino]['completed'])
+        self.assertEqual(self.agent.checkpoint['pending'][st_ino]['offset'], os.path.getsize(self.path))
+
+    def test_copytruncate(self):
+        tail = self.start_tail()
+        shutil.copy(self.path, self.path + '.1')
+        self.write('', 'w')
+        self.write('after\n')
+        self.assertEqual(tail.wait_for_lines(1), ['after\n'])
+        self.assertEqual(self.agent.checkpoint['reading']['line_start'], 0)
+
+    def test_rename(self):
+        tail = self.start_tail()
+        self.write('last\n')
+        os.rename(self.path, self.path + '.1')
+        self.write('other\n', 'w')
+        self.assertEqual(tail.wait_for_lines(1), ['last\n'])
+        # a rotated file is finished without waiting out run_interval, and the new file is left for the reader
+        self.assertTrue(tail.finished.wait(RUN_INTERVAL / 2.0))
+        self.assertEqual(tail.get_lines(), [])
+
+    def test_stops_after_run_interval_without_writes(self):
+        start_time = time.time()
+        tail = self.start_tail()
+        self.assertTrue(tail.finished.wait(RUN_INTERVAL + 5))
+        self.assertGreaterEqual(time.time() - start_time, RUN_INTERVAL)
+        self.assertEqual(tail.get_lines(), [])
+
+
+class InotifyTailTest(TailTest, unittest.TestCase):
+    use_inotify = True
+
+
+class PollingTailTest(TailTest, unittest.TestCase):
+    use_inotify = False
+
+
+if __name__ == '__main__':
+    unittest.main()
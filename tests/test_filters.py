@@ -0,0 +1,76 @@
+# coding=utf-8
+import unittest
+
+from agents import load_agent
+
+# a large exclusion list, as the compiled matchers are for
+EXCLUDED_HOSTS = ['host-{:04d}'.format(i) for i in range(2000)]
+FILTERS_INCLUDE = ['level:error,warn', 'source:billing']
+FILTERS_EXCLUDE = ['host:' + ','.join(EXCLUDED_HOSTS), 'msg:healthcheck']
+
+
+def is_filtered_as_before(message):
+    """ the agents' filters before they were compiled: case-insensitive substrings, field by field """
+    def has_hit(_filter):
+        (filter_field, filter_vals) = _filter.split(':')
+        return any(filter_val.upper() in message[filter_field].upper() for filter_val in filter_vals.split(','))
+    return not any(has_hit(_filter) for _filter in FILTERS_INCLUDE) or \
+        any(has_hit(_filter) for _filter in FILTERS_EXCLUDE)
+
+
+MESSAGES = [
+    {'level': 'ERROR', 'source': 'api', 'host': 'web-1', 'msg': 'timeout'},
+    {'level': 'info', 'source': 'api', 'host': 'web-1', 'msg': 'timeout'},
+    {'level': 'info', 'source': 'Billing-2', 'host': 'web-1', 'msg': 'ok'},
+    {'level': 'Warning', 'source': 'api', 'host': 'host-1999', 'msg': 'ok'},
+    {'level': 'warn', 'source': 'api', 'host': 'rack-2/HOST-0042.dc', 'msg': 'ok'},
+    {'level': 'error', 'source': 'api', 'host': 'host-20000', 'msg': 'ok'},
+    {'level': 'error', 'source': 'api', 'host': 'web-2', 'msg': 'HealthCheck passed'},
+    {'level': '', 'source': '', 'host': '', 'msg': ''},
+]
+
+
+class FilterTest(object):
+    script = None
+
+    def setUp(self):
+        self.agent = load_agent(self.script)
+        self.include = self.agent.compile_filters(FILTERS_INCLUDE)
+        self.exclude = self.agent.compile_filters(FILTERS_EXCLUDE)
+
+    def is_filtered(self, message):
+        raise NotImplementedError
+
+    def test_same_as_substring_filters(self):
+        for message in MESSAGES:
+            self.assertEqual(self.is_filtered(message), is_filtered_as_before(message), message)
+
+    def test_hit_is_the_value_found(self):
+        (host_matcher, _) = self.exclude
+        self.assertEqual(self.agent.get_filter_hit(host_matcher, 'rack-2/host-0042.dc'), 'HOST-0042')
+        self.assertEqual(self.agent.get_filter_hit(host_matcher, 'host-0007'), 'HOST-0007')
+        self.assertIsNone(self.agent.get_filter_hit(host_matcher, 'web-1'))
+
+
+class TemplateFilterTest(FilterTest, unittest.TestCase):
+    script = 'template/insightagent-boilerplate.py'
+
+    def is_filtered(self, message):
+        filters = {'include': self.include, 'exclude': self.exclude}
+        return self.agent.get_filter_reason(filters, lambda field: message[field]) is not None
+
+
+class FileReplayFilterTest(FilterTest, unittest.TestCase):
+    script = 'file_replay/getmessages_file_replay.py'
+
+    def is_filtered(self, message):
+        self.agent.FILTERS.update({'include': self.include, 'exclude': self.exclude})
+        return self.agent.is_filtered(lambda field: message[field])
+
+
+class Kafka2FilterTest(FileReplayFilterTest):
+    script = 'kafka2/getmessages_kafka2.py'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+# coding=utf-8
+import copy
+import unittest
+
+from agents import load_agent
+
+MESSAGE = {
+    'host': 'web-1',
+    'hosts': [{'host': 'web-2', 'zone': 'a'}, {'host': 'web-3', 'zone': 'b'}],
+    'meta': {'host': 'web-4', 'tags': [{'host': 'web-5'}]},
+    'single': [{'host': 'web-6'}]
+}
+
+
+class JsonFieldTest(object):
+    script = None
+
+    def setUp(self):
+        self.agent = load_agent(self.script)
+        self.message = copy.deepcopy(MESSAGE)
+
+    def get_field(self, field):
+        return self.agent.get_json_field(self.message, field, allow_list=True, remove=True)
+
+    def test_top_level_fields_are_removed(self):
+        self.assertEqual(self.get_field('host'), 'web-1')
+        self.assertNotIn('host', self.message)
+
+    def test_fields_in_lists_are_left_in_place(self):
+        self.assertEqual(self.get_field('hosts.host'), ['web-2', 'web-3'])
+        self.assertEqual(self.get_field('single.host'), 'web-6')
+        self.assertEqual(self.get_field('meta.tags.host'), 'web-5')
+        self.assertEqual(self.message, MESSAGE)
+
+    def test_nested_fields_are_left_in_place(self):
+        self.assertEqual(self.get_field('meta.host'), 'web-4')
+        self.assertEqual(self.message, MESSAGE)
+
+
+class TemplateJsonFieldTest(JsonFieldTest, unittest.TestCase):
+    script = 'template/insightagent-boilerplate.py'
+
+
+class FileReplayJsonFieldTest(JsonFieldTest, unittest.TestCase):
+    script = 'file_replay/getmessages_file_replay.py'
+
+
+class Kafka2JsonFieldTest(JsonFieldTest, unittest.TestCase):
+    script = 'kafka2/getmessages_kafka2.py'
+
+
+if __name__ == '__main__':
+    unittest.main()
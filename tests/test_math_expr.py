@@ -0,0 +1,98 @@
+# coding=utf-8
+import unittest
+
+from agents import load_agent
+
+MESSAGES = [
+    {'a': 7, 'b': 2, 'c': '3.5', 'x': 10, 'y': -4, 's': '12', 'big': 12345678901},
+    {'a': -3, 'b': 5, 'c': 0.25, 'x': '1e3', 'y': 3, 's': '-0.5', 'big': 1},
+    {'a': '100', 'b': '7', 'c': '-2', 'x': 0, 'y': 1, 's': '3', 'big': -98765432109876},
+]
+# eval only ever saw top level fields, as str.format reads {n.x} as an attribute of n
+EXPRESSIONS = [
+    '{a}',
+    '{a}+{b}',
+    '{a}-{b}*{c}',
+    '{a}/{b}',
+    '{c}/{b}',
+    '{x}/{y}',
+    '({a}+{b})*{c}',
+    '-{a}+{x}',
+    '{a}--{b}',
+    '{a}*-{b}',
+    '{s}*2',
+    '2.5e2*{a}',
+    '.5*{a}+1.',
+    '{big}*{big}',
+    '(({a}))/(({b}+1))',
+    'max({a},{b},{c})',
+    'min({a}, {y})',
+    'abs({y})',
+    'round({c}*3)',
+    'round({c}/3, 2)',
+    'max(abs({a}), round({c}))*2',
+]
+
+
+def evaluate_as_before(agent, message, expr):
+    """ the template's data_fields evaluation before the compiled evaluator: fill in the fields, then eval """
+    value = agent.get_single_value(message, expr, default=0, allow_list=False, remove=False)
+    return eval(value) if value else value
+
+
+def evaluate_as_before_in_agents(agent, message, expr):
+    """ as evaluate_as_before, for file_replay and kafka2, which filled in fields with parse_formatted """
+    return eval(agent.parse_formatted(message, expr, default=expr, allow_list=True))
+
+
+class MathExprTest(object):
+    script = None
+    evaluate_as_before = None
+
+    def setUp(self):
+        self.agent = load_agent(self.script)
+
+    def test_same_as_eval(self):
+        for message in MESSAGES:
+            for expr in EXPRESSIONS:
+                expected = self.evaluate_as_before(self.agent, message, expr)
+                actual = self.agent.evaluate_math_expr(message, expr)
+                self.assertEqual(actual, expected, '{} of {}'.format(expr, message))
+                self.assertEqual(type(actual), type(expected), '{} of {}'.format(expr, message))
+
+    def test_nested_fields(self):
+        message = {'n': {'x': 10, 'y': '-4'}}
+        self.assertEqual(self.agent.evaluate_math_expr(message, '{n.x}/{n.y}'), -3)
+
+    def test_errors_give_the_default(self):
+        message = {'a': 'text', 'b': 0}
+        self.assertEqual(self.agent.evaluate_math_expr(message, '{a}+1'), '')
+        self.assertEqual(self.agent.evaluate_math_expr(message, '1/{b}'), '')
+
+    def test_anything_but_arithmetic_is_rejected(self):
+        for expr in ('__import__("os")', '{a}.real', '{a}**2', '[{a}]', 'max', 'abs({a}, {b})', '{a}+'):
+            self.assertRaises(ValueError, self.agent.compile_math_expr, expr)
+
+
+class TemplateMathExprTest(MathExprTest, unittest.TestCase):
+    script = 'template/insightagent-boilerplate.py'
+    evaluate_as_before = staticmethod(evaluate_as_before)
+
+    def test_missing_fields_count_as_zero(self):
+        message = {'a': 7}
+        for expr in ('{missing}+{a}', '{a}*{missing}', 'max({missing}, -1)'):
+            self.assertEqual(self.agent.evaluate_math_expr(message, expr), evaluate_as_before(self.agent, message, expr))
+
+
+class FileReplayMathExprTest(MathExprTest, unittest.TestCase):
+    script = 'file_replay/getmessages_file_replay.py'
+    evaluate_as_before = staticmethod(evaluate_as_before_in_agents)
+
+
+class Kafka2MathExprTest(MathExprTest, unittest.TestCase):
+    script = 'kafka2/getmessages_kafka2.py'
+    evaluate_as_before = staticmethod(evaluate_as_before_in_agents)
+
+
+if __name__ == '__main__':
+    unittest.main()
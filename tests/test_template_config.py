@@ -0,0 +1,55 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+from agents import load_agent, write_config
+
+# the template's config.ini before options were added to it
+OLD_CONFIG = OrderedDict([
+    ('agent', OrderedDict([
+        ('filters_include', ''), ('filters_exclude', ''), ('data_format', 'json'), ('raw_regex', ''),
+        ('raw_start_regex', ''), ('csv_field_names', ''), ('csv_field_delimiter', r',|\t'),
+        ('json_top_level', ''), ('timestamp_format', 'epoch'), ('timezone', ''), ('timestamp_field', 'timestamp'),
+        ('instance_field', 'host'), ('device_field', ''), ('data_fields', ''), ('all_metrics', ''),
+        ('metric_buffer_size_mb', '10'), ('agent_http_proxy', ''), ('agent_https_proxy', '')])),
+    ('insightfinder', OrderedDict([
+        ('user_name', 'user'), ('license_key', 'key'), ('token', ''), ('project_name', 'project'),
+        ('project_type', 'metric'), ('sampling_interval', '1'), ('run_interval', '10'), ('chunk_size_kb', '2048'),
+        ('if_url', 'https://app.insightfinder.com'), ('if_http_proxy', ''), ('if_https_proxy', '')]))
+])
+
+
+class OldConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.agent = load_agent('template/insightagent-boilerplate.py')
+        self.work_dir = tempfile.mkdtemp()
+        config_ini = os.path.join(self.work_dir, 'config.ini')
+        write_config(config_ini, OLD_CONFIG)
+        self.agent.cli_config_vars = {'config': config_ini, 'testing': True}
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_insightfinder_options_default_to_old_behaviour(self):
+        if_config_vars = self.agent.get_if_config_vars()
+        self.assertEqual(if_config_vars['chunk_size'], 2048 * 1024)
+        self.assertEqual(if_config_vars['max_chunk_size'], 0)
+        self.assertEqual(if_config_vars['max_in_flight_chunks'], 0)
+        self.assertEqual(if_config_vars['if_compression'], '')
+        self.assertEqual(if_config_vars['spool_dir'], '')
+        self.assertEqual(if_config_vars['telemetry_dir'], '')
+        self.assertEqual(if_config_vars['telemetry_project'], '')
+        self.assertEqual(if_config_vars['run_jitter'], 0)
+
+    def test_agent_options_default_to_old_behaviour(self):
+        agent_config_vars = self.agent.get_agent_config_vars()
+        self.assertEqual(agent_config_vars['suppression_heartbeat'], 0)
+        self.assertEqual(agent_config_vars['suppression_tolerance'], 0)
+        self.assertFalse(agent_config_vars['metric_aggregates'])
+
+
+if __name__ == '__main__':
+    unittest.main()
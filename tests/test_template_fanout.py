@@ -0,0 +1,89 @@
+# coding=utf-8
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+
+from agents import load_agent, write_config
+from test_template_config import OLD_CONFIG
+
+MESSAGES = [
+    ['1600000000000', 'web-1', 'debug', 'cache warm'],
+    ['1600000060000', 'web-1', 'error', 'timeout'],
+]
+
+
+class FanoutTest(unittest.TestCase):
+    def setUp(self):
+        self.agent = load_agent('template/insightagent-boilerplate.py')
+        self.agent.if_config_vars = {'project_type': 'LOG'}
+        self.agent.FILTERS.update({'include': [], 'exclude': []})
+        self.agent.fanout.update({'destinations': [
+            {'name': 'no-debug', 'filters': {'include': [], 'exclude': self.agent.compile_filters(['2:debug'])},
+             'batch': []},
+            {'name': 'errors', 'filters': {'include': self.agent.compile_filters(['2:error']), 'exclude': []},
+             'batch': []}
+        ]})
+        self.agent.end_route()
+        self.to_primary = []
+        # a message's handoffs, as parse_csv_row would make them
+        self.agent.parse_csv_row = lambda row, *args: self.hand_off(row[1])
+
+    def hand_off(self, data):
+        if self.agent.fan_out('log_handoff', 1600000000000, data, 'web-1'):
+            self.to_primary.append(data)
+
+    def get_batches(self):
+        return dict((destination['name'], [args[1] for (_, args) in destination['batch']])
+                    for destination in self.agent.fanout['destinations'])
+
+    def test_routed_messages_go_to_their_destinations(self):
+        self.agent.agent_config_vars = {'instance_field': 1, 'device_field': None, 'timestamp_field': 0,
+                                        'data_fields': [3], 'csv_field_names': ['ts', 'host', 'level', 'msg']}
+        for message in MESSAGES:
+            self.agent.parse_csv_message(message)
+        self.assertEqual(self.get_batches(), {'no-debug': ['timeout'], 'errors': ['timeout']})
+        self.assertEqual(self.to_primary, ['cache warm', 'timeout'])
+
+    def test_unrouted_handoffs_go_everywhere_after_a_routed_message(self):
+        self.agent.agent_config_vars = {'instance_field': 1, 'device_field': None, 'timestamp_field': 0,
+                                        'data_fields': [3], 'csv_field_names': ['ts', 'host', 'level', 'msg']}
+        self.agent.parse_csv_message(MESSAGES[0])
+        self.hand_off('flushed')
+        self.assertEqual(self.get_batches(), {'no-debug': ['flushed'], 'errors': ['flushed']})
+        self.assertEqual(self.to_primary, ['cache warm', 'flushed'])
+
+    def test_unrouted_handoffs_go_everywhere_after_a_dropped_message(self):
+        self.agent.FILTERS['exclude'] = self.agent.compile_filters(['2:debug'])
+        self.agent.fanout['destinations'][1]['filters']['include'] = self.agent.compile_filters(['2:nothing'])
+        self.assertFalse(self.agent.route_message(lambda field: MESSAGES[0][int(field)]))
+        self.hand_off('flushed')
+        self.assertEqual(self.get_batches(), {'no-debug': ['flushed'], 'errors': ['flushed']})
+        self.assertEqual(self.to_primary, ['flushed'])
+
+
+class DestinationStateFileTest(unittest.TestCase):
+    def setUp(self):
+        self.agent = load_agent('template/insightagent-boilerplate.py')
+        self.work_dir = tempfile.mkdtemp()
+        config = copy.deepcopy(OLD_CONFIG)
+        config['insightfinder:backup'] = {'if_url': 'https://backup.example.com'}
+        config_ini = os.path.join(self.work_dir, 'config.ini')
+        write_config(config_ini, config)
+        self.agent.cli_config_vars = {'config': config_ini, 'testing': True}
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_destinations_with_the_same_project_have_their_own_state_files(self):
+        self.agent.if_config_vars = self.agent.get_if_config_vars()
+        primary = self.agent.get_state_file_name(0)
+        self.agent.if_config_vars = self.agent.get_if_config_vars('insightfinder:backup')
+        backup = self.agent.get_state_file_name(0)
+        self.assertEqual(primary, 'project-0')
+        self.assertEqual(backup, 'project@backup-0')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,237 @@
+# coding=utf-8
+import random
+import unittest
+
+from agents import load_agent
+
+# a large enough run_interval that only chunk_size closes chunks
+RUN_INTERVAL = 3600
+
+
+class MetricBufferAsBefore(object):
+    """
+    The template's metric buffer before hashed timestamp buckets and column tables: a dict of
+    {'metric[instance]': 'value'} strings per ts-instance key, flushed oldest first from a sorted list.
+    """
+    def __init__(self, agent):
+        self.agent = agent
+        self.key_list = []
+        self.ts_list = []
+        self.buffer_dict = {}
+        self.size_dict = {}
+        self.size = 0
+        self.collected_list = []
+        self.collected_dict = {}
+        self.chunks = []
+        self.current_row = []
+
+    def send_metric(self, timestamp, field_name, data, instance, device=''):
+        self.append(timestamp, field_name, float(data), instance, device)
+        while self.collected_list:
+            (ts, key, index) = self.collected_list.pop()
+            del self.ts_list[index]
+            self.collected_dict.pop(key)
+            self.transpose(ts, key)
+            self.send_full_chunk()
+        while self.size >= self.agent.agent_config_vars['metric_buffer_size'] and self.ts_list:
+            (ts, key) = self.ts_list.pop()
+            self.transpose(ts, key)
+            self.send_full_chunk()
+        self.send_full_chunk()
+
+    def append(self, timestamp, field_name, data, instance, device):
+        instance_str = self.agent.make_safe_instance_string(instance, device)
+        key = '{}-{}'.format(str(timestamp), instance_str)
+        metric_str = self.agent.make_safe_metric_key(field_name)
+        metric_key = '{}[{}]'.format(metric_str, instance_str)
+        if key not in self.key_list:
+            self.key_list.append(key)
+            self.ts_list.append((timestamp, key))
+            self.ts_list.sort(key=lambda elem: elem[0], reverse=True)
+            self.buffer_dict[key] = dict()
+            self.size_dict[key] = self.agent.get_json_size_bytes(key) + 6
+            self.size += self.size_dict[key]
+            self.collected_dict[key] = []
+        value_str = str(data)
+        value_size = self.agent.get_json_size_bytes(value_str)
+        if metric_key in self.buffer_dict[key]:
+            value_size -= self.agent.get_json_size_bytes(self.buffer_dict[key][metric_key])
+        else:
+            value_size += self.agent.get_json_size_bytes(metric_key) + 4
+        self.buffer_dict[key][metric_key] = value_str
+        self.size_dict[key] += value_size
+        self.size += value_size
+        self.collected_dict[key].append(metric_str)
+        all_metrics = self.agent.agent_config_vars['all_metrics']
+        if all_metrics and set(all_metrics) <= set(self.collected_dict[key]):
+            self.collected_list.append((timestamp, key, self.ts_list.index((timestamp, key))))
+
+    def transpose(self, ts, key):
+        self.key_list.remove(key)
+        self.size -= self.size_dict.pop(key)
+        self.current_row.append(dict({'timestamp': str(ts)}, **self.buffer_dict.pop(key)))
+
+    def send_full_chunk(self):
+        if self.agent.get_json_size_bytes(self.current_row) >= self.agent.if_config_vars['chunk_size']:
+            self.chunks.append(self.current_row)
+            self.current_row = []
+
+
+def make_samples(count, instances=5, fields=('cpu', 'mem', 'disk.used'), seed=0):
+    """ reproducible (timestamp, field name, value, instance) samples, arriving out of timestamp order """
+    rand = random.Random(seed)
+    return [(1560000000000 + rand.randint(0, 20) * 60000, rand.choice(fields), round(rand.uniform(0, 100), 3),
+             'host-{}'.format(rand.randint(1, instances))) for _ in range(count)]
+
+
+class MetricBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.agent = load_agent('template/insightagent-boilerplate.py')
+        self.agent.if_config_vars = {'chunk_size': 2048, 'run_interval': RUN_INTERVAL}
+        self.agent.agent_config_vars = {'all_metrics': set(), 'metric_buffer_size': 4096}
+        self.agent.track.update({'chunk_count': 0, 'entry_count': 0, 'metrics_suppressed': 0})
+        self.agent.reset_track()
+        self.agent.reset_metric_buffer()
+        self.chunks = []
+
+        def send_data_wrapper():
+            self.chunks.append(self.agent.track['current_row'])
+            self.agent.reset_track()
+        self.agent.send_data_wrapper = send_data_wrapper
+        self.before = MetricBufferAsBefore(self.agent)
+
+    def send_metric(self, timestamp, field_name, data, instance, device=''):
+        """ send a sample through both buffers, checking they estimate the same size """
+        self.agent.send_metric(timestamp, field_name, data, instance, device)
+        self.before.send_metric(timestamp, field_name, data, instance, device)
+        self.assertEqual(self.agent.metric_buffer['buffer_size'], self.before.size)
+
+    def get_buffered_rows(self):
+        """ the rows still buffered, as they would be flushed """
+        return dict((key, self.agent.build_metric_row(int(key.partition('-')[0]), row))
+                    for key, row in self.agent.metric_buffer['buffer_dict'].items())
+
+    def get_buffered_rows_before(self):
+        return dict((key, dict({'timestamp': key.partition('-')[0]}, **row))
+                    for key, row in self.before.buffer_dict.items())
+
+    def test_oldest_first_eviction(self):
+        for sample in make_samples(3000):
+            self.send_metric(*sample)
+        self.assertGreater(len(self.chunks), 10)
+        self.assertEqual(self.chunks, self.before.chunks)
+        self.assertEqual(self.agent.track['current_row'], self.before.current_row)
+        self.assertEqual(self.get_buffered_rows(), self.get_buffered_rows_before())
+
+    def test_evicts_oldest_timestamp_first(self):
+        # each row is 50 bytes, so a fourth row evicts one, and each evicted row is sent on its own
+        self.agent.agent_config_vars['metric_buffer_size'] = 200
+        self.agent.if_config_vars['chunk_size'] = 10
+        for ts in (3, 1, 2, 4, 0, 5):
+            self.send_metric(1560000000000 + ts * 60000, 'cpu', 1, 'host-1')
+        self.assertEqual([chunk[0]['timestamp'] for chunk in self.chunks],
+                         ['1560000060000', '1560000000000', '1560000120000'])
+        self.assertEqual(self.chunks, self.before.chunks)
+
+    def test_evicts_last_added_first_within_a_timestamp(self):
+        # as the rows came off the end of the sorted list before
+        self.agent.agent_config_vars['metric_buffer_size'] = 200
+        self.agent.if_config_vars['chunk_size'] = 10
+        for instance in ('host-1', 'host-2', 'host-3'):
+            self.send_metric(1560000000000, 'cpu', 1, instance)
+        self.send_metric(1560000060000, 'cpu', 1, 'host-1')
+        self.send_metric(1560000060000, 'cpu', 1, 'host-2')
+        self.assertEqual([sorted(chunk[0]) for chunk in self.chunks],
+                         [['cpu[host-3]', 'timestamp'], ['cpu[host-2]', 'timestamp']])
+        self.assertEqual(self.chunks, self.before.chunks)
+
+    def test_flush_when_all_metrics_complete(self):
+        self.agent.agent_config_vars.update({'all_metrics': {'cpu', 'mem'}, 'metric_buffer_size': 10 ** 6})
+        for sample in make_samples(2000):
+            self.send_metric(*sample)
+        self.assertGreater(len(self.chunks), 5)
+        self.assertEqual(self.chunks, self.before.chunks)
+        self.assertEqual(self.agent.track['current_row'], self.before.current_row)
+        self.assertEqual(self.get_buffered_rows(), self.get_buffered_rows_before())
+        # only rows still missing cpu or mem are left
+        for key, row in self.get_buffered_rows().items():
+            instance = key.partition('-')[2]
+            self.assertFalse({'cpu[{}]'.format(instance), 'mem[{}]'.format(instance)} <= set(row))
+
+    def test_row_flushed_once_its_metrics_are_collected(self):
+        self.agent.agent_config_vars.update({'all_metrics': {'cpu', 'mem'}, 'metric_buffer_size': 10 ** 6})
+        # less than one row, so each row is sent as it is flushed
+        self.agent.if_config_vars['chunk_size'] = 10
+        self.send_metric(1560000000000, 'cpu', 1, 'host-1')
+        self.send_metric(1560000060000, 'cpu', 2, 'host-1')
+        self.send_metric(1560000060000, 'disk', 3, 'host-1')
+        self.assertEqual(self.chunks, [])
+        self.send_metric(1560000060000, 'mem', 4, 'host-1')
+        self.assertEqual(self.chunks, [[{'timestamp': '1560000060000', 'cpu[host-1]': '2.0', 'disk[host-1]': '3.0',
+                                         'mem[host-1]': '4.0'}]])
+        self.assertEqual(self.chunks, self.before.chunks)
+        self.assertEqual(list(self.agent.metric_buffer['buffer_dict']), ['1560000000000-host-1'])
+
+
+class MetricRowTest(unittest.TestCase):
+    def setUp(self):
+        self.agent = load_agent('template/insightagent-boilerplate.py')
+        self.agent.agent_config_vars = {'all_metrics': set()}
+        self.agent.reset_metric_buffer()
+        self.before = MetricBufferAsBefore(self.agent)
+
+    def append(self, timestamp, field_name, data, instance, device=''):
+        """ buffer a sample in both buffers, as send_metric does once it has checked the value """
+        data = float(data)
+        self.agent.append_metric_data_to_buffer(timestamp, field_name, data, instance, device)
+        self.before.append(timestamp, field_name, data, instance, device)
+
+    def assertSameAsBefore(self):
+        buffer_dict = self.agent.metric_buffer['buffer_dict']
+        self.assertEqual(sorted(buffer_dict), sorted(self.before.buffer_dict))
+        for key, row in buffer_dict.items():
+            ts = key.partition('-')[0]
+            self.assertEqual(self.agent.build_metric_row(ts, row),
+                             dict({'timestamp': ts}, **self.before.buffer_dict[key]))
+        self.assertEqual(self.agent.metric_buffer['buffer_size'], self.before.size)
+        # '"key": ' plus the row without its timestamp, and the ', ' separator
+        self.assertEqual(self.agent.metric_buffer['buffer_size'], sum(
+            self.agent.get_json_size_bytes(key) + 4 + self.agent.get_json_size_bytes(row) + 2
+            for key, row in self.before.buffer_dict.items()))
+
+    def test_columns_added_after_row_started(self):
+        self.append(1000, 'cpu', 1.5, 'host-1')
+        self.append(2000, 'cpu', 2.5, 'host-1')
+        self.append(2000, 'mem', 30.25, 'host-1')
+        # the row at 1000 was started before host-1 had a mem column
+        self.append(1000, 'mem', 10.0, 'host-1')
+        self.append(1000, 'net_in', 7, 'host-1')
+        self.append(2000, 'cpu', 3.0, 'host-2')
+        self.assertSameAsBefore()
+        self.assertEqual(len(self.agent.metric_buffer['buffer_dict']['1000-host-1']['values']), 3)
+        self.assertEqual(len(self.agent.metric_buffer['buffer_dict']['2000-host-1']['values']), 2)
+
+    def test_field_names_sharing_a_safe_key(self):
+        # '.' becomes '/' and '[]' become '()' in safe metric names
+        self.append(1000, 'disk.used', 1, 'host_1')
+        self.append(1000, 'disk/used', 2, 'host_1')
+        self.append(1000, 'load[1m]', 3, 'host_1')
+        self.append(2000, 'load(1m)', 4, 'host_1')
+        self.append(2000, 'load[1m]', 5, 'host_1')
+        self.assertSameAsBefore()
+        columns = self.agent.get_metric_columns('host_1')
+        self.assertEqual(columns['names'], ['disk/used', 'load(1m)'])
+
+    def test_overwritten_values(self):
+        for value in (1, 12345.678, -0.001, 1e20, 0, 7):
+            self.append(1000, 'cpu', float(value), 'host-1', 'eth0')
+        self.assertSameAsBefore()
+
+    def test_size_estimate(self):
+        for sample in make_samples(500, instances=20, fields=('cpu', 'mem', 'disk.used', 'net[in]', 'net(in)')):
+            self.append(*sample)
+        self.assertSameAsBefore()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zlib
+
+from agents import load_agent, start_mock_server
+
+METRIC_ENTRY = {'timestamp': '1600000000000', 'cpu[host-1]': '1.5'}
+# the mock answers entries like this with a 400
+INVALID_METRIC_ENTRY = {'timestamp': '1600000000000', 'cpu[host-1]': 'not a number'}
+
+
+class SpoolTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server, cls.if_url = start_mock_server()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.server.error_rate = 0
+        self.server.reset_stats()
+        self.work_dir = tempfile.mkdtemp()
+        agent = self.agent = load_agent('template/insightagent-boilerplate.py')
+        agent.BACKOFF_BASE_SECONDS = 0
+        agent.cli_config_vars = {'testing': False}
+        agent.if_config_vars = {
+            'user_name': 'user',
+            'license_key': 'key',
+            'project_name': 'project',
+            'project_type': 'METRIC',
+            'is_replay': False,
+            'sampling_interval': 60,
+            'max_in_flight_chunks': 0,
+            'max_chunk_size': 0,
+            'if_compression': '',
+            'if_proxies': dict(),
+            'if_url': self.if_url,
+            'spool_dir': os.path.join(self.work_dir, 'spool'),
+            'spool_max_size': 100 * 1024 * 1024,
+            'spool_replay_rate': 1000
+        }
+        agent.track.update(dict.fromkeys(agent.WORKER_COUNTERS, 0))
+        agent.open_spool(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def spooled_payloads(self):
+        return [payload for segment in self.agent.get_spool_segments()
+                for offset, payload in self.agent.read_spool_segment(segment)]
+
+    def test_record_format(self):
+        data_to_post = self.agent.get_chunk_post_data([METRIC_ENTRY])
+        self.agent.spool_chunk(data_to_post)
+        segments = self.agent.get_spool_segments()
+        self.assertEqual(segments, ['000000000000.seg'])
+        with open(os.path.join(self.agent.spool['dir'], segments[0]), 'rb') as segment_file:
+            (header, payload) = segment_file.read().split('\n', 1)
+        (length, checksum) = [int(i) for i in header.split()]
+        self.assertEqual(payload, self.agent.json.dumps(data_to_post) + '\n')
+        self.assertEqual(length, len(payload) - 1)
+        self.assertEqual(checksum, zlib.crc32(payload[:-1]) & 0xffffffff)
+
+    def test_corrupt_record_is_skipped(self):
+        for i in range(3):
+            self.agent.spool_chunk({'chunk': i})
+        segment_path = os.path.join(self.agent.spool['dir'], self.agent.get_spool_segments()[0])
+        with open(segment_path, 'rb') as segment_file:
+            records = segment_file.read()
+        # flip a byte of the second payload
+        second = records.index('"chunk": 1')
+        with open(segment_path, 'wb') as segment_file:
+            segment_file.write(records[:second] + 'X' + records[second + 1:])
+        self.assertEqual(self.spooled_payloads(), ['{"chunk": 0}', '{"chunk": 2}'])
+
+    def test_truncated_record_ends_segment(self):
+        for i in range(2):
+            self.agent.spool_chunk({'chunk': i})
+        segment_path = os.path.join(self.agent.spool['dir'], self.agent.get_spool_segments()[0])
+        with open(segment_path, 'rb+') as segment_file:
+            segment_file.truncate(os.path.getsize(segment_path) - 4)
+        self.assertEqual(self.spooled_payloads(), ['{"chunk": 0}'])
+
+    def test_server_error_is_spooled(self):
+        self.server.error_rate = 1
+        self.assertFalse(self.agent.send_data_to_if([METRIC_ENTRY]))
+        self.assertEqual(len(self.spooled_payloads()), 1)
+
+    def test_client_error_is_not_spooled(self):
+        self.assertFalse(self.agent.send_data_to_if([INVALID_METRIC_ENTRY]))
+        self.assertEqual(self.server.get_stats()['invalid'], 1)
+        self.assertEqual(self.spooled_payloads(), [])
+
+    def test_replay_drops_chunks_rejected_with_a_client_error(self):
+        self.agent.spool_chunk(self.agent.get_chunk_post_data([INVALID_METRIC_ENTRY]))
+        self.agent.spool_chunk(self.agent.get_chunk_post_data([METRIC_ENTRY]))
+        self.agent.replay_spool()
+        stats = self.server.get_stats()
+        self.assertEqual(stats['invalid'], 1)
+        self.assertEqual(stats['accepted'], 1)
+        self.assertEqual(self.agent.get_spool_segments(), [])
+
+    def test_replay_stops_at_server_errors_and_resumes(self):
+        for _ in range(3):
+            self.agent.spool_chunk(self.agent.get_chunk_post_data([METRIC_ENTRY]))
+        self.server.error_rate = 1
+        self.agent.replay_spool()
+        self.assertEqual(self.server.get_stats()['accepted'], 0)
+        self.assertEqual(len(self.spooled_payloads()), 3)
+        self.server.error_rate = 0
+        self.agent.replay_spool()
+        self.assertEqual(self.server.get_stats()['accepted'], 3)
+        self.assertEqual(self.agent.get_spool_segments(), [])
+
+    def test_replay_throughput(self):
+        chunks = 200
+        data_to_post = self.agent.get_chunk_post_data([METRIC_ENTRY] * 100)
+        for _ in range(chunks):
+            self.agent.spool_chunk(data_to_post)
+        start_time = time.time()
+        self.agent.replay_spool()
+        elapsed = time.time() - start_time
+        stats = self.server.get_stats()
+        self.assertEqual(stats['accepted'], chunks)
+        self.assertEqual(stats['events'], chunks * 100)
+        # well under the rate limit, so this is bounded by posting and reading the spool
+        self.assertGreater(chunks / elapsed, 30, 'replayed {:.1f} chunks/sec'.format(chunks / elapsed))
+
+    def test_replay_keeps_to_rate(self):
+        self.agent.if_config_vars['spool_replay_rate'] = 20
+        for _ in range(5):
+            self.agent.spool_chunk(self.agent.get_chunk_post_data([METRIC_ENTRY]))
+        start_time = time.time()
+        self.agent.replay_spool()
+        self.assertGreaterEqual(time.time() - start_time, 0.2)
+        self.assertEqual(self.server.get_stats()['accepted'], 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# coding=utf-8
+import copy
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from agents import REPO_DIR, list_imports, write_config
+from test_template_config import OLD_CONFIG
+
+SCRIPT = 'template/insightagent-boilerplate.py'
+# modules only some configs use, which a --testing run of a json config with no timezone shouldn't import
+DEFERRED_MODULES = ('requests', 'httplib', 'arrow', 'pytz', 'dateutil', 'statistics', 'xml2dict', 'decimal',
+                    'urllib', 'cProfile', 'tracemalloc', 'pandas', 'xlrd', 'avro')
+
+
+class StartupTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.config = copy.deepcopy(OLD_CONFIG)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_config(self):
+        config_ini = os.path.join(self.work_dir, 'config.ini')
+        write_config(config_ini, self.config)
+        return config_ini
+
+    def test_optional_modules_stay_deferred(self):
+        imported = list_imports(SCRIPT, ['-c', self.write_config(), '-t', '-q'], DEFERRED_MODULES, self.work_dir)
+        self.assertEqual(imported, [])
+
+    def test_timezone_imports_only_what_it_needs(self):
+        self.config['agent']['timezone'] = 'US/Eastern'
+        imported = list_imports(SCRIPT, ['-c', self.write_config(), '-t', '-q'], DEFERRED_MODULES, self.work_dir)
+        # arrow imports dateutil
+        self.assertEqual(sorted(imported), ['arrow', 'dateutil', 'pytz'])
+
+    def test_sending_imports_requests(self):
+        imported = list_imports(SCRIPT, ['-c', self.write_config(), '-q'], DEFERRED_MODULES, self.work_dir)
+        self.assertIn('requests', imported)
+        self.assertNotIn('arrow', imported)
+
+    def test_profile_startup_reports_each_stage(self):
+        output = subprocess.check_output([sys.executable, os.path.join(REPO_DIR, SCRIPT), '-c', self.write_config(),
+                                          '-t', '--profile-startup'], cwd=self.work_dir, stderr=subprocess.STDOUT)
+        # how long it took is only reported, as it depends on the machine
+        report = re.search(r'Startup took [\d.]+ ms \(.*?\):\n((?:\t.*\n)+)', output)
+        self.assertTrue(report, output)
+        stages = [line.strip().rpartition(':')[0] for line in report.group(1).splitlines()]
+        self.assertEqual(stages, ['imports and definitions', 'options and logging', 'insightfinder config',
+                                  'agent config'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+# coding=utf-8
+import threading
+import unittest
+
+from agents import load_agent
+
+THREADS = 16
+
+
+class SessionTest(unittest.TestCase):
+    def setUp(self):
+        self.agent = load_agent('template/insightagent-boilerplate.py')
+        self.agent.if_config_vars = {'max_in_flight_chunks': THREADS}
+
+    def test_sender_threads_share_one_session(self):
+        started = []
+        start_session = self.agent.start_session
+
+        def count_starts():
+            started.append(True)
+            start_session()
+
+        self.agent.start_session = count_starts
+        ready = threading.Event()
+        sessions = []
+
+        def get_session():
+            ready.wait()
+            sessions.append(self.agent.get_session())
+
+        threads = [threading.Thread(target=get_session) for _ in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        ready.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(started), 1)
+        self.assertEqual(len(set(id(session) for session in sessions)), 1)
+        self.assertIn('lock', self.agent.transport)
+
+
+if __name__ == '__main__':
+    unittest.main()
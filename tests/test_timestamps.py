@@ -0,0 +1,258 @@
+# coding=utf-8
+import time
+import unittest
+from datetime import datetime, timedelta
+
+import arrow
+import pytz
+
+from agents import load_agent
+
+# days on which each zone's UTC offset changes, plus an ordinary day
+DAYS = {
+    None: ['2019-03-10'],
+    'UTC': ['2019-03-10'],
+    # clocks go forward at 02:00 and back at 02:00
+    'US/Eastern': ['2019-03-10', '2019-11-03', '2019-07-01'],
+    # +10:30 / +11:00, shifting by half an hour at 02:00
+    'Australia/Lord_Howe': ['2019-04-07', '2019-10-06'],
+    # +05:30 all year
+    'Asia/Kolkata': ['2019-03-10'],
+}
+FRACTIONS = ['.5', '.123', '.123456', '.1234565', '.1234575', '.9999996']
+OFFSETS = ['Z', '+05:30', '-04:00']
+
+
+def local_times(day):
+    """ naive local times every ten minutes through a day, and the last second of each hour """
+    start = datetime.strptime(day, '%Y-%m-%d')
+    times = [start + timedelta(minutes=10 * i) for i in range(6 * 24)]
+    times.extend(start + timedelta(hours=hour, minutes=59, seconds=59) for hour in range(24))
+    return sorted(times)
+
+
+def outcome(parse, date_string):
+    """ what parsing a date string gives, or that it raised """
+    try:
+        return parse(date_string)
+    except Exception:
+        return 'raised'
+
+
+def template_timestamp_as_before(agent, date_string):
+    """ the template's get_timestamp_from_date_string before the compiled parsers: arrow for every format """
+    timezone = agent.agent_config_vars['timezone']
+    for timestamp_format in agent.agent_config_vars['timestamp_format']:
+        try:
+            if timestamp_format == 'epoch':
+                if 13 <= len(date_string) < 15:
+                    datetime_obj = arrow.get(time.gmtime(int(date_string) / 1000))
+                elif 9 <= len(date_string) < 13:
+                    datetime_obj = arrow.get(time.gmtime(int(date_string)))
+                else:
+                    continue
+            elif timezone:
+                datetime_obj = arrow.get(date_string, timestamp_format, tzinfo=timezone.zone)
+            else:
+                datetime_obj = arrow.get(date_string, timestamp_format)
+        except Exception:
+            continue
+        return int(datetime_obj.float_timestamp * 1000)
+    return None
+
+
+def file_replay_timestamp_as_before(agent, date_string):
+    """ file_replay's get_timestamp_from_date_string before the compiled parsers: strptime, then localize """
+    date_string = date_string.partition('.')[0]
+    timestamp_datetime = date_string
+    if agent.agent_config_vars['strip_tz']:
+        date_string = ''.join(agent.agent_config_vars['strip_tz_fmt'].split(date_string))
+    for timestamp_format in agent.agent_config_vars['timestamp_format']:
+        try:
+            if timestamp_format == 'epoch':
+                timestamp_datetime = agent.get_datetime_from_unix_epoch(date_string)
+            else:
+                timestamp_datetime = datetime.strptime(date_string, timestamp_format)
+            break
+        except Exception:
+            continue
+    timestamp_localize = agent.agent_config_vars['timezone'].localize(timestamp_datetime)
+    return long((timestamp_localize - datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds()) * 1000
+
+
+class TemplateTimestampTest(unittest.TestCase):
+    def setUp(self):
+        self.agent = load_agent('template/insightagent-boilerplate.py')
+        self.arrow_calls = 0
+        parse_timestamp_with_arrow = self.agent.parse_timestamp_with_arrow
+
+        def count_arrow_calls(date_string, timestamp_format):
+            self.arrow_calls += 1
+            return parse_timestamp_with_arrow(date_string, timestamp_format)
+        self.agent.parse_timestamp_with_arrow = count_arrow_calls
+
+    def configure(self, timestamp_formats, timezone=None):
+        """ set the agent's formats and timezone, dropping what was compiled for the last ones """
+        self.agent.agent_config_vars = {
+            'timestamp_format': list(timestamp_formats),
+            'timezone': pytz.timezone(timezone) if timezone else ''
+        }
+        self.agent.TIMESTAMP_PARSERS.clear()
+        self.agent.UTC_OFFSETS.clear()
+
+    def assertSameAsBefore(self, date_strings):
+        for date_string in date_strings:
+            # parsed with the format list as configured, not as reordered by the new parser
+            formats = list(self.agent.agent_config_vars['timestamp_format'])
+            expected = outcome(lambda ds: template_timestamp_as_before(self.agent, ds), date_string)
+            actual = outcome(self.agent.get_timestamp_from_date_string, date_string)
+            self.agent.agent_config_vars['timestamp_format'] = formats
+            self.assertEqual(actual, expected, '{} as {} in {}'.format(
+                date_string, formats, self.agent.agent_config_vars['timezone']))
+
+    def test_fixed_layout(self):
+        for timezone, days in sorted(DAYS.items()):
+            for day in days:
+                times = local_times(day)
+                # forwards and backwards, so the per-hour offsets are cached from either side of a change
+                for ordered_times in (times, times[::-1]):
+                    self.configure(['YYYY-MM-DD HH:mm:ss'], timezone)
+                    self.assertSameAsBefore([t.strftime('%Y-%m-%d %H:%M:%S') for t in ordered_times])
+                    self.configure(['YYYYMMDDHHmmss'], timezone)
+                    self.assertSameAsBefore([t.strftime('%Y%m%d%H%M%S') for t in ordered_times])
+                self.configure(['YYYY-MM-DDTHH:mm:ss.SZZ'], timezone)
+                self.assertSameAsBefore([t.strftime('%Y-%m-%dT%H:%M:%S') + fraction + offset
+                                         for t in times[::7] for fraction in FRACTIONS for offset in OFFSETS])
+        self.assertEqual(self.arrow_calls, 0)
+
+    def test_invalid_fields(self):
+        self.configure(['YYYY-MM-DD HH:mm:ss'], 'US/Eastern')
+        self.assertSameAsBefore(['2019-02-29 00:00:00', '2019-13-01 00:00:00', '2019-03-10 00:60:00',
+                                 '0000-01-01 00:00:00',
+                                 # arrow reads 24:00:00, and only that, as the next day's midnight
+                                 '2019-03-10 24:00:00', '2019-12-31 24:00:00', '2019-03-10 24:00:01',
+                                 '9999-12-31 24:00:00'])
+        self.configure(['YYYY-MM-DD HH:mm:ss.S'], 'US/Eastern')
+        self.assertSameAsBefore(['2019-11-03 24:00:00.0', '2019-11-03 24:00:00.5', '2019-11-03 01:59:59.9999999'])
+        self.assertEqual(self.arrow_calls, 0)
+
+    def test_lenient_fallback(self):
+        self.configure(['YYYY-MM-DD HH:mm:ss'], 'US/Eastern')
+        # not the exact layout, but arrow may still find it in the string
+        self.assertSameAsBefore(['at 2019-03-10 01:30:00', '2019-03-10 01:30:00 EST', '2019-03-10 01:30:00x'])
+        self.assertEqual(self.arrow_calls, 3)
+        # nowhere in the string, so rejected without asking arrow
+        self.assertSameAsBefore(['2019-03-10 1:30:00', '2019/03/10 01:30:00', 'garbage', ''])
+        self.assertEqual(self.arrow_calls, 3)
+
+    def test_other_formats_use_arrow(self):
+        self.configure(['DD/MMM/YYYY:HH:mm:ss Z', 'YYYY-MM-DD hh:mm:ss A'], 'Australia/Lord_Howe')
+        self.assertSameAsBefore(['10/Mar/2019:01:30:00 -0500', '2019-04-07 01:45:00 AM', '2019-04-07 01:45:00 PM'])
+        self.assertEqual(self.arrow_calls, 5)
+
+    def test_epoch(self):
+        self.configure(['epoch'])
+        self.assertSameAsBefore([
+            '1552197600', '1552197600123', '15521976001234', '123456789', '-1234567890',
+            # the first and last seconds a datetime can hold, and either side of them
+            '-62135596800', '-62135596801', '253402300799', '253402300800', '999999999999',
+            # too short or too long to be an epoch, or not a number
+            '12345678', '155219760012345', '1552197600.5', 'abcdefghij'])
+
+    def test_matching_format_is_tried_first(self):
+        formats = ['YYYY-MM-DD HH:mm:ss', 'YYYYMMDDHHmmss', 'YYYY-MM-DDTHH:mm:ssZZ', 'epoch']
+        self.configure(formats, 'US/Eastern')
+        self.assertSameAsBefore(['20190310013000'])
+        self.assertEqual(self.agent.agent_config_vars['timestamp_format'], formats)
+        self.agent.get_timestamp_from_date_string('2019-03-10T01:30:00Z')
+        self.assertEqual(self.agent.agent_config_vars['timestamp_format'],
+                         ['YYYY-MM-DDTHH:mm:ssZZ', 'YYYY-MM-DD HH:mm:ss', 'YYYYMMDDHHmmss', 'epoch'])
+        self.agent.get_timestamp_from_date_string('20190310013000')
+        self.assertEqual(self.agent.agent_config_vars['timestamp_format'],
+                         ['YYYYMMDDHHmmss', 'YYYY-MM-DDTHH:mm:ssZZ', 'YYYY-MM-DD HH:mm:ss', 'epoch'])
+
+    def test_epoch_is_not_tried_first(self):
+        # epoch would read a 14 digit YYYYMMDDHHmmss timestamp as unix epoch (ms)
+        formats = ['YYYYMMDDHHmmss', 'epoch']
+        self.configure(formats, 'US/Eastern')
+        self.agent.get_timestamp_from_date_string('1552197600')
+        self.assertEqual(self.agent.agent_config_vars['timestamp_format'], formats)
+        self.assertSameAsBefore(['20190310013000', '1552197600'])
+
+
+class FileReplayTimestampTest(unittest.TestCase):
+    def setUp(self):
+        self.agent = load_agent('file_replay/getmessages_file_replay.py')
+
+    def configure(self, timestamp_format, timezone):
+        """ set the agent's formats and timezone as get_agent_config_vars would, dropping what was compiled """
+        if timestamp_format:
+            self.agent.agent_config_vars = {
+                'timestamp_format': [timestamp_format],
+                'strip_tz': False,
+                'strip_tz_fmt': ''
+            }
+        else:
+            self.agent.agent_config_vars = {
+                'timestamp_format': list(self.agent.ISO8601),
+                'strip_tz': True,
+                'strip_tz_fmt': self.agent.PCT_z_FMT
+            }
+        self.agent.agent_config_vars['timezone'] = pytz.timezone(timezone)
+        self.agent.DATETIME_PARSERS.clear()
+        self.agent.UTC_OFFSETS.clear()
+
+    def assertSameAsBefore(self, date_strings):
+        for date_string in date_strings:
+            formats = list(self.agent.agent_config_vars['timestamp_format'])
+            expected = outcome(lambda ds: file_replay_timestamp_as_before(self.agent, ds), date_string)
+            actual = outcome(self.agent.get_timestamp_from_date_string, date_string)
+            self.agent.agent_config_vars['timestamp_format'] = formats
+            self.assertEqual(actual, expected, '{} as {} in {}'.format(
+                date_string, formats, self.agent.agent_config_vars['timezone']))
+
+    def test_fixed_layout(self):
+        for timezone, days in sorted(DAYS.items()):
+            for day in days:
+                times = local_times(day)
+                for ordered_times in (times, times[::-1]):
+                    self.configure('%Y-%m-%d %H:%M:%S', timezone or 'UTC')
+                    self.assertSameAsBefore([t.strftime('%Y-%m-%d %H:%M:%S') for t in ordered_times])
+                    # the default ISO-8601 formats, with any offset stripped
+                    self.configure(None, timezone or 'UTC')
+                    self.assertSameAsBefore([t.strftime('%Y-%m-%dT%H:%M:%S') + offset
+                                             for t in ordered_times for offset in [''] + OFFSETS])
+                self.configure(None, timezone or 'UTC')
+                self.assertSameAsBefore([t.strftime('%Y%m%dT%H%M%S') + fraction + 'Z'
+                                         for t in times[::7] for fraction in FRACTIONS])
+
+    def test_lenient_fallback(self):
+        self.configure('%Y-%m-%d %H:%M:%S', 'US/Eastern')
+        # strptime takes single digits and any whitespace, but not extra text
+        self.assertSameAsBefore(['2019-3-10 1:30:0', '2019-03-10   01:30:00', '2019-03-10\t02:30:00',
+                                 '2019-03-10 01:30:00 ', 'at 2019-03-10 01:30:00', '2019/03/10 01:30:00',
+                                 '2019-02-29 00:00:00', '2019-03-10 24:00:00', 'garbage', ''])
+
+    def test_other_formats_use_strptime(self):
+        self.configure('%d/%b/%Y:%H:%M:%S', 'Asia/Kolkata')
+        self.assertSameAsBefore(['10/Mar/2019:01:30:00', '10/mar/2019:01:30:00', '10/Foo/2019:01:30:00'])
+
+    def test_epoch(self):
+        self.configure('epoch', 'US/Eastern')
+        self.assertSameAsBefore(['1552197600', '1552197600123', '15521976001234', '0001552197600'])
+
+    def test_matching_format_is_tried_first(self):
+        self.configure(None, 'US/Eastern')
+        formats = list(self.agent.ISO8601)
+        self.agent.get_timestamp_from_date_string('1552197600123')
+        # epoch exits on anything that isn't a number, so it stays last
+        self.assertEqual(self.agent.agent_config_vars['timestamp_format'], formats)
+        self.assertSameAsBefore(['20190310T013000Z'])
+        self.agent.get_timestamp_from_date_string('20190310T013000Z')
+        self.assertEqual(self.agent.agent_config_vars['timestamp_format'],
+                         ['%Y%m%dT%H%M%SZ', '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S', 'epoch'])
+        self.assertSameAsBefore(['2019-03-10T01:30:00Z', '2019-03-10T01:30:00'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# coding=utf-8
+import os
+import unittest
+from multiprocessing import Process, Queue as ProcessQueue
+
+from agents import load_agent
+
+WORKERS = 3
+# more than a pipe holds, so a worker blocks at exit until its counters are read
+COUNTERS = dict(('counter_{}'.format(i), 1) for i in range(20000))
+
+
+def report_counters(counter_queue):
+    counter_queue.put(COUNTERS)
+
+
+class WorkerCountersTest(object):
+    script = None
+
+    def setUp(self):
+        self.agent = load_agent(self.script)
+        self.agent.log_suppression_ratio = lambda *args: None
+
+    def start_workers(self, target, counter_queue):
+        process_list = [Process(target=target, args=(counter_queue,)) for _ in range(WORKERS)]
+        for p in process_list:
+            p.start()
+        return process_list
+
+    def test_large_counters_are_read_before_joining(self):
+        counter_queue = ProcessQueue()
+        process_list = self.start_workers(report_counters, counter_queue)
+        # with a join first, this would never return
+        self.agent.merge_worker_counters(counter_queue, process_list)
+        self.assertFalse(any(p.is_alive() for p in process_list))
+
+    def test_workers_that_exit_without_reporting(self):
+        counter_queue = ProcessQueue()
+        process_list = self.start_workers(lambda counter_queue: os._exit(1), counter_queue)
+        self.agent.merge_worker_counters(counter_queue, process_list)
+        self.assertFalse(any(p.is_alive() for p in process_list))
+
+
+class TemplateWorkerCountersTest(WorkerCountersTest, unittest.TestCase):
+    script = 'template/insightagent-boilerplate.py'
+
+
+class FileReplayWorkerCountersTest(WorkerCountersTest, unittest.TestCase):
+    script = 'file_replay/getmessages_file_replay.py'
+
+
+class Kafka2WorkerCountersTest(WorkerCountersTest, unittest.TestCase):
+    script = 'kafka2/getmessages_kafka2.py'
+
+
+if __name__ == '__main__':
+    unittest.main()